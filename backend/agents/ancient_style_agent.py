@@ -2,6 +2,7 @@ import json
 import dashscope
 from dashscope.api_entities.dashscope_response import Role
 from backend.app.agent_manager import BaseAgent
+from backend.app.llm_client import UpstreamError
 from typing import AsyncGenerator
 
 class AncientStyleAgent(BaseAgent):
@@ -12,6 +13,8 @@ class AncientStyleAgent(BaseAgent):
             description="用文言文带有冒犯性和诙谐性的方式回应他人"
         )
         dashscope.api_key = "sk-"
+        # 回复中的半角标点转换为全角，再过滤违禁词
+        self.stream_middleware = ["fullwidth_punctuation", "content_filter"]
         
         # 设置系统提示
         self.system_prompt = '''## Role: 文言喷子
@@ -73,25 +76,11 @@ class AncientStyleAgent(BaseAgent):
         ]
         
         try:
-            stream_response = dashscope.Generation.call(
-                model='qwen-turbo',
-                messages=messages,
-                result_format='message',
-                stream=True  # 启用流式输出
-            )
-            
-            # 跟踪之前接收到的内容，以便只返回新增部分
-            previous_content = ""
-            
-            # 处理流式响应
-            for response in stream_response:
-                if hasattr(response.output, 'choices') and response.output.choices:
-                    current_content = response.output.choices[0].message.content
-                    # 只返回新增的部分
-                    new_content = current_content[len(previous_content):]
-                    previous_content = current_content
-                    yield new_content
-                else:
-                    yield ""
+            # 通过统一的上游客户端流式调用，首包前的上游抖动会自动重试
+            async for new_content in self.stream_chat(messages):
+                yield new_content
+        except UpstreamError:
+            # 上游调用失败交给生成任务作为错误结束，不作为回复内容写入历史
+            raise
         except Exception as e:
             yield f"文言文回复中出现错误: {str(e)}"
\ No newline at end of file
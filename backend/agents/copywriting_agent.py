@@ -2,6 +2,8 @@ import json
 import dashscope
 from dashscope.api_entities.dashscope_response import Role
 from backend.app.agent_manager import BaseAgent
+from backend.app.llm_client import UpstreamError
+import random
 from typing import AsyncGenerator
 
 class CopywritingAgent(BaseAgent):
@@ -13,6 +15,14 @@ class CopywritingAgent(BaseAgent):
         )
         dashscope.api_key = "sk-"
         
+        # 多版本生成时每个变体采用的地方特色
+        self.dialect_flavors = [
+            "粤语腔调", "川渝方言", "东北话", "台湾腔", "吴语软糯",
+            "京片子", "湖南话", "闽南语腔调", "陕西话", "网络热梗"
+        ]
+        # 多版本生成时本地评分使用的关键词
+        self.variant_keywords = ["嘛", "啦", "咩", "~", "get", "啊"]
+        
         # 设置系统提示
         self.system_prompt = '''# Role：中文语言特色专家
 
@@ -56,6 +66,14 @@ class CopywritingAgent(BaseAgent):
     async def initialize(self):
         """初始化智能体"""
         return ""
+    
+    def variant_directives(self, count: int):
+        """每个变体融入不同的地方特色表达"""
+        flavors = random.sample(self.dialect_flavors, min(count, len(self.dialect_flavors)))
+        return [
+            f"本次优化请重点融入「{flavors[i % len(flavors)]}」的特色词汇和语气。"
+            for i in range(count)
+        ]
             
     async def process_message_stream(self, message: str) -> AsyncGenerator[str, None]:
         """流式处理接收到的消息并返回响应流"""
@@ -65,25 +83,11 @@ class CopywritingAgent(BaseAgent):
         ]
         
         try:
-            stream_response = dashscope.Generation.call(
-                model='qwen-turbo',
-                messages=messages,
-                result_format='message',
-                stream=True  # 启用流式输出
-            )
-            
-            # 跟踪之前接收到的内容，以便只返回新增部分
-            previous_content = ""
-            
-            # 处理流式响应
-            for response in stream_response:
-                if hasattr(response.output, 'choices') and response.output.choices:
-                    current_content = response.output.choices[0].message.content
-                    # 只返回新增的部分
-                    new_content = current_content[len(previous_content):]
-                    previous_content = current_content
-                    yield new_content
-                else:
-                    yield ""
+            # 通过统一的上游客户端流式调用，首包前的上游抖动会自动重试
+            async for new_content in self.stream_chat(messages):
+                yield new_content
+        except UpstreamError:
+            # 上游调用失败交给生成任务作为错误结束，不作为回复内容写入历史
+            raise
         except Exception as e:
             yield f"优化过程中出现错误: {str(e)}" 
\ No newline at end of file
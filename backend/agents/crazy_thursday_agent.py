@@ -2,6 +2,8 @@ import json
 import dashscope
 from dashscope.api_entities.dashscope_response import Role
 from backend.app.agent_manager import BaseAgent
+from backend.app.llm_client import UpstreamError
+from backend.app.model_router import RoutingRule
 from typing import AsyncGenerator
 
 class CrazyThursdayAgent(BaseAgent):
@@ -13,6 +15,13 @@ class CrazyThursdayAgent(BaseAgent):
         )
         dashscope.api_key = "sk-"
         
+        # 段子都很短，始终使用qwen-turbo
+        self.routing_rules = [
+            RoutingRule("qwen-turbo"),
+        ]
+        # 按照提示词中的参数设置
+        self.chat_params = {"temperature": 0.8}
+        
         # 设置系统提示
         self.system_prompt = '''## Role: 疯狂星期四
 
@@ -83,26 +92,11 @@ temperature=0.8
         ]
         
         try:
-            stream_response = dashscope.Generation.call(
-                model='qwen-turbo',
-                messages=messages,
-                result_format='message',
-                stream=True,  # 启用流式输出
-                temperature=0.8  # 按照提示词中的参数设置
-            )
-            
-            # 跟踪之前接收到的内容，以便只返回新增部分
-            previous_content = ""
-            
-            # 处理流式响应
-            for response in stream_response:
-                if hasattr(response.output, 'choices') and response.output.choices:
-                    current_content = response.output.choices[0].message.content
-                    # 只返回新增的部分
-                    new_content = current_content[len(previous_content):]
-                    previous_content = current_content
-                    yield new_content
-                else:
-                    yield ""
+            # 通过统一的上游客户端流式调用，首包前的上游抖动会自动重试
+            async for new_content in self.stream_chat(messages, **self.chat_params):
+                yield new_content
+        except UpstreamError:
+            # 上游调用失败交给生成任务作为错误结束，不作为回复内容写入历史
+            raise
         except Exception as e:
             yield f"生成疯狂星期四段子时出现错误: {str(e)}" 
\ No newline at end of file
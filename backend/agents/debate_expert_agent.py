@@ -2,6 +2,7 @@ import json
 import dashscope
 from dashscope.api_entities.dashscope_response import Role
 from backend.app.agent_manager import BaseAgent
+from backend.app.llm_client import UpstreamError
 from typing import AsyncGenerator
 
 class DebateExpertAgent(BaseAgent):
@@ -12,6 +13,8 @@ class DebateExpertAgent(BaseAgent):
             description="专注于辩论和戳痛对方痛处的吵架专家"
         )
         dashscope.api_key = "sk-"
+        # 回复言辞犀利，推送前过滤违禁词
+        self.stream_middleware = ["content_filter"]
         
         # 设置系统提示
         self.system_prompt = '''# Role: 吵架小能手
@@ -63,25 +66,11 @@ class DebateExpertAgent(BaseAgent):
         ]
         
         try:
-            stream_response = dashscope.Generation.call(
-                model='qwen-turbo',
-                messages=messages,
-                result_format='message',
-                stream=True  # 启用流式输出
-            )
-            
-            # 跟踪之前接收到的内容，以便只返回新增部分
-            previous_content = ""
-            
-            # 处理流式响应
-            for response in stream_response:
-                if hasattr(response.output, 'choices') and response.output.choices:
-                    current_content = response.output.choices[0].message.content
-                    # 只返回新增的部分
-                    new_content = current_content[len(previous_content):]
-                    previous_content = current_content
-                    yield new_content
-                else:
-                    yield ""
+            # 通过统一的上游客户端流式调用，首包前的上游抖动会自动重试
+            async for new_content in self.stream_chat(messages):
+                yield new_content
+        except UpstreamError:
+            # 上游调用失败交给生成任务作为错误结束，不作为回复内容写入历史
+            raise
         except Exception as e:
             yield f"吵架回复中出现错误: {str(e)}" 
\ No newline at end of file
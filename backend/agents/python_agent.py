@@ -2,6 +2,7 @@ import json
 import dashscope
 from dashscope.api_entities.dashscope_response import Role
 from backend.app.agent_manager import BaseAgent
+from backend.app.llm_client import UpstreamError
 from typing import AsyncGenerator, List, Dict
 
 class PythonAgent(BaseAgent):
@@ -25,6 +26,11 @@ class PythonAgent(BaseAgent):
             print(f"DashScope API测试失败: {str(e)}")
             print("请检查API密钥是否有效，网络连接是否正常。")
         
+        # 编程问题经常换种说法重复出现，首轮提问走语义缓存
+        self.semantic_cache = True
+        # 消息携带verify时在沙箱中运行回复里的代码块，把运行结果一并返回
+        self.code_verification = True
+        
         # 设置系统提示
         self.system_prompt = '''## Role: Python代码编程高手
 - 特质：精通Python编程，注重代码质量，擅长问题解决和算法设计。
@@ -137,26 +143,12 @@ class PythonAgent(BaseAgent):
         ]
         
         try:
-            stream_response = dashscope.Generation.call(
-                model='qwen-turbo',
-                messages=messages,
-                result_format='message',
-                stream=True  # 启用流式输出
-            )
-            
-            # 跟踪之前接收到的内容，以便只返回新增部分
-            previous_content = ""
-            
-            # 处理流式响应
-            for response in stream_response:
-                if hasattr(response.output, 'choices') and response.output.choices:
-                    current_content = response.output.choices[0].message.content
-                    # 只返回新增的部分
-                    new_content = current_content[len(previous_content):]
-                    previous_content = current_content
-                    yield new_content
-                else:
-                    yield ""
+            # 通过统一的上游客户端流式调用，首包前的上游抖动会自动重试
+            async for new_content in self.stream_chat(messages):
+                yield new_content
+        except UpstreamError:
+            # 上游调用失败交给生成任务作为错误结束，不作为回复内容写入历史
+            raise
         except Exception as e:
             yield f"处理Python编程问题时出现错误: {str(e)}"
             
@@ -165,7 +157,7 @@ class PythonAgent(BaseAgent):
         try:
             # 直接使用完整的消息列表，包括系统提示和历史对话
             print(f"Python智能体开始处理带历史的消息，消息数量: {len(messages)}")
-            print(f"调用dashscope API，模型: qwen-turbo, 历史长度: {len(messages)}")
+            print(f"调用dashscope API，模型: {self.model}, 历史长度: {len(messages)}")
             
             # 调试：打印完整消息
             for i, msg in enumerate(messages):
@@ -173,40 +165,22 @@ class PythonAgent(BaseAgent):
                 content = msg.get('content', '')
                 print(f"消息[{i}] {role}: {content[:50]}{'...' if len(content)>50 else ''}")
             
-            stream_response = dashscope.Generation.call(
-                model='qwen-turbo',
-                messages=messages,
-                result_format='message',
-                stream=True  # 启用流式输出
-            )
-            
-            # 跟踪之前接收到的内容，以便只返回新增部分
-            previous_content = ""
             has_yielded = False
             
-            # 处理流式响应
-            for response in stream_response:
-                print(f"收到dashscope响应: {response}")
-                if hasattr(response.output, 'choices') and response.output.choices:
-                    current_content = response.output.choices[0].message.content
-                    # 只返回新增的部分
-                    new_content = current_content[len(previous_content):]
-                    previous_content = current_content
-                    
-                    print(f"生成新内容: {new_content[:30]}{'...' if len(new_content)>30 else ''}")
-                    has_yielded = True
-                    yield new_content
-                else:
-                    print("响应格式异常，没有content字段")
-                    if not has_yielded:
-                        yield "抱歉，处理您的请求时出现了问题。"
-                        has_yielded = True
+            # 通过统一的上游客户端流式调用，首包前的上游抖动会自动重试
+            async for new_content in self.stream_chat(messages):
+                print(f"生成新内容: {new_content[:30]}{'...' if len(new_content)>30 else ''}")
+                has_yielded = True
+                yield new_content
             
             # 如果没有生成任何内容，返回一个错误消息
             if not has_yielded:
                 print("未收到任何有效响应")
                 yield "抱歉，智能体未能生成回复。请重试或联系管理员。"
             
+        except UpstreamError:
+            # 上游调用失败交给生成任务作为错误结束，不作为回复内容写入历史
+            raise
         except Exception as e:
             print(f"Python智能体处理消息时出现错误: {str(e)}")
             yield f"处理Python编程问题时出现错误: {str(e)}" 
\ No newline at end of file
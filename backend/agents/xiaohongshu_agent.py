@@ -2,6 +2,7 @@ import json
 import dashscope
 from dashscope.api_entities.dashscope_response import Role
 from backend.app.agent_manager import BaseAgent
+from backend.app.llm_client import UpstreamError
 import random
 from typing import AsyncGenerator
 
@@ -76,6 +77,8 @@ class XiaohongshuAgent(BaseAgent):
             "指南", "拯救", "闺蜜推荐", "一百分", "亲测", "良心推荐",
             "独家", "尝鲜", "小窍门", "人人必备"
         ]
+        # 多版本生成时用爆炸词作为评分关键词
+        self.variant_keywords = self.buzzwords
         
         # 设置系统提示
         self.system_prompt = '''你是一位专业的小红书文案创作专家，擅长创作吸引人的爆款内容。
@@ -117,6 +120,22 @@ class XiaohongshuAgent(BaseAgent):
     async def initialize(self):
         """初始化智能体"""
         return ""
+    
+    def variant_directives(self, count: int):
+        """为每个变体预先选定不同的写作风格、语气、开篇方法与文本结构"""
+        styles = random.sample(self.writing_styles, min(count, len(self.writing_styles)))
+        tones = random.sample(self.tone_styles, min(count, len(self.tone_styles)))
+        openings = random.sample(self.opening_methods, min(count, len(self.opening_methods)))
+        directives = []
+        for i in range(count):
+            directives.append(
+                "本次创作请直接采用以下选择，不要再另行随机："
+                f"写作风格「{styles[i % len(styles)]}」，表达语气「{tones[i % len(tones)]}」，"
+                f"开篇方法「{openings[i % len(openings)]}」，文本结构「{random.choice(self.text_structures)}」，"
+                f"互动引导「{random.choice(self.interaction_methods)}」，小技巧「{random.choice(self.writing_tips)}」，"
+                f"爆炸词「{'、'.join(random.sample(self.buzzwords, 3))}」。"
+            )
+        return directives
             
     async def process_message_stream(self, message: str) -> AsyncGenerator[str, None]:
         """流式处理接收到的消息并返回响应流"""
@@ -126,25 +145,11 @@ class XiaohongshuAgent(BaseAgent):
         ]
         
         try:
-            stream_response = dashscope.Generation.call(
-                model='qwen-turbo',
-                messages=messages,
-                result_format='message',
-                stream=True  # 启用流式输出
-            )
-            
-            # 跟踪之前接收到的内容，以便只返回新增部分
-            previous_content = ""
-            
-            # 处理流式响应
-            for response in stream_response:
-                if hasattr(response.output, 'choices') and response.output.choices:
-                    current_content = response.output.choices[0].message.content
-                    # 只返回新增的部分
-                    new_content = current_content[len(previous_content):]
-                    previous_content = current_content
-                    yield new_content
-                else:
-                    yield ""
+            # 通过统一的上游客户端流式调用，首包前的上游抖动会自动重试
+            async for new_content in self.stream_chat(messages):
+                yield new_content
+        except UpstreamError:
+            # 上游调用失败交给生成任务作为错误结束，不作为回复内容写入历史
+            raise
         except Exception as e:
             yield f"处理消息时出现错误: {str(e)}" 
\ No newline at end of file
@@ -2,6 +2,8 @@ import json
 import dashscope
 from dashscope.api_entities.dashscope_response import Role
 from backend.app.agent_manager import BaseAgent
+from backend.app.llm_client import UpstreamError
+import random
 from typing import AsyncGenerator
 
 class XiaohongshuDailyAgent(BaseAgent):
@@ -13,6 +15,14 @@ class XiaohongshuDailyAgent(BaseAgent):
         )
         dashscope.api_key = "sk-"
         
+        # 多版本生成时每个变体采用的分享角度
+        self.share_angles = [
+            "深夜碎碎念", "踩坑后翻身", "前后对比", "沉浸式日常", "闺蜜吐槽",
+            "反向种草", "意外发现", "朋友追问", "清单盘点", "真实翻车又被救回"
+        ]
+        # 多版本生成时本地评分使用的关键词
+        self.variant_keywords = ["家人们", "谁懂啊", "救命", "绝了", "宝藏", "亲测", "真的"]
+        
         # 设置系统提示
         self.system_prompt = '''
 # 角色
@@ -88,6 +98,14 @@ class XiaohongshuDailyAgent(BaseAgent):
     async def initialize(self):
         """初始化智能体"""
         return ""
+    
+    def variant_directives(self, count: int):
+        """每个变体使用不同的分享角度，避免多个版本的标题和开头雷同"""
+        angles = random.sample(self.share_angles, min(count, len(self.share_angles)))
+        return [
+            f"本次请以「{angles[i % len(angles)]}」的角度来分享，标题、开头和故事场景都要与其他常见写法明显不同。"
+            for i in range(count)
+        ]
             
     async def process_message_stream(self, message: str) -> AsyncGenerator[str, None]:
         """流式处理接收到的消息并返回响应流"""
@@ -97,26 +115,12 @@ class XiaohongshuDailyAgent(BaseAgent):
         ]
         
         try:
-            stream_response = dashscope.Generation.call(
-                model='qwen-turbo',
-                messages=messages,
-                result_format='message',
-                stream=True  # 启用流式输出
-            )
-            
-            # 跟踪之前接收到的内容，以便只返回新增部分
-            previous_content = ""
-            
-            # 处理流式响应
-            for response in stream_response:
-                if hasattr(response.output, 'choices') and response.output.choices:
-                    current_content = response.output.choices[0].message.content
-                    # 只返回新增的部分
-                    new_content = current_content[len(previous_content):]
-                    previous_content = current_content
-                    yield new_content
-                else:
-                    yield ""
+            # 通过统一的上游客户端流式调用，首包前的上游抖动会自动重试
+            async for new_content in self.stream_chat(messages):
+                yield new_content
+        except UpstreamError:
+            # 上游调用失败交给生成任务作为错误结束，不作为回复内容写入历史
+            raise
         except Exception as e:
             yield f"处理消息时出现错误: {str(e)}"
     
@@ -128,34 +132,41 @@ class XiaohongshuDailyAgent(BaseAgent):
         ]
         
         try:
-            response = dashscope.Generation.call(
-                model='qwen-turbo',
-                messages=messages,
-                result_format='message'
-            )
+            # 非流式调用同样经过统一的上游客户端，共享重试逻辑
+            full_response = ""
+            async for chunk in self.stream_chat(messages):
+                full_response += chunk
             
-            if hasattr(response.output, 'choices') and response.output.choices:
-                return response.output.choices[0].message.content
+            if full_response:
+                return full_response
             else:
                 return "抱歉，我无法处理您的请求。"
+        except UpstreamError:
+            # 上游调用失败交给生成任务作为错误结束，不作为回复内容写入历史
+            raise
         except Exception as e:
             return f"处理消息时出现错误: {str(e)}"
     
     async def process_message_with_history(self, messages: list) -> str:
         """处理带历史记录的消息并返回响应"""
-        # 在消息列表开头添加系统提示
-        full_messages = [{"role": "system", "content": self.system_prompt}] + messages
+        # 消息列表开头没有系统提示时添加（服务器传入的消息已包含系统提示）
+        if messages and messages[0]["role"] == "system":
+            full_messages = messages
+        else:
+            full_messages = [{"role": "system", "content": self.system_prompt}] + messages
         
         try:
-            response = dashscope.Generation.call(
-                model='qwen-turbo',
-                messages=full_messages,
-                result_format='message'
-            )
+            # 非流式调用同样经过统一的上游客户端，共享重试逻辑
+            full_response = ""
+            async for chunk in self.stream_chat(full_messages):
+                full_response += chunk
             
-            if hasattr(response.output, 'choices') and response.output.choices:
-                return response.output.choices[0].message.content
+            if full_response:
+                return full_response
             else:
                 return "抱歉，我无法处理您的请求。"
+        except UpstreamError:
+            # 上游调用失败交给生成任务作为错误结束，不作为回复内容写入历史
+            raise
         except Exception as e:
             return f"处理消息时出现错误: {str(e)}"
\ No newline at end of file
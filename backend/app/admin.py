@@ -0,0 +1,214 @@
+import hmac
+import os
+import time
+from typing import Optional
+
+from fastapi import APIRouter, Depends, Header, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+
+from backend.app.agent_manager import agent_manager
+from backend.app.connections import connection_manager
+from backend.app.llm_client import llm_client
+from backend.app.model_router import model_router
+from backend.app.profiler import PROFILE_MAX_SECONDS, cpu_mode_supported, loop_monitor, run_profile
+from backend.app.scheduler import scheduler
+from backend.app.semantic_cache import semantic_cache
+from backend.app.session_store import session_store
+from backend.app.session_transfer import ImportFormatError, SessionImporter, export_sessions
+from backend.app.tracing import tracer
+
+# 管理接口令牌；未配置时只允许本机访问
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+LOCAL_HOSTS = {"127.0.0.1", "::1", "localhost"}
+
+
+def require_admin(request: Request, x_admin_token: Optional[str] = Header(None)):
+    """校验管理员权限"""
+    if ADMIN_TOKEN:
+        if not hmac.compare_digest(x_admin_token or "", ADMIN_TOKEN):
+            raise HTTPException(status_code=403, detail="需要管理员权限")
+    elif request.client is None or request.client.host not in LOCAL_HOSTS:
+        raise HTTPException(status_code=403, detail="未配置ADMIN_TOKEN时仅允许本机访问管理接口")
+
+
+router = APIRouter(prefix="/admin", dependencies=[Depends(require_admin)])
+
+
+@router.get("/breakers")
+async def get_breakers():
+    """
+    获取各模型熔断器状态及最近的状态切换记录
+    """
+    return {"breakers": llm_client.breakers.snapshot()}
+
+
+@router.post("/breakers/{model}/reset")
+async def reset_breaker(model: str):
+    """
+    手动将指定模型的熔断器恢复为关闭状态
+    """
+    if model not in llm_client.breakers.breakers:
+        raise HTTPException(status_code=404, detail=f"未找到模型 {model} 的熔断器")
+    llm_client.breakers.get(model).reset()
+    return {"message": f"模型 {model} 的熔断器已重置"}
+
+
+@router.get("/routing")
+async def get_routing():
+    """
+    获取各智能体当前生效的模型路由规则
+    """
+    return {
+        "context_windows": model_router.context_windows,
+        "agents": {
+            agent.id: [rule.to_dict() for rule in model_router.rules_for(agent)]
+            for agent in agent_manager.get_all_agents()
+        },
+    }
+
+
+@router.get("/scheduler")
+async def get_scheduler():
+    """
+    获取上游调用调度器的并发占用与排队中的请求
+    """
+    return scheduler.snapshot()
+
+
+@router.get("/traces")
+async def get_traces(limit: int = 20, trace_id: Optional[str] = None):
+    """
+    获取进程内保存的最近trace（OTLP/JSON格式），可按trace_id查询单个trace
+    """
+    if trace_id:
+        trace = tracer.find(trace_id)
+        if trace is None:
+            raise HTTPException(status_code=404, detail=f"未找到trace {trace_id}")
+        return trace.to_otlp()
+    traces = list(tracer.recent)[-max(1, min(limit, tracer.recent.maxlen)):]
+    return {
+        "sample_rate": tracer.sample_rate,
+        "resourceSpans": [resource for trace in reversed(traces) for resource in trace.to_otlp()["resourceSpans"]],
+    }
+
+
+@router.get("/profile")
+async def profile(seconds: float = 10.0, mode: str = "wall", interval_ms: float = 10.0,
+                  block_ms: float = 0.0, format: str = "json"):
+    """
+    对整个进程进行采样分析：返回折叠栈（可直接交给flamegraph.pl或speedscope）以及采样期间的事件循环延迟与阻塞记录。
+    mode为wall时统计所有线程的采样，为cpu时只统计消耗CPU的线程；format=collapsed时直接返回折叠栈文本
+    """
+    if mode not in ("wall", "cpu"):
+        raise HTTPException(status_code=400, detail="mode只能为wall或cpu")
+    if mode == "cpu" and not cpu_mode_supported():
+        raise HTTPException(status_code=400, detail="当前平台不支持按线程统计CPU时间，请使用wall模式")
+    if not 0 < seconds <= PROFILE_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"seconds需在0到{PROFILE_MAX_SECONDS:g}之间")
+    if not 1 <= interval_ms <= 1000:
+        raise HTTPException(status_code=400, detail="interval_ms需在1到1000之间")
+
+    started_at = time.time()
+    # 请求的阻塞阈值低于监控默认阈值时，采样期间临时降低阈值
+    threshold = loop_monitor.threshold
+    if 0 < block_ms < threshold * 1000:
+        loop_monitor.threshold = block_ms / 1000
+    try:
+        profiler = await run_profile(seconds, mode, interval_ms)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    finally:
+        loop_monitor.threshold = threshold
+
+    if format == "collapsed":
+        return PlainTextResponse(profiler.collapsed())
+    return {
+        "mode": mode,
+        "seconds": seconds,
+        "interval_ms": interval_ms,
+        "samples": profiler.samples,
+        "collapsed": profiler.collapsed(),
+        "event_loop": loop_monitor.report(since=started_at, min_block_ms=block_ms),
+    }
+
+
+@router.get("/event-loop")
+async def get_event_loop(block_ms: float = 0.0):
+    """
+    获取事件循环延迟统计，以及最近阻塞循环超过阈值的调用栈
+    """
+    return loop_monitor.report(min_block_ms=block_ms)
+
+
+def _process_rss() -> Optional[int]:
+    """当前进程的常驻内存（字节），不支持的平台返回None"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+@router.get("/memory")
+async def get_memory(top: int = 20):
+    """
+    获取会话历史的内存占用：总量、按智能体汇总以及占用最多的会话
+    """
+    report = session_store.memory_report(top=max(0, top))
+    report["process_rss_bytes"] = _process_rss()
+    return report
+
+
+@router.get("/connections")
+async def get_connections(top: int = 20):
+    """
+    获取WebSocket连接数、连接最多的客户端及其各连接的空闲时间；
+    连接本身的内存开销可用 backend/benchmarks/ws_idle_load.py 按进程常驻内存的增量测量
+    """
+    report = connection_manager.report(top=max(0, top))
+    report["process_rss_bytes"] = _process_rss()
+    return report
+
+
+@router.get("/semantic-cache")
+async def get_semantic_cache():
+    """
+    获取语义缓存的配置与各智能体的条目数、命中次数
+    """
+    return semantic_cache.stats()
+
+
+@router.delete("/semantic-cache")
+async def clear_semantic_cache(agent_id: Optional[str] = None):
+    """
+    清空语义缓存，可只清空指定智能体的条目
+    """
+    return {"removed": semantic_cache.clear(agent_id)}
+
+
+@router.get("/export")
+async def export_conversations(agent_id: Optional[str] = None):
+    """
+    以gzip压缩的JSONL流式导出所有会话（含已换出到磁盘的会话），每行一条消息，可只导出指定智能体的会话
+    """
+    filename = f"sessions-{time.strftime('%Y%m%d-%H%M%S')}.jsonl.gz"
+    return StreamingResponse(
+        export_sessions(session_store, agent_id),
+        media_type="application/gzip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@router.post("/import")
+async def import_conversations(request: Request):
+    """
+    从请求体分批导入JSONL格式的会话消息（gzip压缩或未压缩，格式与导出相同），返回导入、跳过与出错的行数。
+    已存在的消息按seq跳过，中断后可重新提交同一文件
+    """
+    importer = SessionImporter(session_store)
+    try:
+        await importer.feed(request.stream())
+    except ImportFormatError as e:
+        # 出错之前的批次已写入，重新提交时按seq跳过
+        raise HTTPException(status_code=400, detail={"error": str(e), **importer.report()})
+    return importer.report()
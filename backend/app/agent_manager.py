@@ -1,6 +1,11 @@
+import time
 from typing import Dict, List, Optional, AsyncGenerator
 from abc import ABC, abstractmethod
 import dashscope
+from backend.app.llm_client import llm_client, DEFAULT_MODEL
+from backend.app.model_router import model_router
+from backend.app.request_context import get_request_context
+from backend.app.tracing import NOOP_TRACE
 
 class BaseAgent(ABC):
     def __init__(self, agent_id: str, name: str, description: str):
@@ -10,6 +15,13 @@ class BaseAgent(ABC):
         self.description = description
         self.category = "未分类"  # 添加分类字段，默认为"未分类"
         self.system_prompt = ""  # 添加系统提示字段
+        self.model = DEFAULT_MODEL  # 调用的上游模型
+        self.routing_rules = None  # 模型路由规则，为None时使用默认规则
+        self.variant_keywords: List[str] = []  # 多版本生成时本地评分使用的关键词
+        self.stream_middleware: List[str] = []  # 回复的流式处理阶段名称，见stream_middleware.STAGES
+        self.semantic_cache = False  # 是否对首轮提问启用语义缓存，见semantic_cache
+        self.code_verification = False  # 是否支持在沙箱中运行回复里的代码（消息携带verify时），见sandbox
+        self.chat_params: Dict = {}  # 调用上游模型时附加的参数，如temperature
         
     async def process_message(self, message: str) -> str:
         """处理接收到的消息并返回响应，默认实现通过收集process_message_stream的结果"""
@@ -31,18 +43,60 @@ class BaseAgent(ABC):
         return full_response
     
     async def process_message_stream_with_history(self, messages: List[Dict[str, str]]) -> AsyncGenerator[str, None]:
-        """流式处理带历史记录的消息，默认实现为直接处理最新的用户消息"""
-        last_user_message = None
-        for msg in reversed(messages):
-            if msg["role"] == "user":
-                last_user_message = msg["content"]
-                break
-        
-        if last_user_message:
-            async for chunk in self.process_message_stream(last_user_message):
-                yield chunk
-        else:
+        """流式处理带历史记录的消息：把系统提示与历史对话（检索模式下为组装后的消息）一起发送给模型，
+        模型路由按完整消息的长度选择模型"""
+        if not any(msg["role"] == "user" for msg in messages):
             yield "未找到用户消息"
+            return
+        if messages[0]["role"] != "system":
+            messages = [{"role": "system", "content": self.system_prompt}] + list(messages)
+        async for chunk in self.stream_chat(messages, **self.chat_params):
+            yield chunk
+    
+    def variant_directives(self, count: int) -> Optional[List[str]]:
+        """多版本生成时为每个变体附加的风格指令，返回None表示该智能体不支持多版本生成"""
+        return None
+
+    async def process_variant_stream(self, messages: List[Dict[str, str]], directive: str,
+                                     seed: Optional[int] = None) -> AsyncGenerator[str, None]:
+        """按指定风格指令生成一个变体：指令追加到系统提示之后，不同变体使用不同的随机种子"""
+        variant_messages = list(messages)
+        if variant_messages and variant_messages[0]["role"] == "system":
+            variant_messages[0] = {"role": "system", "content": f"{variant_messages[0]['content']}\n\n{directive}"}
+        else:
+            variant_messages.insert(0, {"role": "system", "content": f"{self.system_prompt}\n\n{directive}"})
+        params = {"seed": seed} if seed is not None else {}
+        async for chunk in self.stream_chat(variant_messages, **params):
+            yield chunk
+
+    async def stream_chat(self, messages: List[Dict[str, str]], **params) -> AsyncGenerator[str, None]:
+        """调用上游模型并流式返回新增片段，包含首包前重试与对冲请求"""
+        context = get_request_context()
+        trace = context.trace if context else NOOP_TRACE
+        with trace.span("model.route", agent_id=self.id) as span:
+            decision = model_router.route(
+                self,
+                messages,
+                override=context.model_override if context else None,
+                max_tokens=context.max_tokens if context else None,
+                deadline=context.remaining() if context else None,
+            )
+            span.set_attribute("model", decision.model)
+            span.set_attribute("prompt_tokens", decision.prompt_tokens)
+            if decision.max_tokens is not None:
+                span.set_attribute("max_tokens", decision.max_tokens)
+        if context:
+            context.route_reason = decision.reason
+            context.prompt_tokens = decision.prompt_tokens
+            if decision.queue_budget is not None:
+                context.start_by = time.monotonic() + decision.queue_budget
+            # 按期限截短的输出上限优先于客户端期望的长度
+            max_tokens = decision.max_tokens or context.max_tokens
+            if max_tokens:
+                params.setdefault("max_tokens", max_tokens)
+        print(f"模型路由: agent={self.id}, model={decision.model}, prompt_tokens={decision.prompt_tokens}, 原因: {decision.reason}")
+        async for chunk in llm_client.stream_chat(messages, model=decision.model, **params):
+            yield chunk
     
     @abstractmethod
     async def initialize(self) -> str:
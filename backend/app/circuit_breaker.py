@@ -0,0 +1,176 @@
+import os
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from backend.app.metrics import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# 指标中使用的状态数值
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# 熔断配置
+BREAKER_WINDOW_SIZE = int(os.getenv("LLM_BREAKER_WINDOW_SIZE", "20"))
+BREAKER_MIN_CALLS = int(os.getenv("LLM_BREAKER_MIN_CALLS", "10"))
+BREAKER_FAILURE_RATE = float(os.getenv("LLM_BREAKER_FAILURE_RATE", "0.5"))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv("LLM_BREAKER_SLOW_CALL_SECONDS", "8.0"))
+BREAKER_SLOW_CALL_RATE = float(os.getenv("LLM_BREAKER_SLOW_CALL_RATE", "0.8"))
+BREAKER_OPEN_SECONDS = float(os.getenv("LLM_BREAKER_OPEN_SECONDS", "30"))
+BREAKER_HALF_OPEN_PROBES = int(os.getenv("LLM_BREAKER_HALF_OPEN_PROBES", "2"))
+
+# 降级模型映射，格式："主模型:备用模型,主模型:备用模型"。默认不降级：熔断期间的请求直接返回错误。
+# 备用模型的单价可能更高（如qwen-turbo:qwen-plus，后者每token价格数倍于前者），熔断期间的流量全部按备用模型计费
+FALLBACK_MODELS = os.getenv("LLM_FALLBACK_MODELS", "")
+
+breaker_state_gauge = metrics.gauge("llm_breaker_state", "熔断器状态（0=关闭，1=半开，2=打开）")
+breaker_transitions = metrics.counter("llm_breaker_transitions_total", "熔断器状态切换次数")
+breaker_rejections = metrics.counter("llm_breaker_rejected_total", "因熔断被拒绝或改道的请求数")
+
+
+def parse_fallback_models(spec: str) -> Dict[str, str]:
+    """解析降级模型映射配置"""
+    fallbacks = {}
+    for item in spec.split(","):
+        if ":" in item:
+            primary, fallback = item.split(":", 1)
+            if primary.strip() and fallback.strip():
+                fallbacks[primary.strip()] = fallback.strip()
+    return fallbacks
+
+
+class CircuitBreaker:
+    """单个模型的熔断器，基于最近N次调用的错误率与慢调用率切换状态"""
+    def __init__(self, model: str):
+        self.model = model
+        self.state = CLOSED
+        # 每次调用记录 (是否失败, 是否慢调用)
+        self.window: deque = deque(maxlen=BREAKER_WINDOW_SIZE)
+        self.opened_at = 0.0
+        self.half_open_in_flight = 0
+        self.half_open_successes = 0
+        self.transitions: deque = deque(maxlen=50)
+        breaker_state_gauge.set(STATE_VALUES[CLOSED], {"model": model})
+
+    def _transition(self, new_state: str, reason: str):
+        old_state = self.state
+        if old_state == new_state:
+            return
+        self.state = new_state
+        if new_state == OPEN:
+            self.opened_at = time.monotonic()
+        if new_state in (OPEN, CLOSED):
+            self.window.clear()
+        self.half_open_in_flight = 0
+        self.half_open_successes = 0
+        self.transitions.append({"at": time.time(), "from": old_state, "to": new_state, "reason": reason})
+        breaker_state_gauge.set(STATE_VALUES[new_state], {"model": self.model})
+        breaker_transitions.inc(labels={"model": self.model, "from": old_state, "to": new_state})
+        print(f"熔断器状态切换: model={self.model}, {old_state} -> {new_state}, 原因: {reason}")
+
+    def allow_request(self) -> bool:
+        """判断当前是否允许向该模型发出请求"""
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < BREAKER_OPEN_SECONDS:
+                return False
+            self._transition(HALF_OPEN, "打开时间已到，进入半开探测")
+        if self.state == HALF_OPEN:
+            if self.half_open_in_flight >= BREAKER_HALF_OPEN_PROBES:
+                return False
+            self.half_open_in_flight += 1
+        return True
+
+    def record_success(self, latency: float):
+        slow = latency >= BREAKER_SLOW_CALL_SECONDS
+        if self.state == HALF_OPEN:
+            self.half_open_in_flight = max(0, self.half_open_in_flight - 1)
+            if slow:
+                self._transition(OPEN, f"半开探测响应过慢 ({latency:.2f}s)")
+                return
+            self.half_open_successes += 1
+            if self.half_open_successes >= BREAKER_HALF_OPEN_PROBES:
+                self._transition(CLOSED, "半开探测成功")
+            return
+        self.window.append((False, slow))
+        self._evaluate()
+
+    def record_failure(self):
+        if self.state == HALF_OPEN:
+            self._transition(OPEN, "半开探测失败")
+            return
+        self.window.append((True, False))
+        self._evaluate()
+
+    def release(self):
+        """调用未产生可判定的结果（如客户端错误、请求被取消）时归还半开探测名额"""
+        if self.state == HALF_OPEN:
+            self.half_open_in_flight = max(0, self.half_open_in_flight - 1)
+
+    def _evaluate(self):
+        if self.state != CLOSED or len(self.window) < BREAKER_MIN_CALLS:
+            return
+        total = len(self.window)
+        failure_rate = sum(1 for failed, _ in self.window if failed) / total
+        slow_rate = sum(1 for _, slow in self.window if slow) / total
+        if failure_rate >= BREAKER_FAILURE_RATE:
+            self._transition(OPEN, f"错误率 {failure_rate:.0%} 超过阈值")
+        elif slow_rate >= BREAKER_SLOW_CALL_RATE:
+            self._transition(OPEN, f"慢调用率 {slow_rate:.0%} 超过阈值")
+
+    def reset(self):
+        self._transition(CLOSED, "手动重置")
+
+    def snapshot(self) -> Dict:
+        total = len(self.window)
+        return {
+            "model": self.model,
+            "state": self.state,
+            "calls_in_window": total,
+            "failure_rate": sum(1 for failed, _ in self.window if failed) / total if total else 0.0,
+            "slow_call_rate": sum(1 for _, slow in self.window if slow) / total if total else 0.0,
+            "transitions": list(self.transitions),
+        }
+
+
+class BreakerRegistry:
+    """管理各模型的熔断器，并在主模型熔断时选择降级模型"""
+    def __init__(self, fallbacks: Optional[Dict[str, str]] = None):
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.fallbacks = fallbacks if fallbacks is not None else parse_fallback_models(FALLBACK_MODELS)
+
+    def get(self, model: str) -> CircuitBreaker:
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker(model)
+        return self.breakers[model]
+
+    def is_available(self, model: str) -> bool:
+        """只读判断模型是否健康，不占用半开探测名额"""
+        breaker = self.breakers.get(model)
+        if breaker is None or breaker.state == CLOSED:
+            return True
+        if breaker.state == OPEN:
+            return time.monotonic() - breaker.opened_at >= BREAKER_OPEN_SECONDS
+        return breaker.half_open_in_flight < BREAKER_HALF_OPEN_PROBES
+
+    def select(self, model: str) -> Optional[str]:
+        """沿降级链选择第一个允许请求的模型，全部熔断时返回None"""
+        candidate = model
+        visited = set()
+        while candidate and candidate not in visited:
+            visited.add(candidate)
+            if self.get(candidate).allow_request():
+                if candidate != model:
+                    breaker_rejections.inc(labels={"model": model, "action": "fallback"})
+                    print(f"模型 {model} 已熔断，改用降级模型 {candidate}")
+                return candidate
+            candidate = self.fallbacks.get(candidate)
+        breaker_rejections.inc(labels={"model": model, "action": "rejected"})
+        return None
+
+    def snapshot(self) -> List[Dict]:
+        return [
+            dict(breaker.snapshot(), fallback=self.fallbacks.get(model))
+            for model, breaker in self.breakers.items()
+        ]
@@ -0,0 +1,207 @@
+import asyncio
+import os
+import sys
+import time
+import uuid
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from fastapi import WebSocket
+
+from backend.app.metrics import metrics
+from backend.app.protocol import ProtocolV1
+
+# 连接超过该时间（秒）没有收到任何帧时发送心跳
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "25"))
+# 超过该时间（秒）没有收到任何帧（包括心跳回应）视为连接已失效
+WS_HEARTBEAT_TIMEOUT = float(os.getenv("WS_HEARTBEAT_TIMEOUT", "60"))
+# 没有请求进行中且超过该时间（秒）没有发送消息的连接被关闭，0为不限制
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "1800"))
+# 每个client_id最多同时保持的连接数，超出时关闭该客户端最早的连接
+WS_MAX_CONNECTIONS_PER_CLIENT = int(os.getenv("WS_MAX_CONNECTIONS_PER_CLIENT", "20"))
+# 单次心跳发送的超时（秒），慢连接不拖慢整轮检查
+WS_PING_SEND_TIMEOUT = 5.0
+# 每轮心跳并发发送的连接数
+HEARTBEAT_BATCH = 500
+
+# 关闭码：4000为空闲超时，4001为心跳超时，4002为同一客户端连接数超限
+CLOSE_IDLE = 4000
+CLOSE_HEARTBEAT = 4001
+CLOSE_REPLACED = 4002
+
+connections_gauge = metrics.gauge("ws_connections", "当前WebSocket连接数")
+connections_closed_counter = metrics.counter("ws_connections_closed_total", "服务器主动关闭的连接数")
+
+
+class Connection:
+    """一个WebSocket连接；同一client_id可以有多个连接（多个标签页、多台设备）"""
+    __slots__ = ("id", "client_id", "websocket", "protocol", "connected_at", "last_seen", "last_activity",
+                 "busy", "closing", "__weakref__")
+
+    def __init__(self, client_id: str, websocket: WebSocket, protocol: ProtocolV1):
+        self.id = uuid.uuid4().hex[:16]
+        self.client_id = client_id
+        self.websocket = websocket
+        self.protocol = protocol
+        now = time.monotonic()
+        self.connected_at = now
+        # 最近收到任意帧（含心跳回应）的时间，用于判断连接是否存活
+        self.last_seen = now
+        # 最近一次请求开始或结束的时间，用于空闲超时
+        self.last_activity = now
+        # 是否正在处理请求
+        self.busy = False
+        self.closing = False
+
+    def touch(self, activity: bool = True):
+        now = time.monotonic()
+        self.last_seen = now
+        if activity:
+            self.last_activity = now
+
+    async def close(self, code: int, reason: str):
+        if self.closing:
+            return
+        self.closing = True
+        connections_closed_counter.inc(labels={"code": str(code)})
+        try:
+            await asyncio.wait_for(self.websocket.close(code=code, reason=reason), WS_PING_SEND_TIMEOUT)
+        except Exception as e:
+            print(f"关闭连接 {self.id} 失败: {str(e)}")
+
+
+class ConnectionManager:
+    """管理所有WebSocket连接：分配唯一连接ID、按客户端限制连接数，并在单个后台任务中统一做心跳与空闲检查"""
+    def __init__(self, heartbeat_interval: float = WS_HEARTBEAT_INTERVAL, heartbeat_timeout: float = WS_HEARTBEAT_TIMEOUT,
+                 idle_timeout: float = WS_IDLE_TIMEOUT, max_per_client: int = WS_MAX_CONNECTIONS_PER_CLIENT):
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.idle_timeout = idle_timeout
+        self.max_per_client = max_per_client
+        self.connections: Dict[str, Connection] = {}
+        # client_id -> 按建立顺序排列的连接ID
+        self.by_client: Dict[str, "OrderedDict[str, None]"] = {}
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    def get(self, connection_id: str) -> Optional[Connection]:
+        return self.connections.get(connection_id)
+
+    def for_client(self, client_id: str) -> List[Connection]:
+        return [self.connections[cid] for cid in self.by_client.get(client_id, ())]
+
+    async def register(self, client_id: str, websocket: WebSocket, protocol: ProtocolV1) -> Connection:
+        connection = Connection(client_id, websocket, protocol)
+        # 此后发往该连接的帧都经过有界发送队列
+        protocol.attach_queue()
+        self.connections[connection.id] = connection
+        ids = self.by_client.setdefault(client_id, OrderedDict())
+        ids[connection.id] = None
+        connections_gauge.set(len(self.connections))
+        self._ensure_heartbeat()
+        while self.max_per_client and len(ids) > self.max_per_client:
+            oldest = self.connections.get(next(iter(ids)))
+            self.unregister(oldest)
+            print(f"客户端 {client_id} 连接数超过上限，关闭最早的连接 {oldest.id}")
+            await oldest.close(CLOSE_REPLACED, "too many connections")
+        return connection
+
+    def unregister(self, connection: Connection):
+        if connection.protocol.queue is not None:
+            connection.protocol.queue.close()
+        if self.connections.pop(connection.id, None) is None:
+            return
+        ids = self.by_client.get(connection.client_id)
+        if ids is not None:
+            ids.pop(connection.id, None)
+            if not ids:
+                del self.by_client[connection.client_id]
+        connections_gauge.set(len(self.connections))
+
+    def _ensure_heartbeat(self):
+        if self._heartbeat is None or self._heartbeat.done():
+            self._heartbeat = asyncio.create_task(self._heartbeat_loop())
+
+    async def _heartbeat_loop(self):
+        # 检查间隔取心跳间隔的一半，心跳最多比预期晚半个间隔
+        while True:
+            await asyncio.sleep(max(1.0, self.heartbeat_interval / 2))
+            await self.check()
+
+    async def check(self):
+        """关闭心跳超时与空闲超时的连接，并向一段时间没有收到帧的连接发送心跳"""
+        now = time.monotonic()
+        to_ping = []
+        to_close = []
+        for connection in list(self.connections.values()):
+            if connection.busy:
+                # 处理请求期间接收循环不读取新帧，心跳回应要等请求结束后才能读到；断开由推送失败发现
+                continue
+            silent = now - connection.last_seen
+            if silent > self.heartbeat_timeout:
+                to_close.append((connection, CLOSE_HEARTBEAT, "heartbeat timeout"))
+            elif self.idle_timeout and now - connection.last_activity > self.idle_timeout:
+                to_close.append((connection, CLOSE_IDLE, "idle timeout"))
+            elif silent >= self.heartbeat_interval:
+                to_ping.append(connection)
+
+        for connection, code, reason in to_close:
+            self.unregister(connection)
+            print(f"关闭连接 {connection.id}（client_id={connection.client_id}）: {reason}")
+        await self._gather(connection.close(code, reason) for connection, code, reason in to_close)
+        await self._gather(self._ping(connection) for connection in to_ping)
+
+    @staticmethod
+    async def _gather(coroutines):
+        # 分批并发，避免一次创建数万个任务
+        batch = []
+        for coroutine in coroutines:
+            batch.append(coroutine)
+            if len(batch) >= HEARTBEAT_BATCH:
+                await asyncio.gather(*batch, return_exceptions=True)
+                batch = []
+        if batch:
+            await asyncio.gather(*batch, return_exceptions=True)
+
+    @staticmethod
+    async def _ping(connection: Connection):
+        try:
+            await asyncio.wait_for(connection.protocol.send_ping(), WS_PING_SEND_TIMEOUT)
+        except Exception:
+            # 发送失败的连接由接收循环或下一轮心跳超时清理
+            pass
+
+    def report(self, top: int = 20) -> Dict:
+        """连接数、每个客户端的连接数，以及连接记录本身的内存占用"""
+        now = time.monotonic()
+        record_bytes = sum(sys.getsizeof(connection) for connection in self.connections.values())
+        clients = sorted(self.by_client.items(), key=lambda item: len(item[1]), reverse=True)[:top]
+        return {
+            "connections": len(self.connections),
+            "clients": len(self.by_client),
+            "busy": sum(1 for connection in self.connections.values() if connection.busy),
+            "queued_frames": sum(len(connection.protocol.queue or ()) for connection in self.connections.values()),
+            "record_bytes": record_bytes,
+            "top_clients": [
+                {
+                    "client_id": client_id,
+                    "connections": [
+                        {
+                            "id": cid,
+                            "age_seconds": round(now - self.connections[cid].connected_at, 1),
+                            "idle_seconds": round(now - self.connections[cid].last_activity, 1),
+                            "busy": self.connections[cid].busy,
+                            "queued_frames": len(self.connections[cid].protocol.queue or ()),
+                        }
+                        for cid in ids
+                    ],
+                }
+                for client_id, ids in clients
+            ],
+        }
+
+
+# 创建全局连接管理器实例
+connection_manager = ConnectionManager()
@@ -0,0 +1,192 @@
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional
+
+from backend.app.metrics import metrics
+
+# 违禁词文件：每行一个词，#开头为注释；为空时不过滤
+CONTENT_FILTER_TERMS_FILE = os.getenv("CONTENT_FILTER_TERMS_FILE", "")
+# mask：用*替换命中的词；abort：命中即中止本次回复
+CONTENT_FILTER_MODE = os.getenv("CONTENT_FILTER_MODE", "mask")
+# 检查词表文件是否更新的最短间隔（秒）
+CONTENT_FILTER_RELOAD_INTERVAL = float(os.getenv("CONTENT_FILTER_RELOAD_INTERVAL", "10"))
+MASK_CHAR = "*"
+# abort模式中止的回复在对话历史中的占位内容，已推送的部分不写入历史，后续轮次不会再发给模型
+BLOCKED_REPLY = "[回复包含违禁内容，已中止]"
+
+# 大词表的自动机构建较慢，放到后台线程中进行，构建完成前继续使用旧词表
+_build_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="content-filter")
+
+filter_matches_counter = metrics.counter("content_filter_matches_total", "命中违禁词的次数")
+filter_terms_gauge = metrics.gauge("content_filter_terms", "当前生效的违禁词数量")
+filter_reloads_counter = metrics.counter("content_filter_reloads_total", "违禁词表重新加载次数")
+
+
+class ContentBlocked(Exception):
+    """abort模式下回复命中违禁词"""
+    def __init__(self, term_length: int):
+        super().__init__("回复包含违禁内容，已中止")
+        self.term_length = term_length
+
+
+class AhoCorasick:
+    """多模式匹配自动机。节点以整数编号，goto为各节点的转移表，
+    match_len为在该节点结束的最长词长度（已沿失败链合并），depth为节点对应前缀的长度"""
+    def __init__(self, terms: Iterable[str]):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.match_len: List[int] = [0]
+        self.depth: List[int] = [0]
+        count = 0
+        for term in terms:
+            term = term.strip().lower()
+            if term:
+                self._add(term)
+                count += 1
+        self.term_count = count
+        self._build_fail_links()
+
+    def _add(self, term: str):
+        node = 0
+        for ch in term:
+            nxt = self.goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][ch] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.match_len.append(0)
+                self.depth.append(self.depth[node] + 1)
+            node = nxt
+        self.match_len[node] = len(term)
+
+    def _build_fail_links(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self.goto[node].items():
+                queue.append(child)
+                fallback = self.fail[node]
+                while fallback and ch not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                target = self.goto[fallback].get(ch, 0)
+                self.fail[child] = target if target != child else 0
+                self.match_len[child] = max(self.match_len[child], self.match_len[self.fail[child]])
+
+    @property
+    def empty(self) -> bool:
+        return self.term_count == 0
+
+
+class StreamMatcher:
+    """跨片段保持自动机状态的匹配器。只保留可能与后续片段拼成违禁词的尾部字符（当前状态的深度），
+    其余部分立即输出，因此延迟至多为最长违禁词长度减一个字符"""
+    def __init__(self, automaton: AhoCorasick, mode: str = CONTENT_FILTER_MODE):
+        self.automaton = automaton
+        self.mode = mode
+        self.state = 0
+        self.buffer: List[str] = []
+        self.matches = 0
+
+    def feed(self, text: str) -> str:
+        automaton = self.automaton
+        if automaton.empty:
+            return text
+        goto, fail, match_len = automaton.goto, automaton.fail, automaton.match_len
+        lowered = text.lower()
+        if len(lowered) != len(text):
+            # 个别字符小写后长度变化，逐字转换以保持位置对应
+            lowered = [ch.lower()[:1] for ch in text]
+        state = self.state
+        buffer = self.buffer
+        for ch, key in zip(text, lowered):
+            while state and key not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(key, 0)
+            buffer.append(ch)
+            length = match_len[state]
+            if length:
+                self.matches += 1
+                filter_matches_counter.inc(labels={"mode": self.mode})
+                if self.mode == "abort":
+                    self.state = 0
+                    self.buffer = []
+                    raise ContentBlocked(length)
+                buffer[-length:] = MASK_CHAR * length
+        self.state = state
+        keep = automaton.depth[state]
+        emit = len(buffer) - keep
+        if emit <= 0:
+            return ""
+        out = "".join(buffer[:emit])
+        del buffer[:emit]
+        return out
+
+    def held(self) -> int:
+        return len(self.buffer)
+
+    def flush(self) -> str:
+        out = "".join(self.buffer)
+        self.buffer = []
+        self.state = 0
+        return out
+
+
+class TermList:
+    """从文件加载违禁词并构建自动机；文件修改后在后台线程中重建，构建完成后原子替换"""
+    def __init__(self, path: str = CONTENT_FILTER_TERMS_FILE, reload_interval: float = CONTENT_FILTER_RELOAD_INTERVAL):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.automaton = AhoCorasick(())
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self._building = False
+        self._lock = threading.Lock()
+        if path:
+            self._load()
+
+    @staticmethod
+    def read_terms(path: str) -> List[str]:
+        with open(path, "r", encoding="utf-8") as f:
+            return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+    def _load(self):
+        try:
+            mtime = os.path.getmtime(self.path)
+            automaton = AhoCorasick(self.read_terms(self.path))
+        except OSError as e:
+            print(f"加载违禁词表失败: {str(e)}")
+        else:
+            self.automaton = automaton
+            self._mtime = mtime
+            filter_terms_gauge.set(automaton.term_count)
+            filter_reloads_counter.inc()
+            print(f"已加载违禁词表: {self.path}，共 {automaton.term_count} 个词")
+        finally:
+            with self._lock:
+                self._building = False
+
+    def current(self) -> AhoCorasick:
+        """返回当前自动机；距上次检查超过间隔时检查文件是否更新，需要时在后台重建"""
+        if self.path:
+            now = time.monotonic()
+            if now - self._checked_at >= self.reload_interval:
+                self._checked_at = now
+                try:
+                    changed = os.path.getmtime(self.path) != self._mtime
+                except OSError:
+                    changed = False
+                with self._lock:
+                    start = changed and not self._building
+                    if start:
+                        self._building = True
+                if start:
+                    _build_executor.submit(self._load)
+        return self.automaton
+
+
+# 创建全局违禁词表实例
+term_list = TermList()
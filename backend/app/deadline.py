@@ -0,0 +1,66 @@
+import asyncio
+import os
+import time
+from typing import AsyncGenerator, Optional
+
+from backend.app.metrics import metrics
+from backend.app.request_context import RequestContext
+
+# 在客户端期限之前预留的时间（毫秒），用于发送结束帧与网络传输
+DEADLINE_MARGIN_MS = int(os.getenv("DEADLINE_MARGIN_MS", "150"))
+# 客户端可设置的最长期限（毫秒），超出按该值处理
+DEADLINE_MAX_MS = int(os.getenv("DEADLINE_MAX_MS", "600000"))
+# 到达期限时的结束原因
+FINISH_DEADLINE = "deadline"
+
+deadline_stopped_counter = metrics.counter("deadline_stopped_total", "到达期限被提前结束的回复数")
+
+
+def deadline_from_ms(value) -> Optional[float]:
+    """把客户端的deadline_ms（从服务器收到消息起算）换算为time.monotonic时刻，无效值返回None"""
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+        return None
+    return time.monotonic() + (min(value, DEADLINE_MAX_MS) - DEADLINE_MARGIN_MS) / 1000
+
+
+async def stop_at_deadline(chunks: AsyncGenerator[str, None], context: RequestContext) -> AsyncGenerator[str, None]:
+    """逐片段转发回复，到达期限时停止上游调用并正常结束，context.finish_reason记为"deadline"。
+    上游在单独的任务中读取，经容量为1的队列转交；等待下一个片段时到期则取消该任务，
+    片段交给调用方处理期间到期则在处理完后停止。调用方任务本身不会被取消"""
+    remaining = context.remaining()
+    if remaining is None:
+        async for chunk in chunks:
+            yield chunk
+        return
+    queue: asyncio.Queue = asyncio.Queue(maxsize=1)
+
+    async def pump():
+        # 队列中的元素为(片段, 异常)，(None, None)表示上游正常结束
+        try:
+            async for chunk in chunks:
+                await queue.put((chunk, None))
+            await queue.put((None, None))
+        except Exception as e:
+            await queue.put((None, e))
+        finally:
+            await chunks.aclose()
+
+    producer = asyncio.create_task(pump())
+    try:
+        while True:
+            try:
+                chunk, error = await asyncio.wait_for(queue.get(), max(0.0, context.remaining()))
+            except asyncio.TimeoutError:
+                break
+            if error is not None:
+                raise error
+            if chunk is None:
+                return
+            yield chunk
+        context.finish_reason = FINISH_DEADLINE
+        deadline_stopped_counter.inc()
+        print(f"回复到达期限，提前结束: agent_id={context.agent_id}, model={context.model}")
+    finally:
+        producer.cancel()
+        # 等待上游关闭；不直接await任务，以免吞掉调用方任务自身收到的取消
+        await asyncio.wait({producer})
@@ -0,0 +1,111 @@
+import asyncio
+import os
+import random
+import signal
+import time
+from typing import Optional
+
+from backend.app.connections import Connection, connection_manager
+from backend.app.generations import generation_registry
+from backend.app.metrics import metrics
+from backend.app.session_store import session_store
+
+# 收到SIGTERM后等待进行中的生成完成的最长时间（秒），超时后取消剩余生成并提交已生成的部分
+DRAIN_TIMEOUT_SECONDS = float(os.getenv("DRAIN_TIMEOUT_SECONDS", "30"))
+# 重连提示中的随机延迟上限（毫秒），错开大量客户端同时重连
+DRAIN_RECONNECT_JITTER_MS = int(os.getenv("DRAIN_RECONNECT_JITTER_MS", "3000"))
+# 检查进行中请求的间隔（秒）
+DRAIN_POLL_INTERVAL = 0.2
+# 停机时关闭连接的关闭码（Service Restart），客户端应重连
+CLOSE_SERVICE_RESTART = 1012
+
+draining_gauge = metrics.gauge("server_draining", "服务器是否处于停机排空状态")
+
+
+class DrainController:
+    """停机排空：收到SIGTERM后不再开始新的生成，等待进行中的生成在期限内完成，把会话写入磁盘，
+    向客户端发送重连提示并关闭连接，最后交给uvicorn正常退出。
+    滚动发布与开发模式的自动重载都通过SIGTERM停止旧进程，因此不会丢失进行中的回复"""
+    def __init__(self, timeout: float = DRAIN_TIMEOUT_SECONDS):
+        self.timeout = timeout
+        self.draining = False
+        self.deadline: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def install_signal_handler(self):
+        """接管SIGTERM。uvicorn收到SIGTERM会立即以1012关闭所有WebSocket，因此先由这里排空，
+        完成后再发送SIGINT交给uvicorn退出。须在uvicorn安装信号处理之后（startup事件中）调用"""
+        loop = asyncio.get_running_loop()
+        try:
+            loop.add_signal_handler(signal.SIGTERM, self.begin)
+        except (NotImplementedError, RuntimeError, ValueError):
+            # Windows或非主线程不支持，保持uvicorn默认行为
+            print("当前平台不支持接管SIGTERM，停机时不排空")
+
+    def begin(self):
+        if self.draining:
+            # 再次收到SIGTERM：不再等待进行中的请求，尽快退出
+            print("再次收到SIGTERM，立即结束排空")
+            self.deadline = time.monotonic()
+            if self._task is not None and self._task.done():
+                os.kill(os.getpid(), signal.SIGINT)
+            return
+        print(f"收到SIGTERM，开始排空，最长等待 {self.timeout:g}s")
+        self.draining = True
+        self.deadline = time.monotonic() + self.timeout
+        draining_gauge.set(1)
+        self._task = asyncio.create_task(self._drain())
+
+    def reconnect_after_ms(self) -> int:
+        return random.randint(0, max(0, DRAIN_RECONNECT_JITTER_MS))
+
+    async def release(self, connection: Connection):
+        """向连接发送重连提示，等待已排队的帧写出后关闭"""
+        try:
+            await connection.protocol.send_reconnect(self.reconnect_after_ms(), "server draining")
+            if connection.protocol.queue is not None:
+                await asyncio.wait_for(connection.protocol.queue.join(), 5.0)
+        except Exception:
+            pass
+        connection_manager.unregister(connection)
+        await connection.close(CLOSE_SERVICE_RESTART, "server draining")
+
+    def _in_flight(self) -> int:
+        generating = sum(1 for generation in generation_registry.generations.values() if not generation.done)
+        busy = sum(1 for connection in connection_manager.connections.values() if connection.busy)
+        return max(generating, busy)
+
+    async def _drain(self):
+        started = time.monotonic()
+        try:
+            # 空闲连接立即提示重连；处理请求中的连接在请求结束后由接收循环释放
+            idle = [connection for connection in list(connection_manager.connections.values()) if not connection.busy]
+            await asyncio.gather(*(self.release(connection) for connection in idle), return_exceptions=True)
+
+            while self._in_flight() and time.monotonic() < self.deadline:
+                await asyncio.sleep(DRAIN_POLL_INTERVAL)
+            remaining = [generation for generation in generation_registry.generations.values()
+                         if not generation.done and generation.task]
+            if remaining:
+                # 超时：取消剩余生成，已生成的部分照常写入对话历史
+                print(f"排空超时，取消 {len(remaining)} 个进行中的生成")
+                for generation in remaining:
+                    generation.cancel_reason = "服务器重启，回复已提前结束"
+                    generation.task.cancel()
+                await asyncio.wait([generation.task for generation in remaining], timeout=5.0)
+            # 给接收循环一点时间发送结束帧并释放连接
+            await asyncio.sleep(DRAIN_POLL_INTERVAL)
+            await asyncio.gather(*(self.release(connection) for connection in list(connection_manager.connections.values())),
+                                 return_exceptions=True)
+
+            flushed = await session_store.flush()
+            print(f"排空完成，用时 {time.monotonic() - started:.1f}s，已将 {flushed} 个会话写入磁盘")
+        except Exception as e:
+            print(f"排空过程中发生错误: {str(e)}")
+        finally:
+            # uvicorn仍处理SIGINT，由它完成正常退出
+            os.kill(os.getpid(), signal.SIGINT)
+
+
+# 创建全局停机排空控制器实例
+drain_controller = DrainController()
@@ -0,0 +1,257 @@
+import asyncio
+import os
+import time
+from typing import AsyncGenerator, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from backend.app.content_filter import BLOCKED_REPLY, ContentBlocked
+from backend.app.deadline import stop_at_deadline
+from backend.app.metrics import metrics
+from backend.app.protocol import ProtocolV1, StreamDigest
+from backend.app.request_context import RequestContext
+from backend.app.session_store import session_key
+from backend.app.tracing import NOOP_TRACE
+
+# 断线后继续生成并保留缓冲区的时间（秒）
+GENERATION_GRACE_SECONDS = float(os.getenv("GENERATION_GRACE_SECONDS", "120"))
+# 每个请求缓冲的片段数上限，超过后把较早的片段合并为前缀
+GENERATION_BUFFER_MAX_CHUNKS = int(os.getenv("GENERATION_BUFFER_MAX_CHUNKS", "512"))
+GENERATION_SWEEP_INTERVAL = float(os.getenv("GENERATION_SWEEP_INTERVAL", "5"))
+
+generations_gauge = metrics.gauge("generations_in_memory", "内存中保留的生成任务数")
+generations_detached_counter = metrics.counter("generations_completed_detached_total", "无连接附着时完成并提交的生成数")
+generations_resumed_counter = metrics.counter("generations_resumed_total", "断线重连后续传的生成数")
+
+
+class Generation:
+    """一次进行中的流式生成，片段按序号写入有界缓冲区，可供多次附着的连接从任意偏移续读"""
+    def __init__(self, request_id: str, agent_id: str, context: RequestContext, channel: Optional[int] = None):
+        self.request_id = request_id
+        self.agent_id = agent_id
+        self.context = context
+        # 多版本生成时的变体序号，单一回复为None
+        self.channel = channel
+        # 已合并的前缀覆盖序号 [0, prefix_seq)，parts覆盖 [prefix_seq, next_seq)
+        self.prefix = ""
+        self.prefix_seq = 0
+        self.parts: List[str] = []
+        self.next_seq = 0
+        self.done = False
+        self.error: Optional[str] = None
+        # 回复命中违禁词被中止（abort模式）
+        self.blocked = False
+        self.attached = 0
+        self.detached_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.updated = asyncio.Event()
+        # 任务被取消时记录的错误信息，由取消方设置
+        self.cancel_reason = "连接断开超过宽限期，生成已取消"
+
+    @property
+    def text(self) -> str:
+        return self.prefix + "".join(self.parts)
+
+    def _notify(self):
+        # 唤醒当前等待者，并为后续等待创建新的事件
+        self.updated.set()
+        self.updated = asyncio.Event()
+
+    def append(self, content: str):
+        self.parts.append(content)
+        self.next_seq += 1
+        if len(self.parts) > GENERATION_BUFFER_MAX_CHUNKS:
+            merge = len(self.parts) // 2
+            self.prefix += "".join(self.parts[:merge])
+            del self.parts[:merge]
+            self.prefix_seq += merge
+        self._notify()
+
+    def finish(self, error: Optional[str] = None):
+        self.done = True
+        self.error = error
+        self.finished_at = time.monotonic()
+        self._notify()
+
+    def read_from(self, seq: int) -> Tuple[Optional[str], List[Tuple[int, str]]]:
+        """读取序号seq及之后的片段；seq早于缓冲区时先返回覆盖已合并部分的快照"""
+        snapshot = None
+        if seq < self.prefix_seq:
+            snapshot = self.prefix
+            seq = self.prefix_seq
+        start = seq - self.prefix_seq
+        return snapshot, [(self.prefix_seq + i, self.parts[i]) for i in range(start, len(self.parts))]
+
+    def attach(self):
+        self.attached += 1
+
+    def detach(self):
+        self.attached = max(0, self.attached - 1)
+        if self.attached == 0:
+            self.detached_at = time.monotonic()
+
+
+class DuplicateGenerationError(ValueError):
+    """同一客户端的request_id对应的生成仍在进行中"""
+
+
+class GenerationRegistry:
+    """管理进行中与刚完成的生成任务，断线后在宽限期内继续生成并允许续传。
+    request_id由客户端提供，按(client_id, request_id)区分，只有发起请求的客户端能够续传"""
+    def __init__(self):
+        self.generations: Dict[Tuple[Optional[str], str], Generation] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+
+    def get(self, client_id: Optional[str], request_id: str) -> Optional[Generation]:
+        return self.generations.get((client_id, request_id))
+
+    def running(self, client_id: Optional[str], request_id: str) -> bool:
+        generation = self.get(client_id, request_id)
+        return generation is not None and not generation.done
+
+    def active_sessions(self) -> Set[str]:
+        """有进行中生成的会话键，会话存储不换出这些会话"""
+        return {session_key(generation.context.agent_id, generation.context.session_id)
+                for generation in self.generations.values() if not generation.done}
+
+    def start(self, request_id: str, agent_id: str, context: RequestContext,
+              chunks: AsyncGenerator[str, None], on_complete: Callable[[str], Awaitable[None]],
+              channel: Optional[int] = None) -> Generation:
+        """启动后台生成任务；回复完成（或宽限期到期被取消）后通过on_complete提交到历史记录。
+        同一客户端的request_id仍在生成时抛出DuplicateGenerationError，已完成的旧生成被替换"""
+        key = (context.client_id, request_id)
+        if self.running(*key):
+            raise DuplicateGenerationError(f"请求 {request_id} 正在生成中")
+        generation = Generation(request_id, agent_id, context, channel)
+        self.generations[key] = generation
+        if context.deadline is not None:
+            # 到达请求期限时停止生成，已生成的部分照常提交
+            chunks = stop_at_deadline(chunks, context)
+        generations_gauge.set(len(self.generations))
+        generation.task = asyncio.create_task(self._produce(generation, chunks, on_complete))
+        self._ensure_sweeper()
+        return generation
+
+    async def _produce(self, generation: Generation, chunks: AsyncGenerator[str, None],
+                       on_complete: Callable[[str], Awaitable[None]]):
+        error = None
+        # 在生成任务自己的上下文中激活，上游调用的span都挂在它下面
+        span = generation.context.trace.span("agent.generate", agent_id=generation.agent_id).activate()
+        try:
+            async for response_chunk in chunks:
+                print(f"收到流式响应片段: {response_chunk[:30]+'...' if len(response_chunk)>30 else response_chunk}")
+                if response_chunk:
+                    generation.append(response_chunk)
+        except asyncio.CancelledError:
+            error = generation.cancel_reason
+            print(f"生成已取消: request_id={generation.request_id}")
+        except ContentBlocked as e:
+            error = str(e)
+            generation.blocked = True
+            print(f"回复命中违禁词已中止: request_id={generation.request_id}")
+        except Exception as e:
+            error = f"处理消息时发生错误: {str(e)}"
+            print(f"错误: {error}")
+        finally:
+            await chunks.aclose()
+        # 被中止的回复只以占位内容写入历史
+        text = BLOCKED_REPLY if generation.blocked else generation.text
+        try:
+            if text:
+                # 无论是否有连接附着，都把回复写入对话历史
+                await on_complete(text)
+                if generation.attached == 0:
+                    generations_detached_counter.inc()
+        except Exception as e:
+            print(f"回复写入历史失败: request_id={generation.request_id}, {str(e)}")
+        finally:
+            # 写入失败或被取消时也要结束生成，否则附着的连接会一直等待
+            span.set_attribute("chunks", generation.next_seq)
+            span.set_attribute("detached", generation.attached == 0)
+            span.end(error)
+            generation.finish(error)
+
+    def _ensure_sweeper(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def _sweep_loop(self):
+        while self.generations:
+            await asyncio.sleep(GENERATION_SWEEP_INTERVAL)
+            self.sweep()
+
+    def sweep(self):
+        """清理宽限期已过的生成：已完成的移出内存，无人附着仍在生成的取消"""
+        now = time.monotonic()
+        for key, generation in list(self.generations.items()):
+            if generation.attached:
+                continue
+            if generation.done:
+                if now - generation.finished_at > GENERATION_GRACE_SECONDS and self.generations.get(key) is generation:
+                    del self.generations[key]
+            elif now - generation.detached_at > GENERATION_GRACE_SECONDS and generation.task:
+                generation.task.cancel()
+        generations_gauge.set(len(self.generations))
+
+
+async def stream_generation(protocol: ProtocolV1, generation: Generation, offset: int = 0, trace=NOOP_TRACE):
+    """把生成结果从offset开始推送给当前连接，直到生成结束"""
+    generation.attach()
+    # 记录套接字发送耗时（不含等待上游片段的时间）
+    span = trace.span("ws.stream", offset=offset)
+    sends = 0
+    send_seconds = 0.0
+    try:
+        if offset:
+            generations_resumed_counter.inc()
+        await protocol.send_start(generation.agent_id, generation.request_id, offset, generation.channel)
+        seq = offset
+        while True:
+            updated = generation.updated
+            snapshot, chunks = generation.read_from(seq)
+            send_started = time.perf_counter()
+            if snapshot is not None:
+                await protocol.send_snapshot(generation.agent_id, snapshot, generation.request_id, generation.prefix_seq - 1, generation.channel)
+            for chunk_seq, content in chunks:
+                if sends == 0:
+                    span.add_event("first_chunk_sent", seq=chunk_seq)
+                # 每次只发送新增的部分，而不是累积的全部内容
+                await protocol.send_chunk(generation.agent_id, content, generation.request_id, chunk_seq, generation.channel)
+                seq = chunk_seq + 1
+                sends += 1
+            send_seconds += time.perf_counter() - send_started
+            if snapshot is not None and not chunks:
+                seq = generation.prefix_seq
+            if generation.done and seq >= generation.next_seq:
+                break
+            if snapshot is None and not chunks:
+                await updated.wait()
+
+        if generation.error:
+            await protocol.send_error(generation.error)
+        else:
+            print(f"流式响应完成，发送最终消息")
+            full_response = generation.text
+            digest = StreamDigest()
+            digest.update(full_response)
+            extra = {"model": generation.context.model, "request_id": generation.request_id}
+            if generation.channel is not None:
+                extra["variant"] = generation.channel
+            if generation.context.finish_reason:
+                # 到达期限提前结束，content为已生成的部分
+                extra["finish_reason"] = generation.context.finish_reason
+            if generation.context.trace.trace_id:
+                extra["trace_id"] = generation.context.trace.trace_id
+            # 发送完成标记（v2只携带长度与校验和，不重复完整回复）
+            await protocol.send_end(generation.agent_id, full_response, digest, **extra)
+    except BaseException as e:
+        span.end(type(e).__name__)
+        raise
+    finally:
+        span.set_attribute("chunks_sent", sends)
+        span.set_attribute("send_seconds", round(send_seconds, 6))
+        span.end()
+        generation.detach()
+
+
+# 创建全局生成任务注册表实例
+generation_registry = GenerationRegistry()
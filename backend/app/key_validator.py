@@ -0,0 +1,121 @@
+import asyncio
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from dashscope import Generation
+
+from backend.app.llm_client import DEFAULT_MODEL
+from backend.app.metrics import metrics
+
+# 验证结果缓存时间（秒）：有效密钥缓存较久，无效密钥只短暂缓存，便于用户充值或修正后重试
+KEY_VALID_TTL = float(os.getenv("API_KEY_VALID_TTL", "300"))
+KEY_INVALID_TTL = float(os.getenv("API_KEY_INVALID_TTL", "30"))
+KEY_CACHE_MAX_ENTRIES = int(os.getenv("API_KEY_CACHE_MAX_ENTRIES", "1024"))
+
+# 上游返回这些状态码时结论是确定的，可以缓存；其他错误（超时、限流等）不缓存
+DEFINITIVE_STATUS_CODES = {200, 400, 401, 403}
+
+# 验证请求使用独立的小线程池，不占用流式生成的线程
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="key-validator")
+
+key_validation_counter = metrics.counter("api_key_validations_total", "发往上游的API Key验证次数")
+key_cache_hit_counter = metrics.counter("api_key_validation_cache_hits_total", "命中缓存的API Key验证次数")
+
+
+def key_hash(api_key: str) -> str:
+    """缓存只保存密钥的哈希，不保存明文"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+class ApiKeyValidator:
+    """在线程池中调用上游验证API Key，并按密钥哈希缓存验证结果"""
+    def __init__(self, valid_ttl: float = KEY_VALID_TTL, invalid_ttl: float = KEY_INVALID_TTL,
+                 max_entries: int = KEY_CACHE_MAX_ENTRIES):
+        self.valid_ttl = valid_ttl
+        self.invalid_ttl = invalid_ttl
+        self.max_entries = max_entries
+        self._cache: "OrderedDict[str, Tuple[float, bool, str]]" = OrderedDict()
+        # 同一密钥的并发验证共享一次上游调用
+        self._inflight: Dict[str, asyncio.Future] = {}
+
+    def _cached(self, digest: str) -> Optional[Tuple[bool, str]]:
+        entry = self._cache.get(digest)
+        if entry is None:
+            return None
+        expires_at, valid, message = entry
+        if time.monotonic() >= expires_at:
+            del self._cache[digest]
+            return None
+        self._cache.move_to_end(digest)
+        return valid, message
+
+    def _store(self, digest: str, valid: bool, message: str):
+        ttl = self.valid_ttl if valid else self.invalid_ttl
+        self._cache[digest] = (time.monotonic() + ttl, valid, message)
+        self._cache.move_to_end(digest)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def invalidate(self, api_key: str):
+        self._cache.pop(key_hash(api_key), None)
+
+    @staticmethod
+    def _call_upstream(api_key: str) -> Tuple[bool, str, bool]:
+        """同步调用上游，返回(是否有效, 提示信息, 结论是否可缓存)；密钥随请求传入，不修改全局dashscope.api_key"""
+        try:
+            response = Generation.call(
+                model=DEFAULT_MODEL,
+                prompt='测试',
+                max_tokens=10,
+                api_key=api_key
+            )
+        except Exception as e:
+            error_msg = str(e)
+            if "Invalid API-key" in error_msg or "Unauthorized" in error_msg:
+                return False, "API Key无效", True
+            elif "quota" in error_msg.lower():
+                return False, "API Key配额不足", False
+            return False, f"验证过程中出现错误: {error_msg}", False
+
+        cacheable = response.status_code in DEFINITIVE_STATUS_CODES
+        if response.status_code == 200:
+            return True, "API Key验证成功", cacheable
+        return False, f"API Key验证失败: {response.message}", cacheable
+
+    async def validate(self, api_key: str) -> Tuple[bool, str]:
+        digest = key_hash(api_key)
+        cached = self._cached(digest)
+        if cached is not None:
+            key_cache_hit_counter.inc()
+            return cached
+
+        inflight = self._inflight.get(digest)
+        if inflight is not None:
+            key_cache_hit_counter.inc()
+            return await asyncio.shield(inflight)
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._inflight[digest] = future
+        try:
+            key_validation_counter.inc()
+            valid, message, cacheable = await loop.run_in_executor(_executor, self._call_upstream, api_key)
+            if cacheable:
+                self._store(digest, valid, message)
+            future.set_result((valid, message))
+            return valid, message
+        except BaseException as e:
+            future.set_exception(e)
+            # 没有其他等待者时避免“异常未被读取”的警告
+            future.exception()
+            raise
+        finally:
+            del self._inflight[digest]
+
+
+# 创建全局API Key验证器实例
+api_key_validator = ApiKeyValidator()
@@ -0,0 +1,374 @@
+import asyncio
+import hashlib
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from typing import AsyncGenerator, Dict, List, Optional
+
+import dashscope
+
+from backend.app.circuit_breaker import BreakerRegistry
+from backend.app.metrics import metrics
+from backend.app.request_context import get_request_context
+from backend.app.scheduler import SCHED_DEFAULT_OUTPUT_TOKENS, scheduler
+from backend.app.tracing import NOOP_TRACE
+
+DEFAULT_MODEL = "qwen-turbo"
+
+# 重试配置：只在首个片段发出之前重试
+RETRY_MAX_ATTEMPTS = int(os.getenv("LLM_RETRY_MAX_ATTEMPTS", "3"))
+RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.2"))
+RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "2.0"))
+
+# 对冲请求配置：首个token超过p95 TTFT仍未到达时发出第二个请求
+HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_DEFAULT_DELAY = float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "2.0"))
+HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+# 每个API Key的对冲预算：每次请求存入ratio个令牌，每次对冲消耗1个
+HEDGE_BUDGET_RATIO = float(os.getenv("LLM_HEDGE_BUDGET_RATIO", "0.1"))
+HEDGE_BUDGET_MAX = float(os.getenv("LLM_HEDGE_BUDGET_MAX", "10"))
+
+# 上游SDK是同步迭代器，放到独立线程池中执行，避免阻塞事件循环
+UPSTREAM_MAX_WORKERS = int(os.getenv("LLM_MAX_WORKERS", "64"))
+
+# 可重试的HTTP状态码与DashScope错误码
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRYABLE_ERROR_CODES = {
+    "Throttling",
+    "Throttling.RateQuota",
+    "Throttling.AllocationQuota",
+    "Throttling.User",
+    "InternalError",
+    "InternalError.Algo",
+    "ServiceUnavailable",
+    "RequestTimeOut",
+}
+
+_executor = ThreadPoolExecutor(max_workers=UPSTREAM_MAX_WORKERS, thread_name_prefix="llm-upstream")
+
+ttft_histogram = metrics.histogram("llm_ttft_seconds", "上游首token时延")
+retry_counter = metrics.counter("llm_retries_total", "首包前重试次数")
+hedge_counter = metrics.counter("llm_hedges_total", "发出的对冲请求数")
+upstream_error_counter = metrics.counter("llm_upstream_errors_total", "上游调用失败次数")
+deadline_rejected_counter = metrics.counter("llm_deadline_rejected_total", "排队到最晚开始时刻仍未获得名额而放弃的请求数")
+
+
+class UpstreamError(Exception):
+    """上游模型调用失败"""
+    def __init__(self, message: str, status_code: Optional[int] = None, code: Optional[str] = None, retryable: bool = False):
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+        self.retryable = retryable
+
+
+def classify_exception(e: Exception) -> UpstreamError:
+    """把SDK或网络层抛出的异常归类为UpstreamError"""
+    if isinstance(e, UpstreamError):
+        return e
+    # 连接重置、超时等网络错误均可重试
+    if isinstance(e, (ConnectionError, TimeoutError)):
+        return UpstreamError(str(e), retryable=True)
+    name = type(e).__name__
+    if name in ("ConnectionError", "ConnectTimeout", "ReadTimeout", "Timeout", "ChunkedEncodingError", "ProtocolError"):
+        return UpstreamError(str(e), retryable=True)
+    return UpstreamError(str(e), retryable=False)
+
+
+def _error_from_response(response) -> UpstreamError:
+    status_code = getattr(response, "status_code", None)
+    code = getattr(response, "code", None)
+    message = getattr(response, "message", "") or f"上游返回状态码 {status_code}"
+    retryable = status_code in RETRYABLE_STATUS_CODES or code in RETRYABLE_ERROR_CODES
+    return UpstreamError(message, status_code=status_code, code=code, retryable=retryable)
+
+
+class RetryPolicy:
+    """带full jitter的指数退避重试策略"""
+    def __init__(self, max_attempts: int = RETRY_MAX_ATTEMPTS, base_delay: float = RETRY_BASE_DELAY, max_delay: float = RETRY_MAX_DELAY):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def should_retry(self, error: UpstreamError, attempt: int) -> bool:
+        return error.retryable and attempt < self.max_attempts
+
+    def backoff(self, attempt: int) -> float:
+        """第attempt次失败后的等待时间，在[0, min(max, base*2^(n-1))]中均匀随机"""
+        cap = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return random.uniform(0, cap)
+
+
+class TTFTTracker:
+    """按模型记录最近的首token时延，用于估算p95"""
+    def __init__(self, window: int = 200):
+        self.window = window
+        self.samples: Dict[str, deque] = {}
+
+    def record(self, model: str, seconds: float):
+        if model not in self.samples:
+            self.samples[model] = deque(maxlen=self.window)
+        self.samples[model].append(seconds)
+
+    def percentile(self, model: str, q: float) -> Optional[float]:
+        samples = self.samples.get(model)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(q * len(ordered)))
+        return ordered[index]
+
+    def count(self, model: str) -> int:
+        return len(self.samples.get(model, ()))
+
+
+class HedgeBudget:
+    """每个API Key一个令牌桶，限制对冲请求占总请求的比例，防止放大上游负载"""
+    def __init__(self, ratio: float = HEDGE_BUDGET_RATIO, max_tokens: float = HEDGE_BUDGET_MAX):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens: Dict[str, float] = {}
+
+    def on_request(self, key: str):
+        self.tokens[key] = min(self.max_tokens, self.tokens.get(key, 0.0) + self.ratio)
+
+    def try_acquire(self, key: str) -> bool:
+        if self.tokens.get(key, 0.0) >= 1.0:
+            self.tokens[key] -= 1.0
+            return True
+        return False
+
+
+class _UpstreamAttempt:
+    """一次上游流式调用，在线程池中迭代SDK响应并把增量内容投递回事件循环"""
+    def __init__(self, loop: asyncio.AbstractEventLoop, call_kwargs: Dict):
+        self.loop = loop
+        self.call_kwargs = call_kwargs
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.cancelled = threading.Event()
+        self.started_at = time.monotonic()
+        self.ttft: Optional[float] = None
+
+    def start(self):
+        self.loop.run_in_executor(_executor, self._run)
+        return self
+
+    def _put(self, kind: str, value):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, (kind, value))
+
+    def _run(self):
+        try:
+            responses = dashscope.Generation.call(**self.call_kwargs)
+            # 跟踪之前接收到的内容，以便只返回新增部分
+            previous_content = ""
+            for response in responses:
+                if self.cancelled.is_set():
+                    return
+                if getattr(response, "status_code", HTTPStatus.OK) != HTTPStatus.OK:
+                    raise _error_from_response(response)
+                if hasattr(response.output, "choices") and response.output.choices:
+                    current_content = response.output.choices[0].message.content
+                    new_content = current_content[len(previous_content):]
+                    previous_content = current_content
+                    if new_content:
+                        self._put("chunk", new_content)
+            self._put("done", None)
+        except Exception as e:
+            self._put("error", classify_exception(e))
+
+    async def next_chunk(self) -> Optional[str]:
+        """返回下一个片段，流结束时返回None"""
+        kind, value = await self.queue.get()
+        if kind == "chunk":
+            return value
+        if kind == "error":
+            raise value
+        return None
+
+    def cancel(self):
+        self.cancelled.set()
+
+
+class LLMClient:
+    """上游大模型调用入口，负责首包前重试与对冲请求"""
+    def __init__(self, retry_policy: Optional[RetryPolicy] = None, hedge_enabled: bool = HEDGE_ENABLED, breakers: Optional[BreakerRegistry] = None):
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.hedge_enabled = hedge_enabled
+        self.ttft = TTFTTracker()
+        self.hedge_budget = HedgeBudget()
+        self.breakers = breakers or BreakerRegistry()
+
+    def hedge_delay(self, model: str) -> float:
+        """对冲等待时间：样本足够时取p95 TTFT，否则使用默认值"""
+        if self.ttft.count(model) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return self.ttft.percentile(model, 0.95)
+
+    @staticmethod
+    def _budget_key(api_key: Optional[str]) -> str:
+        key = api_key or dashscope.api_key or ""
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+    async def _first_chunk(self, call_kwargs: Dict, model: str, budget_key: str):
+        """发出请求（必要时对冲），返回先产生首个片段的那次调用及其首个片段"""
+        loop = asyncio.get_running_loop()
+        primary = _UpstreamAttempt(loop, call_kwargs).start()
+        tasks = {asyncio.ensure_future(primary.next_chunk()): primary}
+
+        try:
+            if self.hedge_enabled:
+                done, _ = await asyncio.wait(tasks.keys(), timeout=self.hedge_delay(model))
+                if not done:
+                    if self.hedge_budget.try_acquire(budget_key):
+                        print(f"首token超时，发出对冲请求: model={model}")
+                        hedge_counter.inc(labels={"model": model})
+                        hedge = _UpstreamAttempt(loop, call_kwargs).start()
+                        tasks[asyncio.ensure_future(hedge.next_chunk())] = hedge
+                    else:
+                        print(f"对冲预算不足，继续等待原请求: model={model}")
+
+            last_error: Optional[UpstreamError] = None
+            pending = set(tasks.keys())
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    attempt = tasks[task]
+                    if task.exception() is not None:
+                        last_error = task.exception()
+                        continue
+                    # 保留最先响应的请求，取消其余请求
+                    for other_task, other in tasks.items():
+                        if other is not attempt:
+                            other_task.cancel()
+                            other.cancel()
+                    attempt.ttft = time.monotonic() - attempt.started_at
+                    self.ttft.record(model, attempt.ttft)
+                    ttft_histogram.observe(attempt.ttft, {"model": model})
+                    return attempt, task.result()
+            raise last_error
+        except asyncio.CancelledError:
+            # 调用方被取消（如客户端断开）时结束所有仍在进行的请求，避免后台线程继续占用上游
+            for task, attempt in tasks.items():
+                task.cancel()
+                attempt.cancel()
+            raise
+
+    async def stream_chat(self, messages: List[Dict[str, str]], model: str = DEFAULT_MODEL, api_key: Optional[str] = None, **params) -> AsyncGenerator[str, None]:
+        """流式调用模型，只返回新增片段；首个片段发出后不再重试"""
+        call_kwargs = dict(model=model, messages=messages, result_format='message', stream=True, **params)
+        if api_key:
+            call_kwargs["api_key"] = api_key
+        budget_key = self._budget_key(api_key)
+        self.hedge_budget.on_request(budget_key)
+
+        context = get_request_context()
+        trace = context.trace if context else NOOP_TRACE
+        # 按API Key与客户端公平排队，长时间占用名额的流随后排得更靠后
+        client_id = context.client_id if context else None
+        priority = context.priority if context else "batch"
+        estimated = ((context.prompt_tokens or 0) if context else 0) + params.get("max_tokens", SCHED_DEFAULT_OUTPUT_TOKENS)
+        start_by = context.start_by if context else None
+        with trace.span("llm.queue", priority=priority) as span:
+            if start_by is None:
+                ticket = await scheduler.acquire(budget_key, client_id, priority, estimated)
+            else:
+                # 有期限的请求只排队到最晚开始时刻，来不及时直接放弃，不占用上游名额
+                budget = start_by - time.monotonic()
+                try:
+                    if budget <= 0:
+                        raise asyncio.TimeoutError()
+                    ticket = await asyncio.wait_for(scheduler.acquire(budget_key, client_id, priority, estimated), budget)
+                except asyncio.TimeoutError:
+                    deadline_rejected_counter.inc(labels={"priority": priority})
+                    span.set_attribute("deadline_rejected", True)
+                    error = UpstreamError("无法在请求期限内完成，请放宽deadline_ms后重试", code="DeadlineExceeded")
+                    if context:
+                        context.upstream_error = str(error)
+                    raise error
+            span.set_attribute("waited_seconds", round(ticket.waited, 6))
+        output_chars = 0
+        stream = self._stream_with_retry(call_kwargs, model, budget_key, context, trace)
+        try:
+            async for chunk in stream:
+                output_chars += len(chunk)
+                yield chunk
+        except UpstreamError as e:
+            if context:
+                context.upstream_error = str(e)
+            raise
+        finally:
+            await stream.aclose()
+            # 输出按约一个字符一个token计入实际用量
+            scheduler.release(ticket, ((context.prompt_tokens or 0) if context else 0) + output_chars)
+
+    async def _stream_with_retry(self, call_kwargs: Dict, model: str, budget_key: str, context, trace) -> AsyncGenerator[str, None]:
+        """在已获得的调度名额内发出请求，首个片段前按重试策略与熔断状态重试或改道"""
+        attempt_no = 0
+        while True:
+            attempt_no += 1
+            # 每次尝试前重新检查熔断状态，主模型熔断时沿降级链改道
+            selected = self.breakers.select(model)
+            if selected is None:
+                raise UpstreamError(f"模型 {model} 及其降级模型均已熔断，请稍后重试", code="CircuitOpen")
+            call_kwargs["model"] = selected
+            if context:
+                context.model = selected
+            breaker = self.breakers.get(selected)
+            # 从发出请求到收到首个片段（上游TTFT，含对冲）
+            span = trace.span("llm.first_token", model=selected, attempt=attempt_no)
+            try:
+                attempt, first = await self._first_chunk(call_kwargs, selected, budget_key)
+            except UpstreamError as e:
+                span.end(f"{e.code or e.status_code}: {e}")
+                upstream_error_counter.inc(labels={"model": selected, "code": str(e.code or e.status_code or "unknown")})
+                # 只有服务端问题计入熔断统计，参数错误、密钥无效等不影响模型健康度
+                if e.retryable:
+                    breaker.record_failure()
+                else:
+                    breaker.release()
+                if not self.retry_policy.should_retry(e, attempt_no):
+                    raise
+                delay = self.retry_policy.backoff(attempt_no)
+                if context and context.start_by is not None and time.monotonic() + delay > context.start_by:
+                    # 退避后已来不及在期限内完成，不再重试
+                    raise
+                retry_counter.inc(labels={"model": selected})
+                print(f"上游调用失败，{delay:.2f}秒后第{attempt_no + 1}次尝试: model={selected}, status={e.status_code}, code={e.code}, error={e}")
+                await asyncio.sleep(delay)
+                continue
+            except BaseException as e:
+                span.end(type(e).__name__)
+                breaker.release()
+                raise
+            span.end()
+            breaker.record_success(attempt.ttft or 0.0)
+            break
+
+        # 首个片段之后的逐片段输出
+        span = trace.span("llm.stream", model=selected)
+        chunks = 0
+        try:
+            chunk = first
+            while chunk is not None:
+                chunks += 1
+                yield chunk
+                chunk = await attempt.next_chunk()
+        except GeneratorExit:
+            # 下游提前关闭（例如生成被取消），不算上游错误
+            span.set_attribute("closed_early", True)
+            raise
+        except BaseException as e:
+            span.end(type(e).__name__)
+            raise
+        finally:
+            span.set_attribute("chunks", chunks)
+            span.end()
+            attempt.cancel()
+
+
+# 创建全局上游调用客户端实例
+llm_client = LLMClient()
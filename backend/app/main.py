@@ -1,12 +1,31 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, HTTPException
+from fastapi import Depends, FastAPI, Header, WebSocket, WebSocketDisconnect, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse
 from pydantic import BaseModel
-from typing import Dict, List
+from typing import Optional
+import base64
 import json
 import uuid
 import asyncio
-import dashscope
 from backend.app.agent_manager import agent_manager
+from backend.app.admin import require_admin, router as admin_router
+from backend.app.connections import connection_manager
+from backend.app.content_filter import BLOCKED_REPLY, ContentBlocked
+from backend.app.deadline import deadline_from_ms, stop_at_deadline
+from backend.app.drain import drain_controller
+from backend.app.metrics import metrics
+from backend.app.key_validator import api_key_validator
+from backend.app.generations import generation_registry, stream_generation
+from backend.app.profiler import LOOP_MONITOR_ENABLED, loop_monitor
+from backend.app.protocol import negotiate_protocol
+from backend.app.request_context import RequestContext, set_request_context
+from backend.app.retrieval_memory import retrieval_memory
+from backend.app.sandbox import sandbox_pool, verify_reply
+from backend.app.semantic_cache import semantic_cache
+from backend.app.session_store import MEMORY_MODES, session_store
+from backend.app.stream_middleware import stream_middleware
+from backend.app.tracing import tracer
+from backend.app.variants import VARIANTS_MAX, stream_variants, variant_request_id
 from backend.agents.story_agent import StoryAgent
 from backend.agents.rewrite_agent import RewriteAgent
 from backend.agents.copywriting_agent import CopywritingAgent
@@ -31,11 +50,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# 存储活跃的WebSocket连接
-active_connections: Dict[str, WebSocket] = {}
-
-# 为每个会话存储对话历史
-chat_history: Dict[str, List[Dict]] = {}
+# 注册管理接口
+app.include_router(admin_router)
 
 # 注册智能体
 story_agent = StoryAgent()
@@ -90,144 +106,326 @@ agent_manager.register_agent(food_critic_agent)
 agent_manager.register_agent(debate_expert_agent)
 agent_manager.register_agent(ancient_style_agent)
 
+@app.on_event("startup")
+async def start_loop_monitor():
+    # 监控事件循环延迟，循环被同步调用阻塞时记录调用栈，见 /admin/event-loop
+    if LOOP_MONITOR_ENABLED:
+        loop_monitor.start()
+
+@app.on_event("startup")
+async def start_session_store():
+    # 载入已换出到磁盘的会话索引，并启动空闲会话的后台换出
+    await session_store.start()
+    # 回复仍在生成的会话不换出，完成后再写入历史
+    session_store.in_use = generation_registry.active_sessions
+
+@app.on_event("startup")
+async def install_drain_handler():
+    # 收到SIGTERM时先排空进行中的生成并把会话写入磁盘，再交给uvicorn退出
+    drain_controller.install_signal_handler()
+
+@app.on_event("startup")
+async def start_sandbox_pool():
+    # 预热代码运行验证使用的沙箱进程
+    await sandbox_pool.start()
+
+@app.on_event("shutdown")
+async def stop_sandbox_pool():
+    sandbox_pool.close()
+
 @app.get("/")
 async def root():
     return {"message": "本地智能体服务器运行中"}
 
+@app.get("/ready")
+async def ready():
+    """
+    就绪检查：停机排空期间返回503，负载均衡据此不再转发新连接
+    """
+    if drain_controller.draining:
+        raise HTTPException(status_code=503, detail="服务器正在停机排空")
+    return {"status": "ready"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    以Prometheus文本格式导出运行指标
+    """
+    return metrics.render()
+
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
-    await websocket.accept()
-    active_connections[client_id] = websocket
-    print(f"WebSocket连接已建立: client_id={client_id}")
+    # 协商协议版本：v1为当前前端使用的JSON协议，v2为紧凑协议
+    protocol = negotiate_protocol(websocket)
+    await websocket.accept(subprotocol=protocol.subprotocol)
+    # 同一client_id可以同时保持多个连接，每个连接分配唯一ID，由连接管理器统一做心跳与空闲检查
+    connection = await connection_manager.register(client_id, websocket, protocol)
+    print(f"WebSocket连接已建立: client_id={client_id}, connection_id={connection.id}, 协议版本: v{protocol.version}")
+    if drain_controller.draining:
+        # 停机排空期间不再接受新连接，提示客户端稍后重连
+        await drain_controller.release(connection)
+        return
     
     try:
+        await protocol.send_hello(connection.id, connection_manager.heartbeat_interval)
         while True:
-            data = await websocket.receive_text()
-            print(f"收到原始数据: {data}")
-            
             try:
-                message = json.loads(data)
+                message = await protocol.receive()
+                message_type = message.get('type', 'message')
+                
+                # 心跳消息只刷新连接的存活时间
+                if message_type == 'pong':
+                    connection.touch(activity=False)
+                    continue
+                if message_type == 'ping':
+                    connection.touch(activity=False)
+                    await protocol.send_pong()
+                    continue
+                
                 print(f"解析后的消息: {message}")  # 详细日志
+                connection.touch()
+                connection.busy = True
                 
                 # 处理消息
                 agent_id = message.get('to')
                 content = message.get('content', '')
-                message_type = message.get('type', 'message')
                 stream_mode = message.get('stream', True)  # 默认使用流式输出
                 session_id = message.get('session_id', 'default')  # 获取会话ID
+                model_override = message.get('model')  # 可选：指定模型
+                max_tokens = message.get('max_tokens')  # 可选：期望的最大输出长度
+                batch = message.get('priority') == 'batch'  # 可选：标记为批量任务，调度时让位于交互请求
+                deadline = deadline_from_ms(message.get('deadline_ms'))  # 可选：回复必须结束的时限（毫秒），到期返回已生成的部分
+                request_id = message.get('request_id') or uuid.uuid4().hex  # 生成请求ID，用于断线续传
+                memory_mode = message.get('memory')  # 可选：会话的历史记忆模式（full/retrieval），设置后沿用
+                verify = bool(message.get('verify'))  # 可选：在沙箱中运行回复里的代码块并返回运行结果
+                
+                # 断线重连后从上次收到的序号继续接收进行中的回复
+                if message_type == 'resume':
+                    # 只能续传本客户端发起的请求
+                    generation = generation_registry.get(client_id, request_id) if message.get('request_id') else None
+                    if not generation:
+                        await protocol.send_error(f"请求 {request_id} 不存在或已过期，无法续传")
+                        continue
+                    offset = message.get('offset', 0)
+                    print(f"续传生成: request_id={request_id}, offset={offset}")
+                    resume_trace = tracer.start_trace("ws.resume", sampled=generation.context.trace.sampled or None,
+                                                      request_id=request_id, origin_trace_id=generation.context.trace.trace_id)
+                    try:
+                        await stream_generation(protocol, generation, offset if isinstance(offset, int) and offset > 0 else 0, trace=resume_trace)
+                    finally:
+                        resume_trace.root.end()
+                    continue
                 
                 print(f"消息详情: agent_id={agent_id}, type={message_type}, session_id={session_id}, content={content[:50]+'...' if len(content)>50 else content}")
                 
-                # 创建会话历史的唯一键
-                session_key = f"{agent_id}:{session_id}"
+                if drain_controller.draining:
+                    # 停机排空期间不再开始新的生成，续传不受影响
+                    await protocol.send_error("服务器正在重启，请稍后重连再发送")
+                    continue
                 
                 if agent_id:
                     agent = agent_manager.get_agent(agent_id)
                     if not agent:
                         print(f"错误: 未找到智能体 {agent_id}")
-                        await websocket.send_json({
-                            "type": "error",
-                            "content": f"未找到ID为 {agent_id} 的智能体",
-                            "from": "system"
-                        })
+                        await protocol.send_error(f"未找到ID为 {agent_id} 的智能体")
                         continue
                         
+                    # 可选：多版本生成，并发生成N个不同风格的变体
+                    variant_count = message.get('variants')
+                    directives = None
+                    if isinstance(variant_count, int) and variant_count > 1 and stream_mode:
+                        directives = agent.variant_directives(min(variant_count, VARIANTS_MAX))
+                        if directives is None:
+                            await protocol.send_error(f"智能体 {agent_id} 不支持多版本生成")
+                            continue
+                    
+                    if verify and not agent.code_verification:
+                        await protocol.send_error(f"智能体 {agent_id} 不支持代码运行验证")
+                        continue
+                    
+                    if memory_mode is not None and memory_mode not in MEMORY_MODES:
+                        await protocol.send_error(f"未知的记忆模式: {memory_mode}，可选: {', '.join(MEMORY_MODES)}")
+                        continue
+                    
+                    # 客户端重复使用仍在生成中的request_id时拒绝，不覆盖正在进行的生成，也不写入历史
+                    request_ids = [variant_request_id(request_id, index) for index in range(len(directives))] if directives else [request_id]
+                    if any(generation_registry.running(client_id, rid) for rid in request_ids):
+                        await protocol.send_error(f"请求 {request_id} 正在生成中，请使用新的request_id，或发送resume续传")
+                        continue
+                    
                     if content:
                         print(f"处理消息: agent_id={agent_id}, content={content[:50]+'...' if len(content)>50 else content}")
+                        # 按采样率为本次请求创建trace，未采样时各阶段的span均为空操作
+                        trace = tracer.start_trace("ws.message", agent_id=agent_id, session_id=session_id,
+                                                   request_id=request_id, stream=bool(stream_mode))
                         
-                        # 确保会话历史存在
-                        if session_key not in chat_history:
-                            print(f"为会话 {session_key} 创建新的历史记录")
-                            chat_history[session_key] = []
+                        with trace.span("session.assemble") as span:
+                            # 会话已换出到磁盘时先在后台线程中载入
+                            await session_store.ensure_loaded(agent_id, session_id)
+                            # 会话不存在时创建并记录所属的客户端，历史接口据此限定访问范围
+                            session_store.get_or_create(agent_id, session_id, owner=client_id)
+                            # 添加用户消息到对话历史
+                            session_store.append(agent_id, session_id, "user", content)
+                            if memory_mode:
+                                session_store.set_memory_mode(agent_id, session_id, memory_mode)
+                            session = session_store.get(agent_id, session_id)
+                            if session.memory_mode == "retrieval":
+                                # 只发送最近的轮次和与本次提问相关的旧轮次
+                                history = await retrieval_memory.assemble(session, content)
+                            else:
+                                history = session_store.history(agent_id, session_id)
+                            
+                            # 构建包含历史消息的完整消息列表
+                            messages = [
+                                {"role": "system", "content": agent.system_prompt}
+                            ] + history
+                            span.set_attribute("history_length", len(history))
+                            span.set_attribute("memory_mode", session.memory_mode)
                         
-                        # 添加用户消息到对话历史
-                        chat_history[session_key].append({"role": "user", "content": content})
+                        print(f"会话ID: {session_id}, 智能体: {agent_id}, 历史记录长度: {len(history)}")
                         
-                        # 构建包含历史消息的完整消息列表
-                        messages = [
-                            {"role": "system", "content": agent.system_prompt}
-                        ] + chat_history[session_key]
+                        # 语义缓存只用于首轮提问（回复不依赖上文），且客户端未指定模型
+                        cacheable = (not directives and len(session.messages) == 1 and not model_override
+                                     and semantic_cache.enabled_for(agent))
+                        cache_hit = None
+                        if cacheable:
+                            with trace.span("semantic_cache.lookup") as span:
+                                # 向量检索是矩阵运算，放到线程池中执行，不阻塞事件循环
+                                cache_hit = await asyncio.get_running_loop().run_in_executor(
+                                    None, semantic_cache.lookup, agent_id, content)
+                                span.set_attribute("hit", cache_hit is not None)
                         
-                        print(f"会话ID: {session_id}, 智能体: {agent_id}, 历史记录长度: {len(chat_history[session_key])}")
+                        # 设置请求上下文，供模型路由与上游调用读取请求级参数并回写实际使用的模型
+                        request_context = RequestContext(
+                            agent_id=agent_id,
+                            session_id=session_id,
+                            model_override=model_override,
+                            max_tokens=max_tokens if isinstance(max_tokens, int) and max_tokens > 0 else None,
+                            client_id=client_id,
+                            # 流式请求有人在实时等待，优先于一次性请求；客户端只能主动降级为批量
+                            priority="batch" if batch else ("interactive" if stream_mode else "non_stream"),
+                            deadline=deadline,
+                        )
+                        request_context.trace = trace
+                        set_request_context(request_context)
+                        if cache_hit:
+                            cached, score = cache_hit
+                            request_context.model = cached.model
+                            request_context.route_reason = f"语义缓存命中，相似度{score:.3f}"
+                            print(f"语义缓存命中: agent_id={agent_id}, 相似度: {score:.3f}")
                         print(f"发送到智能体的完整消息列表: {messages}")
                         
                         try:
-                            if stream_mode:
+                            if directives:
+                                print(f"多版本生成: agent_id={agent_id}, request_id={request_id}, 变体数: {len(directives)}")
+                                await stream_variants(
+                                    protocol,
+                                    agent,
+                                    request_id,
+                                    request_context,
+                                    messages,
+                                    directives,
+                                    rank=bool(message.get('rank', True)),
+                                    # 全部变体结束后把选中的变体写入对话历史
+                                    on_complete=lambda text, agent_id=agent_id, session_id=session_id: session_store.commit_reply(agent_id, session_id, text),
+                                )
+                            elif stream_mode:
                                 # 流式响应处理
-                                print(f"使用流式处理响应: agent_id={agent_id}")
-                                full_response = ""
-                                async for response_chunk in agent_manager.process_message_stream_with_history(agent_id, messages):
-                                    print(f"收到流式响应片段: {response_chunk[:30]+'...' if len(response_chunk)>30 else response_chunk}")
-                                    # 每次只发送新增的部分，而不是累积的全部内容
-                                    await websocket.send_json({
-                                        "type": "message_chunk",
-                                        "content": response_chunk,  # 只发送新的响应片段
-                                        "from": agent_id,
-                                        "is_final": False
-                                    })
-                                    full_response += response_chunk
-                                
-                                print(f"流式响应完成，发送最终消息")
-                                # 发送完成标记
-                                await websocket.send_json({
-                                    "type": "message",
-                                    "content": full_response,
-                                    "from": agent_id,
-                                    "is_final": True
-                                })
-                                
-                                # 添加智能体回复到对话历史
-                                chat_history[session_key].append({"role": "assistant", "content": full_response})
+                                print(f"使用流式处理响应: agent_id={agent_id}, request_id={request_id}")
+                                # 生成在后台任务中进行，连接断开后仍会在宽限期内继续，并在完成时写入对话历史
+                                if cache_hit:
+                                    # 缓存的回复已经过流式处理，直接回放
+                                    chunks = semantic_cache.replay(cached.response)
+                                else:
+                                    # 回复经过智能体配置的流式处理阶段后再推送与写入历史
+                                    chunks = stream_middleware.wrap(agent, agent_manager.process_message_stream_with_history(agent_id, messages))
+                                generation = generation_registry.start(
+                                    request_id,
+                                    agent_id,
+                                    request_context,
+                                    chunks,
+                                    # 添加智能体回复到对话历史
+                                    on_complete=lambda text, agent_id=agent_id, session_id=session_id: session_store.commit_reply(agent_id, session_id, text),
+                                )
+                                # 有期限的回复可能被截短，只读取缓存、不写入
+                                if cacheable and not cache_hit and deadline is None:
+                                    semantic_cache.remember(agent_id, content, generation)
+                                await stream_generation(protocol, generation, trace=trace)
+                                if verify and not generation.error:
+                                    # 回复发送完毕后运行其中的代码块，结果作为单独的帧发送
+                                    await verify_reply(protocol, agent_id, request_id, generation.text, trace)
                             else:
                                 # 传统的一次性响应
                                 print(f"使用传统一次性响应: agent_id={agent_id}")
-                                response = await agent_manager.process_message_with_history(agent_id, messages)
+                                if cache_hit:
+                                    response = cached.response
+                                else:
+                                    with trace.span("agent.generate", agent_id=agent_id):
+                                        if deadline is not None:
+                                            # 有期限时逐片段收集，到期后返回已生成的部分
+                                            response = "".join([chunk async for chunk in stop_at_deadline(
+                                                agent_manager.process_message_stream_with_history(agent_id, messages), request_context)])
+                                        else:
+                                            response = await agent_manager.process_message_with_history(agent_id, messages)
+                                    # abort模式命中违禁词时抛出ContentBlocked
+                                    response = stream_middleware.transform_text(agent, response)
+                                    if cacheable and response and deadline is None and request_context.upstream_error is None:
+                                        await asyncio.get_running_loop().run_in_executor(
+                                            None, semantic_cache.store, agent_id, content, response, request_context.model)
                                 print(f"收到一次性响应: {response[:50]+'...' if len(response)>50 else response}")
-                                await websocket.send_json({
-                                    "type": "message",
-                                    "content": response,
-                                    "from": agent_id
-                                })
+                                extra = {"model": request_context.model}
+                                if request_context.finish_reason:
+                                    extra["finish_reason"] = request_context.finish_reason
+                                if trace.trace_id:
+                                    extra["trace_id"] = trace.trace_id
+                                with trace.span("ws.send"):
+                                    await protocol.send_message(agent_id, response, **extra)
                                 
-                                # 添加智能体回复到对话历史
-                                chat_history[session_key].append({"role": "assistant", "content": response})
+                                # 添加智能体回复到对话历史（等待回复期间会话可能已换出）
+                                await session_store.commit_reply(agent_id, session_id, response)
+                                if verify:
+                                    await verify_reply(protocol, agent_id, request_id, response, trace)
+                            # 回复已发送，在空闲时把本轮加入检索索引
+                            retrieval_memory.schedule_update(session)
+                        except ContentBlocked as e:
+                            # 一次性响应命中违禁词：与流式生成一致，历史中只写入占位内容并发送中止错误
+                            print(f"回复命中违禁词已中止: request_id={request_id}")
+                            trace.root.end(str(e))
+                            await session_store.commit_reply(agent_id, session_id, BLOCKED_REPLY)
+                            await protocol.send_error(str(e))
                         except Exception as e:
                             error_msg = f"处理消息时发生错误: {str(e)}"
                             print(f"错误: {error_msg}")
-                            await websocket.send_json({
-                                "type": "error",
-                                "content": error_msg,
-                                "from": "system"
-                            })
+                            trace.root.end(error_msg)
+                            await protocol.send_error(error_msg)
+                        finally:
+                            trace.root.end()
                 else:
                     print("错误: 消息中缺少智能体ID")
-                    await websocket.send_json({
-                        "type": "error",
-                        "content": "消息中缺少智能体ID",
-                        "from": "system"
-                    })
+                    await protocol.send_error("消息中缺少智能体ID")
             except json.JSONDecodeError as e:
-                print(f"JSON解析错误: {str(e)}, 数据: {data}")
-                await websocket.send_json({
-                    "type": "error",
-                    "content": f"消息格式不正确: {str(e)}",
-                    "from": "system"
-                })
+                print(f"JSON解析错误: {str(e)}")
+                await protocol.send_error(f"消息格式不正确: {str(e)}")
+            except WebSocketDisconnect:
+                raise
             except Exception as e:
                 print(f"处理消息时发生未知错误: {str(e)}")
-                await websocket.send_json({
-                    "type": "error",
-                    "content": f"服务器错误: {str(e)}",
-                    "from": "system"
-                })
+                await protocol.send_error(f"服务器错误: {str(e)}")
+            finally:
+                if connection.busy:
+                    # 请求处理完毕，空闲超时从此刻重新计时
+                    connection.busy = False
+                    connection.touch()
+            if drain_controller.draining:
+                # 停机排空：当前请求已结束，提示客户端重连后关闭
+                await drain_controller.release(connection)
+                break
     except WebSocketDisconnect:
-        print(f"WebSocket连接已断开: client_id={client_id}")
-        if client_id in active_connections:
-            del active_connections[client_id]
+        print(f"WebSocket连接已断开: client_id={client_id}, connection_id={connection.id}")
     except Exception as e:
         print(f"WebSocket错误: {str(e)}")
-        if client_id in active_connections:
-            del active_connections[client_id]
+    finally:
+        connection_manager.unregister(connection)
 
 @app.get("/agents")
 async def get_agents():
@@ -244,6 +442,74 @@ async def get_agents():
         ]
     }
 
+# 历史消息分页的默认与最大条数
+HISTORY_PAGE_DEFAULT_LIMIT = 50
+HISTORY_PAGE_MAX_LIMIT = 200
+
+def encode_history_cursor(epoch: str, index: int) -> str:
+    return base64.urlsafe_b64encode(f"{epoch}:{index}".encode()).decode().rstrip("=")
+
+def decode_history_cursor(cursor: str, epoch: str) -> int:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        cursor_epoch, index = base64.urlsafe_b64decode(padded.encode()).decode().split(":")
+        if cursor_epoch != epoch:
+            raise ValueError("epoch mismatch")
+        return int(index)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="cursor无效或会话已被重建")
+
+def history_owner(request: Request, x_client_id: Optional[str] = Header(None),
+                  x_admin_token: Optional[str] = Header(None)) -> Optional[str]:
+    """历史接口的访问范围：携带X-Client-Id（与WebSocket路径中的client_id相同）时只能访问该客户端创建的会话，
+    否则需要管理员权限，可以访问全部会话（返回None）"""
+    if x_client_id:
+        return x_client_id
+    require_admin(request, x_admin_token)
+    return None
+
+@app.get("/sessions")
+async def list_sessions(request: Request, response: Response, agent_id: Optional[str] = None,
+                        owner: Optional[str] = Depends(history_owner)):
+    """
+    列出服务器端保存的会话，按最后活动时间倒序
+    """
+    etag = f'W/"sessions-{session_store.version}-{agent_id or ""}-{owner or ""}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return {"sessions": session_store.list_sessions(agent_id, owner)}
+
+@app.get("/sessions/{agent_id}/{session_id}/messages")
+async def get_session_messages(agent_id: str, session_id: str, request: Request, response: Response,
+                               cursor: Optional[str] = None, limit: int = HISTORY_PAGE_DEFAULT_LIMIT,
+                               owner: Optional[str] = Depends(history_owner)):
+    """
+    倒序分页获取会话历史：不带cursor时返回最新的limit条，next_cursor用于继续获取更早的消息
+    """
+    await session_store.ensure_loaded(agent_id, session_id)
+    session = session_store.get(agent_id, session_id)
+    # 其他客户端的会话同样返回404，不暴露会话是否存在
+    if not session or (owner is not None and session.owner != owner):
+        raise HTTPException(status_code=404, detail="会话不存在")
+    limit = max(1, min(limit, HISTORY_PAGE_MAX_LIMIT))
+    before = decode_history_cursor(cursor, session.epoch) if cursor else None
+    start, end, page = session_store.page(session, before, limit)
+    
+    # 历史只追加不修改，同一epoch下相同区间的内容不变，可直接作为ETag
+    etag = f'"{session.epoch}-{start}-{end}"'
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return {
+        "messages": [
+            {"index": start + i, "role": msg.role, "content": msg.content}
+            for i, msg in enumerate(page)
+        ],
+        "next_cursor": encode_history_cursor(session.epoch, start) if start > 0 else None,
+        "total": len(session.messages),
+    }
+
 # API Key验证相关的数据模型
 class ApiKeyRequest(BaseModel):
     api_key: str
@@ -257,41 +523,13 @@ async def validate_api_key(request: ApiKeyRequest):
     """
     验证DashScope API Key是否有效
     """
-    try:
-        # 临时设置API Key进行验证
-        original_key = dashscope.api_key
-        dashscope.api_key = request.api_key
-        
-        # 尝试调用一个简单的API来验证密钥
-        from dashscope import Generation
-        
-        response = Generation.call(
-            model='qwen-turbo',
-            prompt='测试',
-            max_tokens=10
-        )
-        
-        if response.status_code == 200:
-            # 验证成功，应用到agent_manager
-            agent_manager.set_api_key(request.api_key)
-            return ApiKeyResponse(valid=True, message="API Key验证成功")
-        else:
-            # 验证失败，恢复原来的API Key
-            dashscope.api_key = original_key
-            return ApiKeyResponse(valid=False, message=f"API Key验证失败: {response.message}")
-            
-    except Exception as e:
-        # 验证失败，恢复原来的API Key
-        if 'original_key' in locals():
-            dashscope.api_key = original_key
-        
-        error_msg = str(e)
-        if "Invalid API-key" in error_msg or "Unauthorized" in error_msg:
-            return ApiKeyResponse(valid=False, message="API Key无效")
-        elif "quota" in error_msg.lower():
-            return ApiKeyResponse(valid=False, message="API Key配额不足")
-        else:
-            return ApiKeyResponse(valid=False, message=f"验证过程中出现错误: {error_msg}")
+    # 验证在线程池中进行且密钥随请求传入，不阻塞事件循环，也不影响并发请求使用的全局密钥；
+    # 结果按密钥哈希短暂缓存，重复验证同一密钥不会每次都请求上游
+    valid, message = await api_key_validator.validate(request.api_key)
+    if valid:
+        # 验证成功，应用到agent_manager
+        agent_manager.set_api_key(request.api_key)
+    return ApiKeyResponse(valid=valid, message=message)
 
 @app.post("/api/set-key")
 async def set_api_key(request: ApiKeyRequest):
@@ -0,0 +1,217 @@
+import json
+import os
+from typing import Dict, List, Optional
+
+from backend.app.circuit_breaker import BreakerRegistry
+from backend.app.llm_client import llm_client
+
+# 各模型的上下文窗口（token），可通过路由配置文件覆盖
+MODEL_CONTEXT_WINDOWS: Dict[str, int] = {
+    "qwen-turbo": 8000,
+    "qwen-plus": 32000,
+    "qwen-max": 8000,
+}
+
+# 各模型的输出速度（token/秒），用于按请求期限选择模型与输出长度，可通过路由配置文件覆盖
+MODEL_OUTPUT_TOKENS_PER_SECOND: Dict[str, float] = {
+    "qwen-turbo": 80.0,
+    "qwen-plus": 40.0,
+    "qwen-max": 25.0,
+}
+# 未配置输出速度的模型按该值估算
+DEFAULT_OUTPUT_TOKENS_PER_SECOND = 30.0
+
+# 客户端未指定输出长度时预留的token数
+DEFAULT_OUTPUT_TOKENS = int(os.getenv("LLM_DEFAULT_OUTPUT_TOKENS", "1500"))
+
+# 首token时延样本不足时的估计值（秒）
+DEADLINE_DEFAULT_TTFT = float(os.getenv("LLM_DEADLINE_DEFAULT_TTFT", "1.0"))
+# 有期限的请求至少要能输出的token数，达不到时不再排队
+DEADLINE_MIN_OUTPUT_TOKENS = int(os.getenv("LLM_DEADLINE_MIN_OUTPUT_TOKENS", "16"))
+# 估算首token时延使用的分位数与最少样本数
+DEADLINE_TTFT_QUANTILE = 0.9
+DEADLINE_TTFT_MIN_SAMPLES = 20
+
+# 路由配置文件（JSON），格式见README
+ROUTING_CONFIG_PATH = os.getenv("LLM_ROUTING_CONFIG", "")
+
+
+def estimate_tokens(messages: List[Dict[str, str]]) -> int:
+    """粗略估算消息列表的token数：中文等非ASCII字符约1字1token，ASCII约4字符1token"""
+    total = 0
+    for msg in messages:
+        content = msg.get("content", "") or ""
+        ascii_chars = sum(1 for ch in content if ord(ch) < 128)
+        total += (len(content) - ascii_chars) + (ascii_chars + 3) // 4
+        # 每条消息的角色与分隔符开销
+        total += 4
+    return total
+
+
+class RoutingRule:
+    """一条路由规则：提示长度与输出长度都不超过上限时选择该模型"""
+    def __init__(self, model: str, max_prompt_tokens: Optional[int] = None, max_output_tokens: Optional[int] = None):
+        self.model = model
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_output_tokens = max_output_tokens
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "RoutingRule":
+        return cls(data["model"], data.get("max_prompt_tokens"), data.get("max_output_tokens"))
+
+    def matches(self, prompt_tokens: int, output_tokens: int) -> bool:
+        if self.max_prompt_tokens is not None and prompt_tokens > self.max_prompt_tokens:
+            return False
+        if self.max_output_tokens is not None and output_tokens > self.max_output_tokens:
+            return False
+        return True
+
+    def to_dict(self) -> Dict:
+        return {"model": self.model, "max_prompt_tokens": self.max_prompt_tokens, "max_output_tokens": self.max_output_tokens}
+
+
+# 默认规则：短对话用qwen-turbo，长对话切换到上下文更大的qwen-plus
+DEFAULT_RULES = [
+    RoutingRule("qwen-turbo", max_prompt_tokens=6000),
+    RoutingRule("qwen-plus"),
+]
+
+
+class RoutingDecision:
+    def __init__(self, model: str, prompt_tokens: int, output_tokens: int, reason: str,
+                 max_tokens: Optional[int] = None, queue_budget: Optional[float] = None):
+        self.model = model
+        self.prompt_tokens = prompt_tokens
+        self.output_tokens = output_tokens
+        self.reason = reason
+        # 按期限截短后的输出上限，未截短时为None
+        self.max_tokens = max_tokens
+        # 有期限时允许排队等待的最长时间（秒），不大于0表示已无法在期限内完成
+        self.queue_budget = queue_budget
+
+
+class ModelRouter:
+    """按智能体的路由规则，根据估算的提示长度、期望输出长度和模型健康度选择模型"""
+    def __init__(self, breakers: BreakerRegistry, config_path: str = ROUTING_CONFIG_PATH):
+        self.breakers = breakers
+        self.context_windows = dict(MODEL_CONTEXT_WINDOWS)
+        self.throughput = dict(MODEL_OUTPUT_TOKENS_PER_SECOND)
+        self.agent_rules: Dict[str, List[RoutingRule]] = {}
+        self.default_rules = list(DEFAULT_RULES)
+        if config_path:
+            self.load_config(config_path)
+
+    def load_config(self, path: str):
+        """从JSON文件加载路由配置"""
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        self.context_windows.update(config.get("context_windows", {}))
+        self.throughput.update(config.get("throughput", {}))
+        if "default" in config:
+            self.default_rules = [RoutingRule.from_dict(rule) for rule in config["default"]]
+        for agent_id, rules in config.get("agents", {}).items():
+            self.agent_rules[agent_id] = [RoutingRule.from_dict(rule) for rule in rules]
+        print(f"已加载模型路由配置: {path}")
+
+    def rules_for(self, agent) -> List[RoutingRule]:
+        """配置文件中的规则优先，其次是智能体自带规则，最后是默认规则"""
+        if agent.id in self.agent_rules:
+            return self.agent_rules[agent.id]
+        if getattr(agent, "routing_rules", None):
+            return agent.routing_rules
+        return self.default_rules
+
+    def fits(self, model: str, prompt_tokens: int, output_tokens: int) -> bool:
+        window = self.context_windows.get(model)
+        return window is None or prompt_tokens + output_tokens <= window
+
+    def expected_ttft(self, model: str) -> float:
+        """首token时延的估计：样本足够时取最近的p90，否则使用默认值"""
+        if llm_client.ttft.count(model) >= DEADLINE_TTFT_MIN_SAMPLES:
+            return llm_client.ttft.percentile(model, DEADLINE_TTFT_QUANTILE)
+        return DEADLINE_DEFAULT_TTFT
+
+    def affordable_tokens(self, model: str, remaining: float) -> int:
+        """剩余remaining秒内该模型预计能输出的token数"""
+        rate = self.throughput.get(model, DEFAULT_OUTPUT_TOKENS_PER_SECOND)
+        return max(0, int((remaining - self.expected_ttft(model)) * rate))
+
+    def queue_budget(self, model: str, remaining: float) -> float:
+        """排队等待的上限：开始调用后仍需留出首token时延与最少输出的时间"""
+        rate = self.throughput.get(model, DEFAULT_OUTPUT_TOKENS_PER_SECOND)
+        return remaining - self.expected_ttft(model) - DEADLINE_MIN_OUTPUT_TOKENS / rate
+
+    def _within_deadline(self, model: str, prompt_tokens: int, output_tokens: int, reason: str,
+                         remaining: float) -> RoutingDecision:
+        affordable = self.affordable_tokens(model, remaining)
+        if affordable < output_tokens:
+            return RoutingDecision(model, prompt_tokens, affordable, f"{reason}，按期限截短输出",
+                                   max_tokens=affordable, queue_budget=self.queue_budget(model, remaining))
+        return RoutingDecision(model, prompt_tokens, output_tokens, reason, queue_budget=self.queue_budget(model, remaining))
+
+    def route(self, agent, messages: List[Dict[str, str]], override: Optional[str] = None,
+              max_tokens: Optional[int] = None, deadline: Optional[float] = None) -> RoutingDecision:
+        """deadline为距离期限的剩余秒数：优先选择能在期限内完成的模型，都不能时选择期限内输出最多的模型并截短输出"""
+        prompt_tokens = estimate_tokens(messages)
+        output_tokens = max_tokens or DEFAULT_OUTPUT_TOKENS
+
+        # 请求级覆盖只允许已知模型，避免客户端随意指定高成本模型名
+        if override:
+            if override in self.context_windows:
+                if deadline is not None:
+                    return self._within_deadline(override, prompt_tokens, output_tokens, "请求指定", deadline)
+                return RoutingDecision(override, prompt_tokens, output_tokens, "请求指定")
+            print(f"忽略未知的模型覆盖: {override}")
+
+        rules = self.rules_for(agent)
+        if deadline is not None:
+            decision = self._route_deadline(rules, prompt_tokens, output_tokens, deadline)
+            if decision is None:
+                decision = self.route(agent, messages, max_tokens=max_tokens)
+                decision.queue_budget = self.queue_budget(decision.model, deadline)
+            return decision
+        first_match = None
+        for rule in rules:
+            if not rule.matches(prompt_tokens, output_tokens):
+                continue
+            if not self.fits(rule.model, prompt_tokens, output_tokens):
+                continue
+            if first_match is None:
+                first_match = rule.model
+            if self.breakers.is_available(rule.model):
+                return RoutingDecision(rule.model, prompt_tokens, output_tokens, "规则匹配")
+
+        if first_match:
+            # 匹配到的模型都不健康时仍交给熔断器沿降级链处理
+            return RoutingDecision(first_match, prompt_tokens, output_tokens, "规则匹配（模型不健康）")
+
+        # 没有规则能容纳该请求，选择上下文窗口最大的候选模型
+        candidates = [rule.model for rule in rules] or [agent.model]
+        largest = max(candidates, key=lambda m: self.context_windows.get(m, 0))
+        print(f"警告: 提示长度 {prompt_tokens} token 超出所有路由规则，使用 {largest}")
+        return RoutingDecision(largest, prompt_tokens, output_tokens, "超出规则上限")
+
+    def _route_deadline(self, rules: List[RoutingRule], prompt_tokens: int, output_tokens: int,
+                        remaining: float) -> Optional[RoutingDecision]:
+        """在健康的规则模型中按规则顺序选择第一个能在期限内完成的模型；没有时选择期限内输出最多的模型。
+        都无法输出最少token数时返回None，按无期限规则选择，并由排队上限拒绝该请求"""
+        best = None
+        for rule in rules:
+            if not self.breakers.is_available(rule.model):
+                continue
+            affordable = min(output_tokens, self.affordable_tokens(rule.model, remaining))
+            if affordable < DEADLINE_MIN_OUTPUT_TOKENS:
+                continue
+            if not rule.matches(prompt_tokens, affordable) or not self.fits(rule.model, prompt_tokens, affordable):
+                continue
+            if affordable == output_tokens:
+                return self._within_deadline(rule.model, prompt_tokens, output_tokens, "规则匹配，可在期限内完成", remaining)
+            if best is None or affordable > best[0]:
+                best = (affordable, rule.model)
+        if best is None:
+            return None
+        return self._within_deadline(best[1], prompt_tokens, output_tokens, "期限内输出最多的模型", remaining)
+
+
+# 创建全局模型路由实例，与上游客户端共享熔断器状态
+model_router = ModelRouter(llm_client.breakers)
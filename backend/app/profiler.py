@@ -0,0 +1,214 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter as StackCounter, deque
+from typing import Dict, List, Optional
+
+from backend.app.metrics import metrics
+
+# 事件循环被阻塞超过该时间（毫秒）时记录当时正在执行的调用栈
+LOOP_BLOCK_THRESHOLD_MS = float(os.getenv("LOOP_BLOCK_THRESHOLD_MS", "100"))
+LOOP_MONITOR_ENABLED = os.getenv("LOOP_MONITOR_ENABLED", "true").lower() == "true"
+# 保留的阻塞事件与延迟样本数量
+LOOP_BLOCK_HISTORY = 100
+LOOP_LAG_HISTORY = 2000
+
+PROFILE_MAX_SECONDS = 60.0
+PROFILE_DEFAULT_INTERVAL_MS = 10.0
+PROFILE_MAX_DEPTH = 128
+
+loop_lag_histogram = metrics.histogram("event_loop_lag_seconds", "事件循环调度延迟",
+                                       buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0))
+loop_blocked_counter = metrics.counter("event_loop_blocked_total", "事件循环被阻塞超过阈值的次数")
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+    # 第三方库保留site-packages之后的路径，项目代码保留backend之后的路径，便于阅读火焰图
+    if "site-packages" + os.sep in filename:
+        filename = filename.split("site-packages" + os.sep, 1)[1]
+    elif os.sep + "backend" + os.sep in filename:
+        filename = "backend" + os.sep + filename.rsplit(os.sep + "backend" + os.sep, 1)[1]
+    else:
+        filename = os.path.basename(filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})"
+
+
+def collapse_stack(frame) -> List[str]:
+    """把帧链转换为从根到叶的标签列表"""
+    labels = []
+    while frame is not None and len(labels) < PROFILE_MAX_DEPTH:
+        labels.append(_frame_label(frame))
+        frame = frame.f_back
+    labels.reverse()
+    return labels
+
+
+def _thread_cpu_time(ident: int) -> Optional[float]:
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError, ProcessLookupError):
+        return None
+
+
+def cpu_mode_supported() -> bool:
+    return _thread_cpu_time(threading.get_ident()) is not None
+
+
+class SamplingProfiler:
+    """在独立线程中周期性采集所有线程的调用栈；wall模式统计全部样本，cpu模式只统计期间消耗了CPU的线程"""
+    def __init__(self, mode: str = "wall", interval: float = PROFILE_DEFAULT_INTERVAL_MS / 1000):
+        self.mode = mode
+        self.interval = interval
+        self.stacks: StackCounter = StackCounter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._cpu_times: Dict[int, float] = {}
+        # 每个线程尚未计入样本的CPU时间（以采样间隔为单位的小数部分）
+        self._cpu_carry: Dict[int, float] = {}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                weight = 1
+                if self.mode == "cpu":
+                    # 按两次采样之间线程消耗的CPU时间计权（以采样间隔为单位），空闲线程不计入；
+                    # 不足一个间隔的部分累积到下次，只占用零点几个核的线程也会按实际CPU时间计入
+                    cpu = _thread_cpu_time(ident)
+                    previous = self._cpu_times.get(ident)
+                    self._cpu_times[ident] = cpu
+                    if cpu is None or previous is None:
+                        continue
+                    carry = self._cpu_carry.get(ident, 0.0) + (cpu - previous) / self.interval
+                    weight = int(carry)
+                    self._cpu_carry[ident] = carry - weight
+                    if weight <= 0:
+                        continue
+                stack = [names.get(ident, f"thread-{ident}")] + collapse_stack(frame)
+                self.stacks[";".join(stack)] += weight
+            self.samples += 1
+
+    def collapsed(self) -> str:
+        """flamegraph.pl / speedscope可读取的折叠栈格式：每行“帧;帧;帧 计数”"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+class LoopMonitor:
+    """测量事件循环调度延迟，并在循环被阻塞时由看门狗线程抓取循环线程的调用栈"""
+    def __init__(self, threshold_ms: float = LOOP_BLOCK_THRESHOLD_MS):
+        self.threshold = threshold_ms / 1000
+        self.lags: deque = deque(maxlen=LOOP_LAG_HISTORY)
+        self.blocks: deque = deque(maxlen=LOOP_BLOCK_HISTORY)
+        self._heartbeat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._current_block: Optional[Dict] = None
+
+    @property
+    def interval(self) -> float:
+        # 心跳间隔取阈值的四分之一，保证超过阈值的阻塞都能被看门狗发现
+        return max(0.005, self.threshold / 4)
+
+    def start(self):
+        if self._task is not None and not self._task.done():
+            return
+        self._loop_thread = threading.get_ident()
+        self._heartbeat = time.monotonic()
+        self._task = asyncio.create_task(self._beat())
+        if self._watchdog is None:
+            self._watchdog = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+            self._watchdog.start()
+
+    async def _beat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self._heartbeat = now
+            self.lags.append((time.time(), lag))
+            loop_lag_histogram.observe(lag)
+
+    def _watch(self):
+        while True:
+            time.sleep(self.interval)
+            stalled = time.monotonic() - self._heartbeat
+            block = self._current_block
+            if stalled >= self.threshold:
+                if block is None:
+                    frame = sys._current_frames().get(self._loop_thread)
+                    block = {
+                        "started_at": time.time() - stalled,
+                        "duration_ms": stalled * 1000,
+                        # 阻塞期间循环线程正在执行的代码，通常直接指向同步调用所在位置
+                        "stack": traceback.format_stack(frame) if frame else [],
+                    }
+                    self._current_block = block
+                    self.blocks.append(block)
+                    loop_blocked_counter.inc()
+                else:
+                    block["duration_ms"] = stalled * 1000
+            elif block is not None:
+                self._current_block = None
+
+    def report(self, since: float = 0.0, min_block_ms: float = 0.0) -> Dict:
+        lags = sorted(lag for ts, lag in list(self.lags) if ts >= since)
+
+        def percentile(q: float) -> Optional[float]:
+            if not lags:
+                return None
+            return round(lags[min(len(lags) - 1, int(q * len(lags)))] * 1000, 3)
+
+        return {
+            "threshold_ms": self.threshold * 1000,
+            "lag_samples": len(lags),
+            "lag_p50_ms": percentile(0.5),
+            "lag_p99_ms": percentile(0.99),
+            "lag_max_ms": round(lags[-1] * 1000, 3) if lags else None,
+            "blocked": [
+                dict(block, duration_ms=round(block["duration_ms"], 1))
+                for block in list(self.blocks)
+                if block["started_at"] + block["duration_ms"] / 1000 >= since and block["duration_ms"] >= min_block_ms
+            ],
+        }
+
+
+_profile_lock = asyncio.Lock()
+
+
+async def run_profile(seconds: float, mode: str = "wall", interval_ms: float = PROFILE_DEFAULT_INTERVAL_MS) -> SamplingProfiler:
+    """在不阻塞事件循环的前提下采样seconds秒；同一时间只允许一个采样任务"""
+    if _profile_lock.locked():
+        raise RuntimeError("已有采样任务在运行")
+    async with _profile_lock:
+        profiler = SamplingProfiler(mode, interval_ms / 1000)
+        profiler.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            # 采样线程最多再运行一个间隔，放到线程池中等待它退出
+            await asyncio.get_running_loop().run_in_executor(None, profiler.stop)
+        return profiler
+
+
+# 创建全局事件循环监控实例
+loop_monitor = LoopMonitor()
@@ -0,0 +1,315 @@
+import json
+import zlib
+from typing import Dict, List, Optional
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from backend.app.send_queue import SendQueue
+
+try:
+    import msgpack
+except ImportError:  # MessagePack为可选依赖，未安装时只提供JSON帧
+    msgpack = None
+
+# WebSocket子协议名称
+SUBPROTOCOL_V1 = "agent.v1"
+SUBPROTOCOL_V2_JSON = "agent.v2.json"
+SUBPROTOCOL_V2_MSGPACK = "agent.v2.msgpack"
+
+# v2帧类型
+FRAME_START = "s"
+FRAME_CHUNK = "c"
+FRAME_END = "e"
+FRAME_MESSAGE = "m"
+FRAME_ERROR = "x"
+FRAME_SNAPSHOT = "p"
+FRAME_VARIANTS = "v"
+FRAME_HELLO = "h"
+FRAME_PING = "pi"
+FRAME_PONG = "po"
+FRAME_RESUME = "rs"
+FRAME_RECONNECT = "rc"
+FRAME_CODE_RESULT = "k"
+
+# 客户端发送的心跳消息类型，不写入日志
+HEARTBEAT_TYPES = ("ping", "pong")
+
+# v1附加字段在v2中的缩写
+COMPACT_KEYS = {
+    "model": "m",
+    "request_id": "r",
+    "trace_id": "tr",
+    "variant": "ch",
+    "finish_reason": "fr",
+}
+
+
+def _compact(extra: Dict) -> Dict:
+    return {COMPACT_KEYS.get(key, key): value for key, value in extra.items() if value is not None}
+
+
+class StreamDigest:
+    """增量计算回复的UTF-8字节长度与CRC32，v2的结束帧只携带这两个值"""
+    def __init__(self):
+        self.length = 0
+        self.crc = 0
+
+    def update(self, text: str):
+        data = text.encode("utf-8")
+        self.length += len(data)
+        self.crc = zlib.crc32(data, self.crc)
+
+
+class ProtocolV1:
+    """v1协议：JSON文本帧，最终消息重复完整回复，供当前前端使用"""
+    version = 1
+    subprotocol: Optional[str] = None
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        # 连接注册后启用有界发送队列，之前（以及未注册的连接）直接写套接字
+        self.queue: Optional[SendQueue] = None
+
+    def attach_queue(self) -> SendQueue:
+        self.queue = SendQueue(self._write, self.merge_chunk, self.resume_frame, self._close)
+        return self.queue
+
+    async def _write(self, frame: Dict):
+        await self.websocket.send_json(frame)
+
+    async def _close(self, code: int, reason: str):
+        await self.websocket.close(code=code, reason=reason)
+
+    async def _send(self, frame: Dict, request_id: Optional[str] = None, seq: Optional[int] = None,
+                    mergeable: bool = False):
+        """发送一帧；request_id与seq用于积压时合并片段与生成续传令牌，seq为None的帧表示该回复已结束"""
+        if self.queue is None:
+            await self._write(frame)
+            return
+        size = sum(len(value) for value in frame.values() if isinstance(value, str))
+        self.queue.put(frame, request_id, seq, size, mergeable)
+
+    @staticmethod
+    def merge_chunk(queued: Dict, frame: Dict, seq: Optional[int]):
+        """把新片段合并到已排队的片段帧，序号取合并后最后一个片段的序号"""
+        queued["content"] += frame["content"]
+        queued["seq"] = seq
+
+    @staticmethod
+    def resume_frame(tokens: List[Dict]) -> Dict:
+        """因发送过慢断开前发送的续传令牌：各进行中回复的请求ID与下一个未发送的序号"""
+        return {"type": "resume_required", "resume": tokens}
+
+    async def receive(self) -> Dict:
+        data = await self.websocket.receive_text()
+        message = json.loads(data)
+        if message.get("type") not in HEARTBEAT_TYPES:
+            print(f"收到原始数据: {data}")
+        return message
+
+    async def send_hello(self, connection_id: str, heartbeat: float):
+        """连接建立后告知客户端本连接的ID与心跳间隔"""
+        await self._send({
+            "type": "connected",
+            "connection_id": connection_id,
+            "heartbeat": heartbeat
+        })
+
+    async def send_ping(self):
+        await self._send({"type": "ping"})
+
+    async def send_reconnect(self, after_ms: int, reason: str):
+        """服务器即将停机：提示客户端在after_ms毫秒后重连（由负载均衡转到其他实例或重启后的进程）"""
+        await self._send({"type": "reconnect", "after_ms": after_ms, "reason": reason})
+
+    async def send_pong(self):
+        await self._send({"type": "pong"})
+
+    async def send_start(self, agent_id: str, request_id: str, offset: int = 0, channel: Optional[int] = None):
+        """v1没有开始帧，请求ID与序号随每个片段发送"""
+
+    async def send_chunk(self, agent_id: str, content: str, request_id: str, seq: int, channel: Optional[int] = None):
+        frame = {
+            "type": "message_chunk",
+            "content": content,
+            "from": agent_id,
+            "is_final": False,
+            "request_id": request_id,
+            "seq": seq
+        }
+        if channel is not None:
+            # 多版本生成时标明片段所属的变体
+            frame["variant"] = channel
+        await self._send(frame, request_id, seq, mergeable=True)
+
+    async def send_snapshot(self, agent_id: str, content: str, request_id: str, seq: int, channel: Optional[int] = None):
+        """续传偏移早于缓冲区时，发送截至seq的完整内容，客户端用它替换已收到的部分"""
+        frame = {
+            "type": "message_snapshot",
+            "content": content,
+            "from": agent_id,
+            "request_id": request_id,
+            "seq": seq
+        }
+        if channel is not None:
+            frame["variant"] = channel
+        await self._send(frame, request_id, seq)
+
+    async def send_end(self, agent_id: str, full_response: str, digest: StreamDigest, **extra):
+        await self._send(dict({
+            "type": "message",
+            "content": full_response,
+            "from": agent_id,
+            "is_final": True
+        }, **extra), extra.get("request_id"))
+
+    async def send_message(self, agent_id: str, content: str, **extra):
+        await self._send(dict({
+            "type": "message",
+            "content": content,
+            "from": agent_id
+        }, **extra))
+
+    async def send_variants(self, agent_id: str, request_id: str, chosen: int, ranking: List[Dict]):
+        """所有变体结束后发送评分排名，chosen为写入对话历史的变体"""
+        await self._send({
+            "type": "variants_ranked",
+            "from": agent_id,
+            "request_id": request_id,
+            "chosen": chosen,
+            "ranking": ranking
+        })
+
+    async def send_code_result(self, agent_id: str, request_id: str, block: int, result: Dict):
+        """回复中第block个代码块在沙箱中的运行结果"""
+        await self._send({
+            "type": "code_result",
+            "from": agent_id,
+            "request_id": request_id,
+            "block": block,
+            "status": result["status"],
+            "stdout": result["stdout"],
+            "stderr": result["stderr"],
+            "result": result.get("result"),
+            "duration_ms": result.get("duration_ms")
+        })
+
+    async def send_error(self, content: str):
+        await self._send({
+            "type": "error",
+            "content": content,
+            "from": "system"
+        })
+
+
+class ProtocolV2(ProtocolV1):
+    """v2协议：紧凑信封，开始帧声明来源，片段帧只带内容，结束帧只带长度与校验和"""
+    version = 2
+
+    def __init__(self, websocket: WebSocket, binary: bool = False):
+        super().__init__(websocket)
+        self.binary = binary
+        self.subprotocol = SUBPROTOCOL_V2_MSGPACK if binary else SUBPROTOCOL_V2_JSON
+
+    async def _write(self, frame: Dict):
+        if self.binary:
+            await self.websocket.send_bytes(msgpack.packb(frame, use_bin_type=True))
+        else:
+            await self.websocket.send_text(json.dumps(frame, ensure_ascii=False, separators=(",", ":")))
+
+    async def receive(self) -> Dict:
+        message = await self.websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        if message.get("bytes") is not None:
+            if msgpack is None:
+                raise ValueError("服务器未安装msgpack，无法解析二进制帧")
+            return msgpack.unpackb(message["bytes"], raw=False)
+        data = message.get("text") or ""
+        parsed = json.loads(data)
+        if parsed.get("type") not in HEARTBEAT_TYPES:
+            print(f"收到原始数据: {data}")
+        return parsed
+
+    async def send_hello(self, connection_id: str, heartbeat: float):
+        await self._send({"t": FRAME_HELLO, "id": connection_id, "hb": heartbeat})
+
+    async def send_ping(self):
+        await self._send({"t": FRAME_PING})
+
+    async def send_reconnect(self, after_ms: int, reason: str):
+        await self._send({"t": FRAME_RECONNECT, "a": after_ms, "d": reason})
+
+    async def send_pong(self):
+        await self._send({"t": FRAME_PONG})
+
+    @staticmethod
+    def merge_chunk(queued: Dict, frame: Dict, seq: Optional[int]):
+        """合并后的片段帧携带最后一个片段的序号n，客户端据此校正自行计数的序号"""
+        queued["d"] += frame["d"]
+        queued["n"] = seq
+
+    @staticmethod
+    def resume_frame(tokens: List[Dict]) -> Dict:
+        return {"t": FRAME_RESUME, "k": [{"r": token["request_id"], "o": token["offset"]} for token in tokens]}
+
+    async def send_start(self, agent_id: str, request_id: str, offset: int = 0, channel: Optional[int] = None):
+        frame = {"t": FRAME_START, "f": agent_id, "r": request_id}
+        if offset:
+            frame["o"] = offset
+        if channel is not None:
+            frame["ch"] = channel
+        await self._send(frame)
+
+    async def send_chunk(self, agent_id: str, content: str, request_id: str, seq: int, channel: Optional[int] = None):
+        # 片段序号由客户端从开始帧的偏移起自行计数，不随片段发送；多个变体交错发送时用ch区分
+        frame = {"t": FRAME_CHUNK, "d": content}
+        if channel is not None:
+            frame["ch"] = channel
+        await self._send(frame, request_id, seq, mergeable=True)
+
+    async def send_snapshot(self, agent_id: str, content: str, request_id: str, seq: int, channel: Optional[int] = None):
+        frame = {"t": FRAME_SNAPSHOT, "d": content, "n": seq}
+        if channel is not None:
+            frame["ch"] = channel
+        await self._send(frame, request_id, seq)
+
+    async def send_end(self, agent_id: str, full_response: str, digest: StreamDigest, **extra):
+        await self._send(dict({"t": FRAME_END, "len": digest.length, "crc": digest.crc}, **_compact(extra)),
+                         extra.get("request_id"))
+
+    async def send_message(self, agent_id: str, content: str, **extra):
+        await self._send(dict({"t": FRAME_MESSAGE, "f": agent_id, "d": content}, **_compact(extra)))
+
+    async def send_variants(self, agent_id: str, request_id: str, chosen: int, ranking: List[Dict]):
+        await self._send({"t": FRAME_VARIANTS, "r": request_id, "c": chosen, "k": ranking})
+
+    async def send_code_result(self, agent_id: str, request_id: str, block: int, result: Dict):
+        frame = {"t": FRAME_CODE_RESULT, "r": request_id, "b": block, "st": result["status"],
+                 "o": result["stdout"], "er": result["stderr"], "ms": result.get("duration_ms")}
+        if result.get("result") is not None:
+            frame["v"] = result["result"]
+        await self._send(frame)
+
+    async def send_error(self, content: str):
+        await self._send({"t": FRAME_ERROR, "d": content})
+
+
+def negotiate_protocol(websocket: WebSocket) -> ProtocolV1:
+    """根据WebSocket子协议或查询参数protocol协商协议版本，默认v1"""
+    offered = websocket.scope.get("subprotocols") or []
+    if SUBPROTOCOL_V2_MSGPACK in offered and msgpack is not None:
+        return ProtocolV2(websocket, binary=True)
+    if SUBPROTOCOL_V2_JSON in offered:
+        return ProtocolV2(websocket)
+    requested = websocket.query_params.get("protocol", "")
+    if requested == "v2":
+        binary = websocket.query_params.get("encoding") == "msgpack" and msgpack is not None
+        protocol = ProtocolV2(websocket, binary=binary)
+        # 通过查询参数协商时不设置子协议响应头
+        protocol.subprotocol = None
+        return protocol
+    protocol = ProtocolV1(websocket)
+    if SUBPROTOCOL_V1 in offered:
+        protocol.subprotocol = SUBPROTOCOL_V1
+    return protocol
@@ -0,0 +1,208 @@
+import re
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from backend.app.vector_index import EMBEDDING_DIM, embed_features
+
+# 编程提问的常用说法：规范词 -> 同义的其他说法。提取时最长匹配优先（“去除重复”先于“去除”）
+SYNONYMS: Dict[str, Tuple[str, ...]] = {
+    "反转": ("倒序", "逆序", "翻转", "颠倒", "倒过来", "反过来", "reverse", "reversed"),
+    "去重": ("去除重复", "删除重复", "去掉重复", "删掉重复", "移除重复", "重复的去掉", "重复元素去掉", "dedup"),
+    "删除": ("移除", "去掉", "去除", "删掉", "剔除", "清除", "remove", "delete", "del", "pop"),
+    "添加": ("增加", "加入", "追加", "append", "add"),
+    "插入": ("insert",),
+    "排序": ("排列", "sort", "sorted"),
+    "升序": ("从小到大", "由小到大", "正序", "ascending"),
+    "降序": ("从大到小", "由大到小", "descending"),
+    "列表": ("list", "数组"),
+    "字典": ("dict", "dictionary", "哈希表"),
+    "字符串": ("字串", "str", "string"),
+    "元组": ("tuple",),
+    "集合": ("set",),
+    "整数": ("int", "整型"),
+    "浮点数": ("float", "小数"),
+    "键": ("key", "keys", "键名"),
+    "值": ("value", "values", "数值"),
+    "读取": ("读入", "读", "加载", "载入", "read", "load"),
+    "写入": ("写到", "写", "保存为", "保存到", "保存", "存储", "存入", "存为", "write", "save", "dump"),
+    "文件": ("file",),
+    "目录": ("文件夹", "folder", "dir", "directory"),
+    "转换": ("转换成", "转换为", "转成", "转为", "转化为", "转化", "变成", "转", "convert"),
+    "合并": ("拼接", "merge", "concat"),
+    "拆分": ("分割", "切分", "切割", "split"),
+    "获取": ("得到", "取得", "拿到", "获得", "求", "取出", "取", "get"),
+    "判断": ("检查", "检测", "确认", "验证", "check"),
+    "存在": ("存不存在", "有没有"),
+    "为空": ("是空的", "是不是空", "为空值", "空的", "empty"),
+    "长度": ("元素个数", "多长", "len", "length"),
+    "遍历": ("迭代", "iterate"),
+    "格式化": ("format",),
+    "替换": ("替代", "replace"),
+    "统计": ("计数", "计算个数", "count"),
+    "查找": ("搜索", "寻找", "find", "search"),
+    "复制": ("拷贝", "copy"),
+    "捕获": ("捕捉", "catch"),
+    "暂停": ("休眠", "睡眠", "等待", "sleep"),
+    "生成": ("产生", "创建", "新建", "generate", "create"),
+    "所有": ("全部", "全体", "all"),
+    "当前": ("现在的", "现在", "此刻"),
+    "开头": ("第一", "首个", "头部", "最前面", "最开始", "首"),
+    "末尾": ("最后", "结尾", "尾部", "最末"),
+    "两端": ("首尾", "两边", "两头"),
+    "逐行": ("每一行", "每行", "一行一行"),
+    "扩展名": ("后缀名", "后缀", "extension"),
+    "运行": ("执行", "run"),
+    "求和": ("总和", "之和", "的和", "加总", "sum"),
+    "最大值": ("最大", "max"),
+    "最小值": ("最小", "min"),
+    "大写": ("upper",),
+    "小写": ("lower",),
+    "时间": ("time",),
+    "日期": ("date",),
+    "随机数": ("random",),
+    "函数": ("function",),
+    "异常": ("exception",),
+    "对象": ("object",),
+    "返回值": ("return",),
+    "转义": ("escape",),
+    "重复": ("重复元素", "重复项", "重复值", "重复的"),
+}
+# 分开出现时合起来才是一个意思的词：“删除……重复元素”即去重
+COMPOUNDS = {("删除", "重复"): "去重"}
+# 包含上面某个词、但不表示该含义的说法（“进行”中的“行”、“怎么写”中的“写”），提取后丢弃
+IGNORED = ("进行", "行不行", "不行", "可行", "首先", "写法")
+# 只在句末忽略的说法（“格式化怎么写”，而“怎么写入”仍是写入）
+IGNORED_AT_END = ("怎么写", "如何写")
+
+# 互斥的词：两个提问的含义常常只差在这些词上（升序/降序、第一行/最后一行、读取/写入……），
+# 只有包含完全相同的这些词时才可能是同一问题
+CONTRAST_GROUPS: Tuple[Tuple[str, ...], ...] = (
+    ("升序", "降序", "反转"),
+    ("读取", "写入", "删除", "添加", "插入", "复制", "替换", "查找", "合并", "拆分", "去重"),
+    ("开头", "末尾", "两端"),
+    ("最大值", "最小值", "平均值", "中位数", "众数", "求和"),
+    ("大写", "小写"),
+    ("键", "值"),
+    ("行", "列"),
+    ("列表", "字典", "字符串", "元组", "集合", "整数", "浮点数", "时间戳", "日期", "时间"),
+    # 文件是默认的操作对象，只有提到目录时含义才不同
+    ("目录",),
+    ("加密", "解密"),
+    ("压缩", "解压"),
+    ("编码", "解码"),
+    ("序列化", "反序列化"),
+    ("上传", "下载"),
+    ("安装", "卸载", "升级", "降级"),
+    ("打开", "关闭"),
+    ("启动", "停止"),
+    ("同步", "异步"),
+    ("进程", "线程", "协程"),
+    ("深拷贝", "浅拷贝"),
+    ("交集", "并集", "差集"),
+    ("绝对路径", "相对路径"),
+    ("大小", "文件名", "扩展名", "修改时间", "创建时间"),
+    ("奇数", "偶数"),
+    ("单词", "字符"),
+    ("天数", "小时", "分钟", "秒", "毫秒", "微秒"),
+)
+CONTRAST_TERMS = frozenset(term for group in CONTRAST_GROUPS for term in group)
+# 出现“转换”时这些类型词与英文标识符的先后顺序表示转换方向（列表转字符串与字符串转列表不同）
+TYPE_TERMS = frozenset(CONTRAST_GROUPS[7])
+
+# 不影响语义的虚词与说法，在提取词语之后从剩余文本中去掉
+_FILLER = re.compile("请问|怎么样|怎么办|怎么|怎样|如何|一下|一个|可以|能否|能不能|是否|是不是|吗|呢|吧|啊|的|了|"
+                     "把|将|对|给|从|在|用|使用|里面|里|中|按照|按|根据|来|进行|实现|做|写法|代码|方式|办法")
+# 提问对象本身是Python时不影响语义（python2/python3除外）
+_DOMAIN = re.compile(r"python(?![\d.])")
+_ASCII_WORD = re.compile(r"[a-z_][a-z0-9_.+#-]*[a-z0-9_+#]|[a-z]")
+_NUMBER = re.compile(r"\d+(?:\.\d+)?|[零〇一二两三四五六七八九十百千万]+")
+_SPACES = re.compile(r"[\W_]+")
+
+# 规范词与剩余文本的n-gram权重：词语区分度高，单字区分度低
+TERM_WEIGHT = 1.5
+NGRAM_WEIGHTS = {1: 0.5, 2: 1.0}
+
+
+def _build_lexicon():
+    canonical: Dict[str, str] = {}
+    for term, variants in SYNONYMS.items():
+        canonical[term] = term
+        for variant in variants:
+            canonical[variant] = term
+    for term in CONTRAST_TERMS:
+        canonical.setdefault(term, term)
+    for phrase in IGNORED + IGNORED_AT_END:
+        canonical[phrase] = ""
+    patterns = []
+    for term in sorted(canonical, key=len, reverse=True):
+        escaped = re.escape(term)
+        if term.isascii():
+            # 英文词需要完整匹配，避免list匹配到listdir
+            escaped = rf"(?<![a-z0-9_]){escaped}(?![a-z0-9_])"
+        elif term in IGNORED_AT_END:
+            escaped = rf"{escaped}(?=[\W_]|$)"
+        patterns.append(escaped)
+    return canonical, re.compile("|".join(patterns))
+
+
+_CANONICAL, _LEXICON = _build_lexicon()
+
+
+class QueryTerms:
+    """一条提问的分析结果：vector用于相似度检索，guard相同的两条提问才可能是同一问题"""
+    __slots__ = ("terms", "vector", "guard")
+
+    def __init__(self, terms: List[str], vector, guard: Tuple):
+        self.terms = terms
+        self.vector = vector
+        self.guard = guard
+
+
+def _segment_features(segment: str, features: Dict[str, float], words: List[str], numbers: List[str]):
+    # 先去掉虚词，“一个”“一下”中的“一”不算数字
+    segment = _FILLER.sub(" ", segment)
+    for word in _ASCII_WORD.findall(segment):
+        words.append(word)
+    numbers.extend(_NUMBER.findall(_ASCII_WORD.sub(" ", segment)))
+    for part in _SPACES.split(_ASCII_WORD.sub(" ", segment)):
+        for n, weight in NGRAM_WEIGHTS.items():
+            for i in range(len(part) - n + 1):
+                key = "c:" + part[i:i + n]
+                features[key] = features.get(key, 0.0) + weight
+
+
+def analyze(prompt: str, dim: int = EMBEDDING_DIM) -> QueryTerms:
+    """按词典提取规范词（与顺序无关），剩余文本在各自片段内取字符n-gram；
+    同时记下互斥词、英文标识符（库名、格式等）、数字以及转换方向作为guard"""
+    text = _DOMAIN.sub(" ", prompt.lower())
+    features: Dict[str, float] = {}
+    terms: List[str] = []
+    numbers: List[str] = []
+    # 规范词与英文标识符按出现顺序排列，用于判断转换方向
+    sequence: List[str] = []
+    position = 0
+    for match in _LEXICON.finditer(text):
+        _segment_features(text[position:match.start()], features, sequence, numbers)
+        term = _CANONICAL[match.group()]
+        position = match.end()
+        if term:
+            terms.append(term)
+            sequence.append(term)
+    _segment_features(text[position:], features, sequence, numbers)
+    for (first, second), combined in COMPOUNDS.items():
+        if first in terms and second in terms:
+            terms = [term for term in terms if term not in (first, second)] + [combined]
+    words = [item for item in sequence if item not in _CANONICAL]
+    for item in terms + words:
+        key = ("t:" if item in _CANONICAL else "w:") + item
+        features[key] = features.get(key, 0.0) + TERM_WEIGHT
+
+    contrast: FrozenSet[str] = frozenset(term for term in terms if term in CONTRAST_TERMS)
+    direction: Optional[Tuple[str, ...]] = None
+    if "转换" in terms:
+        ordered = []
+        for item in sequence:
+            if (item in TYPE_TERMS or item in words) and item not in ordered:
+                ordered.append(item)
+        direction = tuple(ordered)
+    guard = (contrast, direction, frozenset(words), tuple(sorted(numbers)))
+    return QueryTerms(terms, embed_features(features, dim), guard)
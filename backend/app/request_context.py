@@ -0,0 +1,49 @@
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from backend.app.tracing import NOOP_TRACE
+
+
+class RequestContext:
+    """单次生成请求的上下文，在WebSocket处理函数与智能体调用链之间传递请求级参数"""
+    def __init__(self, agent_id: Optional[str] = None, session_id: Optional[str] = None,
+                 model_override: Optional[str] = None, max_tokens: Optional[int] = None,
+                 client_id: Optional[str] = None, priority: str = "interactive", deadline: Optional[float] = None):
+        self.agent_id = agent_id
+        self.session_id = session_id
+        self.client_id = client_id  # 发起请求的客户端，用于公平调度
+        self.priority = priority  # 调度优先级，见scheduler.PRIORITIES
+        self.model_override = model_override  # 客户端指定的模型
+        self.max_tokens = max_tokens  # 客户端期望的最大输出长度
+        self.deadline = deadline  # 回复必须结束的时刻（time.monotonic），见deadline
+        self.start_by: Optional[float] = None  # 最晚开始上游调用的时刻，排队超过该时刻放弃请求
+        self.finish_reason: Optional[str] = None  # 回复提前结束的原因，如"deadline"
+        self.model: Optional[str] = None  # 实际调用的模型（含熔断降级后的结果）
+        self.upstream_error: Optional[str] = None  # 上游调用失败的原因，此时回复即使有内容也不写入语义缓存
+        self.route_reason: Optional[str] = None
+        self.prompt_tokens: Optional[int] = None
+        self.trace = NOOP_TRACE  # 请求的trace，未采样时为空实现
+
+    def remaining(self) -> Optional[float]:
+        """距离期限的剩余秒数，未设置期限时返回None"""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.monotonic()
+
+
+_current_request: ContextVar[Optional[RequestContext]] = ContextVar("current_request", default=None)
+
+
+def set_request_context(context: RequestContext):
+    """设置当前请求上下文，返回用于恢复的token"""
+    return _current_request.set(context)
+
+
+def reset_request_context(token):
+    _current_request.reset(token)
+
+
+def get_request_context() -> Optional[RequestContext]:
+    """获取当前请求上下文，不在请求中时返回None"""
+    return _current_request.get()
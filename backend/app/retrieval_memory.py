@@ -0,0 +1,152 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from backend.app.metrics import metrics
+from backend.app.model_router import estimate_tokens
+from backend.app.vector_index import VectorIndex, embed_text
+
+if TYPE_CHECKING:
+    from backend.app.session_store import Message, Session
+
+# 检索模式下始终保留的最近轮数，以及最多检索的旧轮数
+MEMORY_RECENT_TURNS = int(os.getenv("MEMORY_RECENT_TURNS", "4"))
+MEMORY_RETRIEVED_TURNS = int(os.getenv("MEMORY_RETRIEVED_TURNS", "4"))
+# 检索模式下历史消息的token预算：最近轮次必定保留，检索到的旧轮次按相关度填入剩余预算
+MEMORY_TOKEN_BUDGET = int(os.getenv("MEMORY_TOKEN_BUDGET", "4000"))
+# 相关度低于该值的旧轮次不加入
+MEMORY_MIN_SCORE = float(os.getenv("MEMORY_MIN_SCORE", "0.1"))
+# 请求等待索引补齐的最长时间（毫秒）：会话从磁盘载入后需要重建索引，超时后先用已索引的轮次检索，补齐在后台继续
+MEMORY_INDEX_WAIT_MS = int(os.getenv("MEMORY_INDEX_WAIT_MS", "50"))
+# 每轮参与嵌入的提问与回复的最大字符数，限制长回复的索引开销
+EMBED_MAX_CHARS = 1000
+# 每次在线程中嵌入的轮数，批次之间把新向量写入索引
+EMBED_BATCH_TURNS = 32
+
+memory_retrieved_counter = metrics.counter("memory_retrieved_turns_total", "检索模式加入请求的旧轮次数")
+memory_omitted_counter = metrics.counter("memory_omitted_turns_total", "检索模式未发送的旧轮次数")
+
+# 嵌入在线程中计算，重建长会话的索引时不阻塞事件循环
+_embed_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory-embed")
+
+
+def turn_bounds(messages: List["Message"]) -> List[Tuple[int, int]]:
+    """把消息划分为轮次：每轮从一条用户消息开始，到下一条用户消息之前结束，返回[start, end)列表"""
+    starts = [i for i, message in enumerate(messages) if message.role == "user"]
+    if not starts:
+        return []
+    return list(zip(starts, starts[1:] + [len(messages)]))
+
+
+class TurnIndex:
+    """会话的轮次向量索引，键为轮次首条消息的序号；只追加已有回复的完整轮次"""
+    def __init__(self):
+        self.index = VectorIndex(capacity=16)
+        # 之前的消息均已索引
+        self.indexed = 0
+        # 正在后台补齐索引的任务
+        self.task: Optional[asyncio.Task] = None
+
+    def pending(self, messages: List["Message"], limit: int) -> List[Tuple[int, int, str]]:
+        """尚未索引的完整轮次，至多limit个，返回(start, end, 嵌入文本)列表"""
+        turns = []
+        for start, end in turn_bounds(messages):
+            if start < self.indexed:
+                continue
+            turn = messages[start:end]
+            if end == len(messages) and len(turn) == 1:
+                # 最后一轮还没有回复
+                break
+            turns.append((start, end, "\n".join(message.content[:EMBED_MAX_CHARS] for message in turn)))
+            if len(turns) >= limit:
+                break
+        return turns
+
+    async def _update(self, messages: List["Message"]):
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                # 文本在事件循环中取出，线程只做嵌入计算；补齐期间新完成的轮次在下一批处理
+                turns = self.pending(messages, EMBED_BATCH_TURNS)
+                if not turns:
+                    return
+                vectors = await loop.run_in_executor(_embed_executor, lambda: [embed_text(text) for _, _, text in turns])
+                for (start, end, _text), vector in zip(turns, vectors):
+                    self.index.add(start, vector)
+                    self.indexed = end
+        except Exception as e:
+            print(f"检索索引更新失败: {str(e)}")
+
+    def refresh(self, messages: List["Message"]) -> asyncio.Task:
+        """在后台索引新完成的轮次，已有补齐任务在进行时复用该任务"""
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._update(messages))
+        return self.task
+
+
+class RetrievalMemory:
+    """检索式长期记忆：请求只携带最近的轮次和与当前提问最相关的旧轮次，索引在回复发送后更新"""
+    def __init__(self, recent_turns: int = MEMORY_RECENT_TURNS, retrieved_turns: int = MEMORY_RETRIEVED_TURNS,
+                 token_budget: int = MEMORY_TOKEN_BUDGET, min_score: float = MEMORY_MIN_SCORE):
+        self.recent_turns = max(1, recent_turns)
+        self.retrieved_turns = retrieved_turns
+        self.token_budget = token_budget
+        self.min_score = min_score
+
+    @staticmethod
+    def _index_for(session: "Session") -> TurnIndex:
+        # 索引只保存在内存中的会话对象上，会话换出后丢弃，载入后首次请求时重建
+        if session.turn_index is None:
+            session.turn_index = TurnIndex()
+        return session.turn_index
+
+    async def assemble(self, session: "Session", query: str) -> List[Dict[str, str]]:
+        """组装检索模式下发送给模型的历史消息，旧轮次按原顺序排在最近轮次之前"""
+        messages = session.messages
+        bounds = turn_bounds(messages)
+        if len(bounds) <= self.recent_turns:
+            return [message.to_dict() for message in messages]
+
+        recent_start = bounds[-self.recent_turns][0]
+        recent = [message.to_dict() for message in messages[recent_start:]]
+        budget = self.token_budget - estimate_tokens(recent)
+
+        # 正常情况下索引已在上次回复后更新；会话刚从磁盘载入时在后台重建，最多等待MEMORY_INDEX_WAIT_MS
+        index = self._index_for(session)
+        task = index.refresh(messages)
+        if not task.done():
+            await asyncio.wait({task}, timeout=MEMORY_INDEX_WAIT_MS / 1000)
+        ends = dict(bounds)
+        selected = []
+        if self.retrieved_turns > 0 and budget > 0:
+            query_vector = await asyncio.get_running_loop().run_in_executor(None, embed_text, query)
+            # 多取一些候选，最近轮次、尚未索引的轮次与超出预算的轮次会被跳过
+            hits = index.index.search(query_vector, k=self.retrieved_turns + self.recent_turns,
+                                      min_score=self.min_score)
+            for start, _score in hits:
+                if start >= recent_start:
+                    continue
+                turn = [message.to_dict() for message in messages[start:ends[start]]]
+                tokens = estimate_tokens(turn)
+                if tokens > budget:
+                    continue
+                budget -= tokens
+                selected.append((start, turn))
+                if len(selected) >= self.retrieved_turns:
+                    break
+
+        selected.sort(key=lambda item: item[0])
+        memory_retrieved_counter.inc(len(selected))
+        memory_omitted_counter.inc(len(bounds) - self.recent_turns - len(selected))
+        return [message for _start, turn in selected for message in turn] + recent
+
+    def schedule_update(self, session: "Session"):
+        """回复发送完成后在后台线程中索引新轮次，不占用请求与事件循环的处理时间"""
+        if session.memory_mode != "retrieval":
+            return
+        self._index_for(session).refresh(session.messages)
+
+
+# 创建全局检索记忆实例
+retrieval_memory = RetrievalMemory()
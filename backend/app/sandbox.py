@@ -0,0 +1,237 @@
+import asyncio
+import json
+import os
+import re
+import shutil
+import signal
+import sys
+import tempfile
+import time
+from collections import deque
+from typing import TYPE_CHECKING, Deque, Dict, List
+
+from backend.app.metrics import metrics
+from backend.app.tracing import NOOP_TRACE
+
+try:
+    import resource
+except ImportError:  # Windows没有resource模块，无法限制子进程资源，代码运行验证不可用
+    resource = None
+
+if TYPE_CHECKING:
+    from backend.app.protocol import ProtocolV1
+
+# 预先启动、等待任务的工作进程数，0为关闭代码运行验证
+SANDBOX_POOL_SIZE = int(os.getenv("SANDBOX_POOL_SIZE", "2"))
+# 每段代码的CPU时间（秒）、内存（MB）与墙钟时间（秒）上限
+SANDBOX_CPU_SECONDS = int(os.getenv("SANDBOX_CPU_SECONDS", "2"))
+SANDBOX_MEMORY_MB = int(os.getenv("SANDBOX_MEMORY_MB", "256"))
+SANDBOX_WALL_SECONDS = float(os.getenv("SANDBOX_WALL_SECONDS", "5"))
+# 返回的标准输出与标准错误各自的最大字符数
+SANDBOX_OUTPUT_MAX_CHARS = int(os.getenv("SANDBOX_OUTPUT_MAX_CHARS", "10000"))
+# 一次回复最多运行的代码块数
+SANDBOX_MAX_BLOCKS = 3
+# 代码可写入工作目录的文件大小上限（MB）
+SANDBOX_FILE_MB = 16
+# 工作进程启动并完成预导入的超时（秒）
+SANDBOX_SPAWN_TIMEOUT = 10.0
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sandbox_worker.py")
+# 工作进程的源码通过-c传入，用户代码从sys.argv中看不到服务器的路径
+with open(WORKER_SCRIPT, encoding="utf-8") as _f:
+    WORKER_SOURCE = _f.read()
+
+# 回复中的Python代码块：```python 或 ```py 开头
+_CODE_BLOCK = re.compile(r"```(?:python|py|python3)[ \t]*\n(.*?)```", re.DOTALL | re.IGNORECASE)
+
+sandbox_runs_counter = metrics.counter("sandbox_runs_total", "沙箱中运行的代码块数")
+sandbox_duration_histogram = metrics.histogram("sandbox_run_seconds", "代码块从提交到返回结果的时间",
+                                               buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+sandbox_ready_gauge = metrics.gauge("sandbox_workers_ready", "已预热、等待任务的沙箱工作进程数")
+
+
+def extract_code_blocks(text: str, limit: int = SANDBOX_MAX_BLOCKS) -> List[str]:
+    return [block for block in (match.group(1) for match in _CODE_BLOCK.finditer(text)) if block.strip()][:limit]
+
+
+def sandbox_supported() -> bool:
+    return resource is not None and sys.platform.startswith("linux")
+
+
+class Worker:
+    __slots__ = ("process", "workdir", "network_isolated", "filesystem_isolated")
+
+    def __init__(self, process: asyncio.subprocess.Process, workdir: str, network_isolated: bool,
+                 filesystem_isolated: bool = False):
+        self.process = process
+        self.workdir = workdir
+        self.network_isolated = network_isolated
+        self.filesystem_isolated = filesystem_isolated
+
+
+class SandboxPool:
+    """预热的沙箱进程池：工作进程提前启动并完成导入，提交代码时只需一次管道往返。
+    每个进程只执行一段代码，执行时设置CPU、内存、文件大小与描述符数限制，在临时目录中运行并禁止网络，
+    用完即销毁并在后台补充新的进程。工作进程无法进入独立的命名空间时停用，不在未隔离的进程中运行代码"""
+    def __init__(self, size: int = SANDBOX_POOL_SIZE, cpu_seconds: int = SANDBOX_CPU_SECONDS,
+                 memory_mb: int = SANDBOX_MEMORY_MB, wall_seconds: float = SANDBOX_WALL_SECONDS,
+                 output_limit: int = SANDBOX_OUTPUT_MAX_CHARS):
+        self.size = size
+        self.cpu_seconds = cpu_seconds
+        self.memory_mb = memory_mb
+        self.wall_seconds = wall_seconds
+        self.output_limit = output_limit
+        self.ready: Deque[Worker] = deque()
+        self.spawning = 0
+        self.closed = False
+        # 工作进程未能隔离网络与文件系统时记录原因并停用代码运行验证，只靠审计钩子无法阻止用户代码执行程序
+        self.unavailable = None
+        # 同时运行的代码块数不超过池大小，超出的排队等待
+        self._slots = asyncio.Semaphore(max(1, size))
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0 and sandbox_supported() and self.unavailable is None
+
+    async def _spawn(self) -> Worker:
+        workdir = tempfile.mkdtemp(prefix="sandbox-")
+        process = await asyncio.create_subprocess_exec(
+            sys.executable, "-I", "-c", WORKER_SOURCE, str(SANDBOX_FILE_MB),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            cwd=workdir,
+            # 不继承服务器的环境变量（其中有API Key）
+            env={"PATH": os.defpath, "HOME": workdir, "TMPDIR": workdir, "PYTHONIOENCODING": "utf-8"},
+            start_new_session=True,
+            # 结果行包含标准输出与标准错误，放宽默认64KB的行长度限制
+            limit=1024 * 1024,
+        )
+        try:
+            line = await asyncio.wait_for(process.stdout.readline(), SANDBOX_SPAWN_TIMEOUT)
+            hello = json.loads(line)
+        except BaseException:
+            self._kill(Worker(process, workdir, False))
+            raise
+        worker = Worker(process, workdir, bool(hello.get("network_isolated")), bool(hello.get("filesystem_isolated")))
+        if not (worker.network_isolated and worker.filesystem_isolated):
+            self._kill(worker)
+            self.unavailable = "无法为沙箱进程创建用户命名空间（如容器的seccomp配置禁止unshare），代码运行验证已停用"
+            print(self.unavailable)
+            raise RuntimeError(self.unavailable)
+        return worker
+
+    async def _refill(self):
+        try:
+            worker = await self._spawn()
+        except Exception as e:
+            print(f"沙箱工作进程启动失败: {str(e)}")
+            return
+        finally:
+            self.spawning -= 1
+        if self.closed:
+            self._kill(worker)
+            return
+        self.ready.append(worker)
+        sandbox_ready_gauge.set(len(self.ready))
+
+    def _replenish(self):
+        while not self.closed and self.enabled and len(self.ready) + self.spawning < self.size:
+            self.spawning += 1
+            asyncio.create_task(self._refill())
+
+    async def start(self):
+        """预热工作进程"""
+        if not self.enabled:
+            return
+        self.closed = False
+        self._replenish()
+
+    def _kill(self, worker: Worker):
+        if worker.process.returncode is None:
+            try:
+                # 工作进程在独立的进程组中，连同它可能创建的子进程一起结束
+                os.killpg(worker.process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+        shutil.rmtree(worker.workdir, ignore_errors=True)
+
+    async def _take(self) -> Worker:
+        if self.ready:
+            worker = self.ready.popleft()
+            sandbox_ready_gauge.set(len(self.ready))
+            if worker.process.returncode is None:
+                return worker
+            self._kill(worker)
+        # 没有预热好的进程时当场启动，需要付出解释器启动的开销
+        return await self._spawn()
+
+    async def run(self, code: str) -> Dict:
+        """在沙箱中运行一段代码，返回状态、标准输出、标准错误、最后一个表达式的值与耗时"""
+        if not self.enabled:
+            raise RuntimeError(self.unavailable or "当前环境不支持代码运行验证")
+        started = time.perf_counter()
+        async with self._slots:
+            worker = await self._take()
+            self._replenish()
+            try:
+                job = {
+                    "code": code,
+                    "cpu_seconds": self.cpu_seconds,
+                    "memory_mb": self.memory_mb,
+                    "file_mb": SANDBOX_FILE_MB,
+                    "output_limit": self.output_limit,
+                }
+                worker.process.stdin.write((json.dumps(job, ensure_ascii=False) + "\n").encode("utf-8"))
+                await worker.process.stdin.drain()
+                line = await asyncio.wait_for(worker.process.stdout.readline(), self.wall_seconds)
+                if line:
+                    result = json.loads(line)
+                    if "crashed" in result:
+                        result = self._crashed(result["crashed"])
+                else:
+                    result = self._crashed(await worker.process.wait())
+            except asyncio.TimeoutError:
+                result = {"status": "timeout", "stdout": "", "stderr": f"运行超过{self.wall_seconds:g}秒，已终止",
+                          "result": None, "exit_code": None}
+            finally:
+                self._kill(worker)
+        elapsed = time.perf_counter() - started
+        result["duration_ms"] = round(elapsed * 1000, 1)
+        sandbox_runs_counter.inc(labels={"status": result["status"]})
+        sandbox_duration_histogram.observe(elapsed)
+        return result
+
+    def _crashed(self, returncode: int) -> Dict:
+        # 超出CPU时间时内核发送SIGXCPU，超出内存时解释器可能来不及抛出MemoryError而直接崩溃
+        if returncode == -signal.SIGXCPU or returncode == -signal.SIGKILL:
+            status, message = "cpu_limit", f"CPU时间超过{self.cpu_seconds}秒，已终止"
+        else:
+            status, message = "crashed", f"进程异常退出（返回码 {returncode}），可能超出内存限制"
+        return {"status": status, "stdout": "", "stderr": message, "result": None, "exit_code": returncode}
+
+    def close(self):
+        self.closed = True
+        while self.ready:
+            self._kill(self.ready.popleft())
+        sandbox_ready_gauge.set(0)
+
+
+async def verify_reply(protocol: "ProtocolV1", agent_id: str, request_id: str, text: str, trace=NOOP_TRACE):
+    """运行回复中的Python代码块，每个代码块的结果作为单独的帧发送"""
+    blocks = extract_code_blocks(text)
+    if not blocks:
+        return
+    for index, code in enumerate(blocks):
+        with trace.span("sandbox.run", block=index) as span:
+            try:
+                result = await sandbox_pool.run(code)
+            except Exception as e:
+                result = {"status": "unavailable", "stdout": "", "stderr": str(e), "result": None, "exit_code": None}
+            span.set_attribute("status", result["status"])
+        print(f"代码运行验证: request_id={request_id}, 代码块{index}, 状态: {result['status']}, 耗时: {result.get('duration_ms')}ms")
+        await protocol.send_code_result(agent_id, request_id, index, result)
+
+
+# 创建全局沙箱进程池实例
+sandbox_pool = SandboxPool()
@@ -0,0 +1,369 @@
+"""沙箱工作进程：由sandbox.SandboxPool预先启动，完成解释器启动与常用模块导入后输出就绪行，
+然后等待一个任务，在子进程中于资源限制下执行，校验子进程交回的结果后输出并退出（每个进程只执行一次，互不影响）。
+源码通过python -I -c传入，不导入项目中的模块，sys.argv中也没有服务器的路径"""
+import ast
+import ctypes
+import io
+import json
+import linecache
+import os
+import resource
+import signal
+import sys
+import time
+import traceback
+
+# unshare(2)的标志：新的用户、网络与挂载命名空间，进程内只有不通外网的回环设备
+CLONE_NEWUSER = 0x10000000
+CLONE_NEWNET = 0x40000000
+CLONE_NEWNS = 0x00020000
+# mount(2)的标志
+MS_RDONLY = 0x1
+MS_NOSUID = 0x2
+MS_NODEV = 0x4
+MS_NOEXEC = 0x8
+MS_REMOUNT = 0x20
+MS_BIND = 0x1000
+MS_REC = 0x4000
+MS_PRIVATE = 0x40000
+# prctl(2)与capset(2)的参数
+PR_SET_DUMPABLE = 4
+PR_SET_NO_NEW_PRIVS = 38
+LINUX_CAPABILITY_VERSION_3 = 0x20080522
+# 子进程交回的结果的合法状态
+RESULT_STATUSES = ("ok", "error", "memory_limit")
+
+# 执行用户代码期间禁止的审计事件：网络、创建进程、加载动态库
+BLOCKED_EVENTS = {
+    "socket.__new__", "socket.connect", "socket.bind", "socket.getaddrinfo", "socket.sendto",
+    "subprocess.Popen", "os.system", "os.exec", "os.posix_spawn", "os.spawn", "os.fork", "os.forkpty",
+    "os.kill", "os.killpg", "ctypes.dlopen", "ctypes.dlsym", "ctypes.cdata",
+}
+# 只允许读取工作目录与Python库目录的事件（open另行处理）
+READ_EVENTS = {"os.listdir", "os.scandir", "os.getxattr", "os.listxattr"}
+# 只允许在工作目录内进行的文件系统修改
+PATH_EVENTS = {"os.remove", "os.rename", "os.rmdir", "os.mkdir", "os.chmod", "os.chown", "os.symlink",
+               "os.link", "os.truncate", "os.utime", "shutil.rmtree", "shutil.move", "shutil.copyfile",
+    "os.setxattr", "os.removexattr", "sqlite3.connect"}
+
+
+def library_paths() -> list:
+    """导入模块需要读取的路径：sys.path中位于Python安装目录内的条目。
+    以可编辑方式安装到site-packages的项目目录不在安装目录内，不会被加入"""
+    prefixes = {os.path.realpath(p) + os.sep for p in (sys.prefix, sys.base_prefix, sys.exec_prefix, sys.base_exec_prefix)}
+    paths = []
+    for entry in sys.path:
+        if not entry or not os.path.exists(entry):
+            continue
+        path = os.path.realpath(entry)
+        if any(path.startswith(prefix) for prefix in prefixes):
+            paths.append(path)
+    # 去掉包含在其他条目中的路径（如lib-dynload位于标准库目录内）
+    paths.sort()
+    result = []
+    for path in paths:
+        if not result or not (path + os.sep).startswith(result[-1] + os.sep):
+            result.append(path)
+    return result
+
+
+def enter_root(libc, workdir: str, paths: list, file_mb: int) -> bool:
+    """在新的挂载命名空间中把根目录换成一个tmpfs，其中只有工作目录与只读绑定的Python库目录；
+    tmpfs挂载在工作目录上，写入的文件不落盘，进程退出后随命名空间一起消失"""
+    def mount(source, target, fstype, flags, data=None):
+        if libc.mount(source, os.fsencode(target), fstype, flags, data) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), target)
+
+    try:
+        # 之后的挂载不传播回服务器所在的命名空间
+        mount(None, "/", None, MS_REC | MS_PRIVATE)
+        root = workdir
+        # 工作目录不可执行，用户代码写入的文件无法作为程序运行
+        mount(b"tmpfs", root, b"tmpfs", MS_NOSUID | MS_NODEV | MS_NOEXEC, f"size={file_mb}m,mode=755".encode())
+        for path in paths:
+            target = root + path
+            if os.path.isdir(path):
+                os.makedirs(target, exist_ok=True)
+            else:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                open(target, "w").close()
+            mount(os.fsencode(path), target, None, MS_BIND | MS_REC)
+            # 重新挂载为只读时需要保留原挂载上锁定的标志，失败时保持可写，写入仍由审计钩子拦截
+            locked = os.statvfs(path).f_flag & (MS_NOSUID | MS_NODEV | MS_NOEXEC)
+            try:
+                mount(None, target, None, MS_REMOUNT | MS_BIND | MS_RDONLY | locked)
+            except OSError:
+                pass
+        os.makedirs(root + workdir)
+        os.makedirs(root + "/dev")
+        open(root + "/dev/null", "w").close()
+        mount(b"/dev/null", root + "/dev/null", None, MS_BIND)
+        os.chroot(root)
+        os.chdir(workdir)
+    except OSError:
+        return False
+    return True
+
+
+class CapHeader(ctypes.Structure):
+    _fields_ = [("version", ctypes.c_uint32), ("pid", ctypes.c_int)]
+
+
+class CapData(ctypes.Structure):
+    _fields_ = [("effective", ctypes.c_uint32), ("permitted", ctypes.c_uint32), ("inheritable", ctypes.c_uint32)]
+
+
+def drop_privileges(libc) -> bool:
+    """放弃新用户命名空间中获得的全部能力：否则用户代码可以再次chroot逃出根目录，或重新挂载文件系统。
+    同时禁止通过exec获得新权限，并禁止同一用户的进程附加调试本进程"""
+    if libc.capset(ctypes.byref(CapHeader(LINUX_CAPABILITY_VERSION_3, 0)), (CapData * 2)()) != 0:
+        return False
+    return libc.prctl(PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0) == 0 and libc.prctl(PR_SET_DUMPABLE, 0, 0, 0, 0) == 0
+
+
+def isolate(workdir: str, file_mb: int):
+    """进入新的用户、网络与挂载命名空间，把根目录换成只含工作目录与Python库目录的文件系统并放弃能力。
+    返回(网络是否隔离, 文件系统是否隔离)；内核未开放非特权用户命名空间时都为False，进程池不会使用这样的工作进程"""
+    uid, gid = os.getuid(), os.getgid()
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        if libc.unshare(CLONE_NEWUSER | CLONE_NEWNET | CLONE_NEWNS) != 0:
+            return False, False
+    except (OSError, AttributeError):
+        return False, False
+    # 新用户命名空间内映射回原来的用户，保持对工作目录的写权限
+    try:
+        for path, content in (("/proc/self/setgroups", "deny"), ("/proc/self/uid_map", f"{uid} {uid} 1"),
+                              ("/proc/self/gid_map", f"{gid} {gid} 1")):
+            with open(path, "w") as f:
+                f.write(content)
+    except OSError:
+        pass
+    filesystem_isolated = enter_root(libc, workdir, library_paths(), file_mb)
+    return True, drop_privileges(libc) and filesystem_isolated
+
+
+def install_audit_hook(workdir: str, readable: list):
+    """审计钩子安装后无法移除，进程剩余的生命周期都处于限制之下。
+    只能读取工作目录与readable中的路径，只能修改工作目录内的文件"""
+    root = os.path.realpath(workdir) + os.sep
+    read_roots = tuple([root] + [path + os.sep for path in readable])
+
+    def resolve(path):
+        if isinstance(path, int):
+            return None
+        if isinstance(path, bytes):
+            path = os.fsdecode(path)
+        return os.path.realpath(path) + os.sep
+
+    def check_path(path):
+        resolved = resolve(path)
+        if resolved is not None and not resolved.startswith(root):
+            raise PermissionError(f"沙箱中只能修改工作目录内的文件: {path}")
+
+    def check_read(path):
+        resolved = resolve(path)
+        if resolved is not None and not resolved.startswith(read_roots) and resolved != os.devnull + os.sep:
+            raise PermissionError(f"沙箱中只能读取工作目录内的文件: {path}")
+
+    def hook(event, args):
+        if event in BLOCKED_EVENTS:
+            raise PermissionError(f"沙箱中禁止该操作: {event}")
+        if event == "open":
+            path, mode, flags = args
+            writing = (mode is not None and any(c in mode for c in "wax+")) or \
+                      (flags is not None and flags & (os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_TRUNC))
+            if writing:
+                check_path(path)
+            else:
+                check_read(path)
+        elif event in READ_EVENTS and args:
+            check_read(args[0])
+        elif event in PATH_EVENTS and args:
+            check_path(args[0])
+            if event in ("os.rename", "os.symlink", "os.link", "shutil.move", "shutil.copyfile") and len(args) > 1:
+                check_path(args[1])
+
+    sys.addaudithook(hook)
+
+
+def apply_limits(cpu_seconds: int, memory_mb: int, file_mb: int):
+    resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+    memory = memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    file_size = file_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_FSIZE, (file_size, file_size))
+    resource.setrlimit(resource.RLIMIT_NOFILE, (64, 64))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+
+class LimitedWriter(io.TextIOBase):
+    """只保留前limit个字符的输出，超出部分计数后丢弃"""
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.parts = []
+        self.size = 0
+        self.dropped = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        room = self.limit - self.size
+        if room > 0:
+            self.parts.append(text[:room])
+            self.size += min(room, len(text))
+        self.dropped += max(0, len(text) - max(room, 0))
+        return len(text)
+
+    def getvalue(self) -> str:
+        value = "".join(self.parts)
+        if self.dropped:
+            value += f"\n...（另有 {self.dropped} 个字符被截断）"
+        return value
+
+
+def run(code: str, output_limit: int) -> dict:
+    stdout = LimitedWriter(output_limit)
+    stderr = LimitedWriter(output_limit)
+    sys.stdout, sys.stderr, sys.stdin = stdout, stderr, io.StringIO("")
+    status = "ok"
+    value = None
+    exit_code = None
+    started = time.process_time()
+    # 让调用栈中显示出错的源码行
+    linecache.cache["<sandbox>"] = (len(code), None, code.splitlines(True), "<sandbox>")
+    try:
+        tree = ast.parse(code, "<sandbox>")
+        # 与交互式解释器一样，最后一条语句是表达式时返回它的值
+        last = tree.body.pop() if tree.body and isinstance(tree.body[-1], ast.Expr) else None
+        namespace = {"__name__": "__main__", "__builtins__": __builtins__}
+        exec(compile(tree, "<sandbox>", "exec"), namespace)
+        if last is not None:
+            result = eval(compile(ast.Expression(last.value), "<sandbox>", "eval"), namespace)
+            if result is not None:
+                value = repr(result)[:output_limit]
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        status = "ok" if exit_code == 0 else "error"
+    except MemoryError:
+        status = "memory_limit"
+        stderr.write("MemoryError: 超出内存限制\n")
+    except BaseException:
+        status = "error"
+        # 只保留用户代码部分的调用栈
+        frames = [frame for frame in traceback.extract_tb(sys.exc_info()[2]) if frame.filename == "<sandbox>"]
+        stderr.write("Traceback (most recent call last):\n" + "".join(traceback.format_list(frames)))
+        stderr.write("".join(traceback.format_exception_only(*sys.exc_info()[:2])))
+    return {
+        "status": status,
+        "stdout": stdout.getvalue(),
+        "stderr": stderr.getvalue(),
+        "result": value,
+        "exit_code": exit_code,
+        "cpu_ms": round((time.process_time() - started) * 1000, 1),
+    }
+
+
+def emit(fd: int, payload: dict):
+    data = (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def read_limited(fd: int, limit: int) -> bytes:
+    """读到文件结束或超过limit字节为止，超出时返回None"""
+    chunks = []
+    size = 0
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            return b"".join(chunks)
+        size += len(chunk)
+        if size > limit:
+            return None
+        chunks.append(chunk)
+
+
+def checked_result(payload, output_limit: int) -> dict:
+    """子进程交回的结果来自运行用户代码的进程，只取已知字段并检查类型与长度，不合法时抛出ValueError"""
+    if not isinstance(payload, dict) or payload.get("status") not in RESULT_STATUSES:
+        raise ValueError("结果格式不正确")
+    # 截断提示与调用栈会超出字符上限，留出余量
+    text_limit = output_limit + 200
+    result = {"status": payload["status"]}
+    for field in ("stdout", "stderr"):
+        if not isinstance(payload.get(field), str):
+            raise ValueError("结果格式不正确")
+        result[field] = payload[field][:text_limit]
+    value = payload.get("result")
+    exit_code = payload.get("exit_code")
+    cpu_ms = payload.get("cpu_ms")
+    if value is not None and not isinstance(value, str) or \
+            exit_code is not None and (not isinstance(exit_code, int) or isinstance(exit_code, bool)) or \
+            not isinstance(cpu_ms, (int, float)) or isinstance(cpu_ms, bool):
+        raise ValueError("结果格式不正确")
+    result["result"] = value[:text_limit] if value is not None else None
+    result["exit_code"] = exit_code
+    result["cpu_ms"] = cpu_ms
+    return result
+
+
+def run_in_child(job: dict, workdir: str, readable: list, result_fd: int) -> dict:
+    """在子进程中运行用户代码。子进程关闭结果描述符后才执行代码，只能把结果写入专用管道，
+    由本进程校验后组成结果帧，用户代码无法直接伪造结果帧或其中的隔离状态"""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(read_fd)
+            os.close(result_fd)
+            apply_limits(job["cpu_seconds"], job["memory_mb"], job["file_mb"])
+            install_audit_hook(workdir, readable)
+            emit(write_fd, run(job["code"], job["output_limit"]))
+            os.close(write_fd)
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    # JSON中的字符最多占6字节（控制字符转义为\uXXXX），三个文本字段加上余量
+    data = read_limited(read_fd, (job["output_limit"] + 200) * 6 * 3 + 4096)
+    try:
+        # 交回结果后不等待子进程退出，它与本进程在同一进程组中，由进程池一起结束
+        return checked_result(json.loads(data), job["output_limit"])
+    except (TypeError, ValueError):
+        pass
+    # 子进程被信号终止或没有交回合法结果，由服务器根据返回码给出说明
+    if data is None:
+        os.kill(pid, signal.SIGKILL)
+    _, status = os.waitpid(pid, 0)
+    return {"crashed": -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)}
+
+
+def main():
+    # 结果通过复制出的描述符返回，原始的标准输出指向/dev/null；用户代码在关闭了该描述符的子进程中运行
+    result_fd = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    workdir = os.getcwd()
+    readable = library_paths()
+    # tmpfs工作目录的大小（MB），由启动参数传入
+    file_mb = int(sys.argv[1])
+    network_isolated, filesystem_isolated = isolate(workdir, file_mb)
+    # 预先导入常用标准库，执行时不再付出导入开销
+    import collections, functools, itertools, math, random, re, statistics, string  # noqa: F401
+    emit(result_fd, {"ready": True, "network_isolated": network_isolated, "filesystem_isolated": filesystem_isolated})
+
+    line = sys.stdin.readline()
+    if not line:
+        return
+    job = json.loads(line)
+    result = run_in_child(job, workdir, readable, result_fd)
+    result["network_isolated"] = network_isolated
+    result["filesystem_isolated"] = filesystem_isolated
+    emit(result_fd, result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+import asyncio
+import os
+import time
+from typing import Dict, List, Optional
+
+from backend.app.metrics import metrics
+
+# 同时进行的上游流式调用数上限，超出的请求排队
+SCHED_MAX_CONCURRENT = int(os.getenv("SCHED_MAX_CONCURRENT", "32"))
+# 排队每超过该时间（秒）优先级提升一级，防止低优先级请求饿死
+SCHED_MAX_WAIT_SECONDS = float(os.getenv("SCHED_MAX_WAIT_SECONDS", "10"))
+# 预估输出长度（token），请求结束后按实际输出修正
+SCHED_DEFAULT_OUTPUT_TOKENS = 1500
+
+# 优先级从高到低：交互式流式请求、一次性请求、批量与后台任务
+PRIORITIES = ("interactive", "non_stream", "batch")
+_PRIORITY_RANK = {name: rank for rank, name in enumerate(PRIORITIES)}
+
+queue_wait_histogram = metrics.histogram("scheduler_queue_wait_seconds", "请求在调度队列中的等待时间",
+                                         buckets=(0.001, 0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0))
+queue_depth_gauge = metrics.gauge("scheduler_queue_depth", "调度队列中等待的请求数")
+active_streams_gauge = metrics.gauge("scheduler_active_streams", "正在进行的上游调用数")
+starvation_counter = metrics.counter("scheduler_starvation_promotions_total", "因等待过久被提前调度的请求数")
+
+
+class Ticket:
+    """一次获得的调度名额，结束时交回并按实际用量修正所属流的份额"""
+    __slots__ = ("key", "client", "priority", "cost", "waited", "enqueued_at", "future")
+
+    def __init__(self, key: str, client: str, priority: str, cost: float):
+        self.key = key
+        self.client = client
+        self.priority = priority
+        self.cost = cost
+        self.waited = 0.0
+        self.enqueued_at = time.monotonic()
+        self.future: Optional[asyncio.Future] = None
+
+
+class FairScheduler:
+    """上游调用前的两级加权公平排队：先在API Key之间、再在同一密钥的客户端之间按已获得的服务量
+    （虚拟时间=累计token用量/权重）均分名额，同一客户端内先到先得。
+    不同优先级之间严格按优先级调度，排队过久的请求逐级提升优先级"""
+    def __init__(self, capacity: int = SCHED_MAX_CONCURRENT, max_wait: float = SCHED_MAX_WAIT_SECONDS):
+        self.capacity = capacity
+        self.max_wait = max_wait
+        self.active = 0
+        self.waiters: List[Ticket] = []
+        # 各API Key与各客户端的虚拟时间
+        self.key_vtime: Dict[str, float] = {}
+        self.client_vtime: Dict[str, float] = {}
+        # 最近一次调度时所选流的虚拟时间，重新变为活跃的流从这里开始，不能用空闲期间积攒份额
+        self.key_floor = 0.0
+        self.client_floor: Dict[str, float] = {}
+        # 各流的权重，未配置时为1
+        self.weights: Dict[str, float] = {}
+
+    def _weight(self, flow: str) -> float:
+        return self.weights.get(flow, 1.0)
+
+    def _charge(self, ticket: Ticket, cost: float):
+        """把服务量记到请求所属的密钥与客户端上"""
+        self.key_vtime[ticket.key] = self.key_vtime.get(ticket.key, 0.0) + cost / self._weight(ticket.key)
+        self.client_vtime[ticket.client] = self.client_vtime.get(ticket.client, 0.0) + cost / self._weight(ticket.client)
+
+    def _activate(self, ticket: Ticket):
+        self.key_vtime[ticket.key] = max(self.key_vtime.get(ticket.key, 0.0), self.key_floor)
+        floor = self.client_floor.get(ticket.key, 0.0)
+        self.client_vtime[ticket.client] = max(self.client_vtime.get(ticket.client, 0.0), floor)
+
+    def _grant(self, ticket: Ticket):
+        self.key_floor = max(self.key_floor, self.key_vtime.get(ticket.key, 0.0))
+        self.client_floor[ticket.key] = max(self.client_floor.get(ticket.key, 0.0),
+                                            self.client_vtime.get(ticket.client, 0.0))
+        self._charge(ticket, ticket.cost)
+        self.active += 1
+
+    def _update_gauges(self):
+        for priority in PRIORITIES:
+            queue_depth_gauge.set(sum(1 for w in self.waiters if w.priority == priority), {"priority": priority})
+        active_streams_gauge.set(self.active)
+
+    async def acquire(self, key: str, client: Optional[str] = None, priority: str = "interactive",
+                      cost: float = 1.0) -> Ticket:
+        if priority not in _PRIORITY_RANK:
+            priority = PRIORITIES[-1]
+        # 客户端流挂在密钥之下，不同密钥的同名客户端互不影响
+        ticket = Ticket(key, f"{key}/{client or ''}", priority, max(cost, 1.0))
+        self._activate(ticket)
+        if self.active < self.capacity and not self.waiters:
+            self._grant(ticket)
+            self._update_gauges()
+            queue_wait_histogram.observe(0.0, {"priority": priority})
+            return ticket
+
+        ticket.future = asyncio.get_running_loop().create_future()
+        self.waiters.append(ticket)
+        self._update_gauges()
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # 已分到名额但调用方已取消，交还名额
+                self.release(ticket)
+            elif ticket in self.waiters:
+                self.waiters.remove(ticket)
+                self._update_gauges()
+            raise
+        ticket.waited = time.monotonic() - ticket.enqueued_at
+        queue_wait_histogram.observe(ticket.waited, {"priority": priority})
+        return ticket
+
+    def release(self, ticket: Ticket, actual_cost: Optional[float] = None):
+        """交回名额；给出实际用量时按与预估的差值修正，长回复所属的流随后排得更靠后"""
+        if actual_cost is not None:
+            self._charge(ticket, max(actual_cost, 1.0) - ticket.cost)
+        self.active -= 1
+        self._dispatch()
+        if len(self.client_vtime) > 4 * max(self.capacity, 256):
+            # 虚拟时间已落后于下限的流与新流等价，可以丢弃
+            self.key_vtime = {k: v for k, v in self.key_vtime.items() if v > self.key_floor}
+            self.client_vtime = {c: v for c, v in self.client_vtime.items()
+                                 if v > self.client_floor.get(c.split("/", 1)[0], 0.0)}
+            self.client_floor = {k: v for k, v in self.client_floor.items() if k in self.key_vtime}
+
+    def _effective_rank(self, ticket: Ticket, now: float) -> int:
+        # 每等待SCHED_MAX_WAIT_SECONDS提升一级，低优先级请求最终与交互请求按公平份额竞争
+        return max(0, _PRIORITY_RANK[ticket.priority] - int((now - ticket.enqueued_at) / self.max_wait))
+
+    def _select(self) -> Ticket:
+        now = time.monotonic()
+        ticket = min(self.waiters, key=lambda t: (self._effective_rank(t, now), self.key_vtime.get(t.key, 0.0),
+                                                  self.client_vtime.get(t.client, 0.0), t.enqueued_at))
+        if self._effective_rank(ticket, now) < _PRIORITY_RANK[ticket.priority]:
+            starvation_counter.inc(labels={"priority": ticket.priority})
+        return ticket
+
+    def _dispatch(self):
+        while self.active < self.capacity and self.waiters:
+            ticket = self._select()
+            self.waiters.remove(ticket)
+            if ticket.future.done():
+                continue
+            self._grant(ticket)
+            ticket.future.set_result(None)
+        self._update_gauges()
+
+    def snapshot(self) -> Dict:
+        now = time.monotonic()
+        return {
+            "capacity": self.capacity,
+            "active": self.active,
+            "waiting": [
+                {
+                    "priority": t.priority,
+                    "key": t.key,
+                    "client": t.client.split("/", 1)[1],
+                    "cost": t.cost,
+                    "key_vtime": round(self.key_vtime.get(t.key, 0.0), 1),
+                    "client_vtime": round(self.client_vtime.get(t.client, 0.0), 1),
+                    "waited_seconds": round(now - t.enqueued_at, 3),
+                }
+                for t in sorted(self.waiters, key=lambda t: t.enqueued_at)
+            ],
+        }
+
+
+# 创建全局调度器实例
+scheduler = FairScheduler()
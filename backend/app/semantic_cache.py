@@ -0,0 +1,180 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, AsyncGenerator, Dict, Optional, Tuple
+
+from backend.app.metrics import metrics
+from backend.app.query_terms import analyze
+from backend.app.vector_index import VectorIndex
+
+if TYPE_CHECKING:
+    from backend.app.agent_manager import BaseAgent
+    from backend.app.generations import Generation
+
+# 相似度（余弦）不低于该值、且互斥词等guard完全相同时直接返回缓存的回复，
+# 取值依据 python -m backend.benchmarks.semantic_cache_eval 的评估结果
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.8"))
+# 缓存条目的有效期（秒）
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "86400"))
+# 每个智能体最多缓存的条目数，超过后淘汰最久未命中的条目
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "10000"))
+# 启用语义缓存的智能体，逗号分隔；设置后覆盖智能体自带的semantic_cache属性
+SEMANTIC_CACHE_AGENTS = os.getenv("SEMANTIC_CACHE_AGENTS", "")
+# 查询时检查的候选条目数：相似度最高的条目guard不同或已过期时依次检查后面的条目
+SEMANTIC_CACHE_CANDIDATES = 5
+# 命中时回放缓存回复的片段长度（字符）
+REPLAY_CHUNK_CHARS = 200
+
+cache_lookups_counter = metrics.counter("semantic_cache_lookups_total", "语义缓存查询次数")
+cache_entries_gauge = metrics.gauge("semantic_cache_entries", "语义缓存条目数")
+
+
+class CacheEntry:
+    __slots__ = ("prompt", "guard", "response", "model", "created_at", "hits")
+
+    def __init__(self, prompt: str, guard: Tuple, response: str, model: Optional[str]):
+        self.prompt = prompt
+        self.guard = guard
+        self.response = response
+        self.model = model
+        self.created_at = time.time()
+        self.hits = 0
+
+
+class AgentCache:
+    """单个智能体的缓存：向量索引负责检索，OrderedDict按最近命中排序用于LRU淘汰"""
+    def __init__(self):
+        self.index = VectorIndex()
+        self.entries: "OrderedDict[int, CacheEntry]" = OrderedDict()
+        self.next_id = 0
+
+    def remove(self, entry_id: int):
+        self.entries.pop(entry_id, None)
+        self.index.remove(entry_id)
+
+
+class SemanticCache:
+    """按语义相似度缓存首轮提问的回复：同一问题换种说法也能命中，命中时不调用上游模型。
+    查询与写入包含向量检索的矩阵运算，由调用方放到线程池中执行，索引与条目的读写都在锁内进行"""
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, ttl: float = SEMANTIC_CACHE_TTL,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.agents: Dict[str, AgentCache] = {}
+        self.enabled_agents = {name.strip() for name in SEMANTIC_CACHE_AGENTS.split(",") if name.strip()}
+        self._lock = threading.Lock()
+
+    def enabled_for(self, agent: "BaseAgent") -> bool:
+        if self.enabled_agents:
+            return agent.id in self.enabled_agents
+        return bool(getattr(agent, "semantic_cache", False))
+
+    def _expired(self, entry: CacheEntry, now: float) -> bool:
+        return now - entry.created_at > self.ttl
+
+    def _update_gauge(self):
+        cache_entries_gauge.set(sum(len(cache.entries) for cache in self.agents.values()))
+
+    def lookup(self, agent_id: str, prompt: str) -> Optional[Tuple[CacheEntry, float]]:
+        """查找guard相同、相似度最高且未过期的条目，返回(条目, 相似度)，未命中返回None。
+        只差在升序/降序、读取/写入等互斥词上的提问向量很接近，靠guard而不是阈值区分"""
+        with self._lock:
+            return self._lookup(agent_id, prompt)
+
+    def _lookup(self, agent_id: str, prompt: str) -> Optional[Tuple[CacheEntry, float]]:
+        cache = self.agents.get(agent_id)
+        if cache is None or not cache.entries:
+            cache_lookups_counter.inc(labels={"agent_id": agent_id, "result": "miss"})
+            return None
+        query = analyze(prompt)
+        now = time.time()
+        expired = False
+        for entry_id, score in cache.index.search(query.vector, k=SEMANTIC_CACHE_CANDIDATES, min_score=self.threshold):
+            entry = cache.entries[entry_id]
+            if self._expired(entry, now):
+                cache.remove(entry_id)
+                expired = True
+                continue
+            if entry.guard != query.guard:
+                continue
+            if expired:
+                self._update_gauge()
+            entry.hits += 1
+            cache.entries.move_to_end(entry_id)
+            cache_lookups_counter.inc(labels={"agent_id": agent_id, "result": "hit"})
+            return entry, score
+        if expired:
+            self._update_gauge()
+        cache_lookups_counter.inc(labels={"agent_id": agent_id, "result": "miss"})
+        return None
+
+    def store(self, agent_id: str, prompt: str, response: str, model: Optional[str] = None):
+        # 只在查询未命中后写入，因此不再检查重复条目
+        query = analyze(prompt)
+        with self._lock:
+            self._store(agent_id, prompt, query, response, model)
+
+    def _store(self, agent_id: str, prompt: str, query, response: str, model: Optional[str]):
+        cache = self.agents.setdefault(agent_id, AgentCache())
+        now = time.time()
+        while cache.entries:
+            oldest_id, oldest = next(iter(cache.entries.items()))
+            if len(cache.entries) < self.max_entries and not self._expired(oldest, now):
+                break
+            cache.remove(oldest_id)
+        entry_id = cache.next_id
+        cache.next_id += 1
+        cache.entries[entry_id] = CacheEntry(prompt, query.guard, response, model)
+        cache.index.add(entry_id, query.vector)
+        self._update_gauge()
+
+    def remember(self, agent_id: str, prompt: str, generation: "Generation"):
+        """生成正常结束后在线程池中缓存回复；出错、被取消或上游调用失败的回复不缓存"""
+        def on_done(_task):
+            if generation.error is None and generation.context.upstream_error is None and generation.text:
+                asyncio.get_running_loop().run_in_executor(None, self.store, agent_id, prompt, generation.text,
+                                                           generation.context.model)
+        generation.task.add_done_callback(on_done)
+
+    @staticmethod
+    async def replay(text: str) -> AsyncGenerator[str, None]:
+        """把缓存的回复按片段回放，走与上游回复相同的推送、续传流程"""
+        for start in range(0, len(text), REPLAY_CHUNK_CHARS):
+            yield text[start:start + REPLAY_CHUNK_CHARS]
+
+    def clear(self, agent_id: Optional[str] = None) -> int:
+        with self._lock:
+            if agent_id is None:
+                removed = sum(len(cache.entries) for cache in self.agents.values())
+                self.agents.clear()
+            else:
+                cache = self.agents.pop(agent_id, None)
+                removed = len(cache.entries) if cache else 0
+            self._update_gauge()
+        return removed
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return self._stats()
+
+    def _stats(self) -> Dict:
+        return {
+            "threshold": self.threshold,
+            "ttl_seconds": self.ttl,
+            "max_entries": self.max_entries,
+            "agents": {
+                agent_id: {
+                    "entries": len(cache.entries),
+                    "hits": sum(entry.hits for entry in cache.entries.values()),
+                    "index_bytes": cache.index.nbytes,
+                }
+                for agent_id, cache in self.agents.items()
+            },
+        }
+
+
+# 创建全局语义缓存实例
+semantic_cache = SemanticCache()
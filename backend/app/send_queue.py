@@ -0,0 +1,167 @@
+import asyncio
+import os
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional
+
+from fastapi import WebSocketDisconnect
+
+from backend.app.metrics import metrics
+
+# 队列中的帧数达到该值后，同一回复的新片段合并到队尾的片段帧中
+WS_SEND_QUEUE_HIGH_WATER = int(os.getenv("WS_SEND_QUEUE_HIGH_WATER", "32"))
+# 队列中待发送内容的字符数上限，超过后断开该连接，客户端凭续传令牌重连续读
+WS_SEND_QUEUE_MAX_CHARS = int(os.getenv("WS_SEND_QUEUE_MAX_CHARS", "1000000"))
+# 发送续传令牌与关闭帧的超时（秒）
+SLOW_CONSUMER_CLOSE_TIMEOUT = 5.0
+# 因发送过慢断开连接时的关闭码
+CLOSE_SLOW_CONSUMER = 4003
+
+queued_frames_gauge = metrics.gauge("ws_send_queue_frames", "所有连接发送队列中待发送的帧数")
+queued_chars_gauge = metrics.gauge("ws_send_queue_chars", "所有连接发送队列中待发送内容的字符数")
+queue_depth_histogram = metrics.histogram("ws_send_queue_depth", "入队时该连接发送队列的帧数",
+                                          buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128, 256))
+coalesced_counter = metrics.counter("ws_send_coalesced_chunks_total", "超过高水位后合并到已排队帧中的片段数")
+slow_consumer_counter = metrics.counter("ws_slow_consumer_disconnects_total", "发送队列超过上限被断开的连接数")
+
+
+class QueueClosed(WebSocketDisconnect):
+    """连接的发送队列已关闭（连接已断开或因发送过慢被断开），按连接断开处理"""
+
+
+class PendingFrame:
+    __slots__ = ("frame", "key", "seq", "size", "mergeable")
+
+    def __init__(self, frame: Dict, key: Optional[str], seq: Optional[int], size: int, mergeable: bool):
+        self.frame = frame
+        # 帧所属的请求ID与该帧覆盖到的片段序号，用于合并与生成续传令牌
+        self.key = key
+        self.seq = seq
+        self.size = size
+        self.mergeable = mergeable
+
+
+class SendQueue:
+    """单个连接的有界发送队列：生成推送只入队不等待套接字，由按需启动的写任务按序发出。
+    慢速客户端积压超过高水位时把同一回复的片段合并，超过字符上限时丢弃积压并断开连接，
+    断开前发送各进行中回复的续传偏移"""
+    def __init__(self, write: Callable[[Dict], Awaitable[None]], merge: Callable[[Dict, Dict, Optional[int]], None],
+                 resume_frame: Callable[[List[Dict]], Dict], close: Callable[[int, str], Awaitable[None]],
+                 high_water: int = WS_SEND_QUEUE_HIGH_WATER, max_chars: int = WS_SEND_QUEUE_MAX_CHARS):
+        self._write = write
+        self._merge = merge
+        self._resume_frame = resume_frame
+        self._close = close
+        self.high_water = high_water
+        self.max_chars = max_chars
+        self.pending: Deque[PendingFrame] = deque()
+        self.chars = 0
+        # 请求ID -> 下一个未写出的片段序号，回复结束帧写出后移除
+        self.resume_offsets: Dict[str, int] = {}
+        self.closed = False
+        # 队列关闭后入队抛出的断开码：慢速断开为CLOSE_SLOW_CONSUMER，其他情况为连接异常断开
+        self.close_code = 1006
+        self._writer: Optional[asyncio.Task] = None
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def put(self, frame: Dict, key: Optional[str] = None, seq: Optional[int] = None, size: int = 0,
+            mergeable: bool = False):
+        if self.closed:
+            raise QueueClosed(self.close_code)
+        queue_depth_histogram.observe(len(self.pending))
+        tail = self.pending[-1] if self.pending else None
+        # 队首的帧可能正在写出，只合并到它之后的帧中
+        if (mergeable and tail is not None and tail.mergeable and tail.key == key
+                and len(self.pending) >= max(self.high_water, 2)):
+            self._merge(tail.frame, frame, seq)
+            tail.seq = seq
+            tail.size += size
+            self._account(0, size)
+            coalesced_counter.inc()
+        else:
+            self.pending.append(PendingFrame(frame, key, seq, size, mergeable))
+            if key is not None and seq is not None:
+                self.resume_offsets.setdefault(key, seq)
+            self._account(1, size)
+        if self.chars > self.max_chars:
+            self._overflow()
+            raise QueueClosed(CLOSE_SLOW_CONSUMER)
+        if self._writer is None or self._writer.done():
+            # 空闲连接不常驻写任务，有待发送帧时才启动
+            self._writer = asyncio.create_task(self._drain())
+
+    def _account(self, frames: int, chars: int):
+        self.chars += chars
+        queued_frames_gauge.inc(frames)
+        queued_chars_gauge.inc(chars)
+
+    def _discard(self):
+        queued_frames_gauge.dec(len(self.pending))
+        queued_chars_gauge.dec(self.chars)
+        self.pending.clear()
+        self.chars = 0
+
+    async def _drain(self):
+        try:
+            while self.pending:
+                item = self.pending[0]
+                await self._write(item.frame)
+                if self.closed:
+                    return
+                # 写出后再出队，队列长度包含正在写出的帧
+                self.pending.popleft()
+                self._account(-1, -item.size)
+                if item.key is not None:
+                    if item.seq is not None:
+                        self.resume_offsets[item.key] = item.seq + 1
+                    else:
+                        # 结束帧已写出，该回复无需续传
+                        self.resume_offsets.pop(item.key, None)
+        except Exception as e:
+            # 写入失败说明连接已断开，由接收循环清理
+            print(f"发送队列写入失败: {str(e)}")
+            self.closed = True
+            self._discard()
+
+    def _overflow(self):
+        """积压超过上限：丢弃未发送的帧，发送续传令牌后断开，客户端重连后从令牌中的偏移续读"""
+        self.closed = True
+        self.close_code = CLOSE_SLOW_CONSUMER
+        slow_consumer_counter.inc()
+        for item in self.pending:
+            if item.key is not None and item.seq is not None:
+                self.resume_offsets.setdefault(item.key, item.seq)
+        tokens = [{"request_id": key, "offset": offset} for key, offset in self.resume_offsets.items()]
+        print(f"连接发送积压 {self.chars} 字符超过上限，断开并返回续传令牌: {tokens}")
+        self._discard()
+        writer = self._writer
+        asyncio.create_task(self._disconnect(writer, tokens))
+
+    async def _disconnect(self, writer: Optional[asyncio.Task], tokens: List[Dict]):
+        if writer is not None and not writer.done():
+            writer.cancel()
+            try:
+                await writer
+            except BaseException:
+                pass
+        try:
+            await asyncio.wait_for(self._write(self._resume_frame(tokens)), SLOW_CONSUMER_CLOSE_TIMEOUT)
+        except Exception:
+            pass
+        try:
+            await asyncio.wait_for(self._close(CLOSE_SLOW_CONSUMER, "slow consumer"), SLOW_CONSUMER_CLOSE_TIMEOUT)
+        except Exception as e:
+            print(f"断开慢速连接失败: {str(e)}")
+
+    async def join(self):
+        """等待已入队的帧全部写出；调用方超时取消时不影响写任务"""
+        while self._writer is not None and not self._writer.done():
+            await asyncio.shield(self._writer)
+
+    def close(self):
+        """连接已断开：停止写任务并丢弃未发送的帧"""
+        self.closed = True
+        if self._writer is not None and not self._writer.done():
+            self._writer.cancel()
+        self._discard()
@@ -0,0 +1,521 @@
+import asyncio
+import gzip
+import hashlib
+import json
+import os
+import sys
+import time
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncGenerator, Callable, Dict, List, Optional, Set, Tuple
+
+from backend.app.metrics import metrics
+
+# 每个会话最近的若干条消息保持原样，更早的长消息压缩存放
+SESSION_HOT_MESSAGES = int(os.getenv("SESSION_HOT_MESSAGES", "20"))
+# 超过该字节数的冷消息才压缩，短消息压缩收益不足以抵消开销
+SESSION_COMPRESS_MIN_BYTES = int(os.getenv("SESSION_COMPRESS_MIN_BYTES", "512"))
+SESSION_COMPRESS_COLD = os.getenv("SESSION_COMPRESS_COLD", "true").lower() == "true"
+COMPRESS_LEVEL = 6
+
+# 内存中会话历史的总预算（字节），超出后按最近最少使用的顺序换出到磁盘
+SESSION_MEMORY_BUDGET = int(os.getenv("SESSION_MEMORY_BUDGET_MB", "256")) * 1024 * 1024
+# 超过该时间（秒）未活动的会话无论预算如何都会换出
+SESSION_IDLE_SECONDS = float(os.getenv("SESSION_IDLE_SECONDS", "3600"))
+SESSION_SPILL_DIR = os.getenv("SESSION_SPILL_DIR", os.path.join("data", "sessions"))
+# 后台换出的检查间隔与每轮最多换出的会话数，分批进行以免长时间占用事件循环
+SESSION_EVICT_INTERVAL = float(os.getenv("SESSION_EVICT_INTERVAL", "5"))
+SESSION_EVICT_BATCH = int(os.getenv("SESSION_EVICT_BATCH", "50"))
+
+# 历史记忆模式：full每次发送完整历史；retrieval发送最近若干轮加上检索到的相关旧轮次，见retrieval_memory
+MEMORY_MODES = ("full", "retrieval")
+SESSION_MEMORY_MODE = os.getenv("SESSION_MEMORY_MODE", "full")
+
+# 磁盘读写放到单独线程中执行
+_io_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="session-spill")
+
+sessions_in_memory_gauge = metrics.gauge("sessions_in_memory", "内存中的会话数")
+sessions_spilled_gauge = metrics.gauge("sessions_spilled", "已换出到磁盘的会话数")
+session_bytes_gauge = metrics.gauge("session_memory_bytes", "内存中会话历史的占用字节数")
+session_evictions_counter = metrics.counter("session_evictions_total", "换出到磁盘的会话数")
+session_reloads_counter = metrics.counter("session_reloads_total", "从磁盘重新载入的会话数")
+
+
+class Message:
+    """紧凑的消息记录：无实例字典，角色字符串驻留共享，冷消息的内容以zlib压缩的字节保存"""
+    __slots__ = ("role", "_data", "compressed", "raw_size")
+
+    def __init__(self, role: str, content: str):
+        self.role = sys.intern(role)
+        self._data = content
+        self.compressed = False
+        self.raw_size = len(content.encode("utf-8"))
+
+    @property
+    def content(self) -> str:
+        if self.compressed:
+            return zlib.decompress(self._data).decode("utf-8")
+        return self._data
+
+    def compress(self) -> bool:
+        """压缩内容，只有压缩后确实更小时才保留压缩结果"""
+        if self.compressed or self.raw_size < SESSION_COMPRESS_MIN_BYTES:
+            return False
+        data = zlib.compress(self._data.encode("utf-8"), COMPRESS_LEVEL)
+        if len(data) >= self.raw_size:
+            return False
+        self._data = data
+        self.compressed = True
+        return True
+
+    @property
+    def nbytes(self) -> int:
+        # 角色字符串为驻留共享对象，不计入单条消息
+        return sys.getsizeof(self) + sys.getsizeof(self._data)
+
+    def to_dict(self) -> Dict[str, str]:
+        return {"role": self.role, "content": self.content}
+
+
+class Session:
+    """一个会话的对话历史"""
+    def __init__(self, agent_id: str, session_id: str, owner: Optional[str] = None):
+        self.agent_id = agent_id
+        self.session_id = session_id
+        # 创建会话的客户端ID，历史接口只向该客户端返回会话；为None时（旧版本创建）只有管理员可以读取
+        self.owner = owner
+        self.messages: List[Message] = []
+        self.created_at = time.time()
+        self.updated_at = self.created_at
+        # 最近一次读写的时间，与SessionStore中的LRU顺序一致，用于空闲超时换出
+        self.accessed_at = self.created_at
+        # 会话每次创建生成新的epoch，同一键被删除后重建时旧的分页ETag随之失效
+        self.epoch = uuid.uuid4().hex[:12]
+        # 增量维护的消息记录及其内容的内存占用，供内存报告使用
+        self.message_bytes = 0
+        self.raw_bytes = 0
+        self.memory_mode = SESSION_MEMORY_MODE
+        # 检索模式的轮次索引，只在内存中维护，换出后丢弃、再次使用时重建
+        self.turn_index = None
+
+    @property
+    def key(self) -> str:
+        return session_key(self.agent_id, self.session_id)
+
+    def append(self, role: str, content: str):
+        message = Message(role, content)
+        self.messages.append(message)
+        self.message_bytes += message.nbytes
+        self.raw_bytes += message.raw_size
+        self.updated_at = time.time()
+        # 刚移出热区的消息转为压缩存放
+        cold = len(self.messages) - SESSION_HOT_MESSAGES - 1
+        if SESSION_COMPRESS_COLD and cold >= 0:
+            self._compress(self.messages[cold])
+
+    def _compress(self, message: Message):
+        before = message.nbytes
+        if message.compress():
+            self.message_bytes += message.nbytes - before
+
+    @property
+    def nbytes(self) -> int:
+        return self.message_bytes + sys.getsizeof(self.messages)
+
+    def summary(self) -> Dict:
+        return {
+            "agent_id": self.agent_id,
+            "session_id": self.session_id,
+            "owner": self.owner,
+            "message_count": len(self.messages),
+            "created_at": self.created_at,
+            "updated_at": self.updated_at,
+        }
+
+    def snapshot(self) -> Tuple[Dict, List[Tuple[str, bool, object]]]:
+        """在事件循环线程中截取会话状态，只复制引用，解压与编码留给写盘线程"""
+        header = dict(self.summary(), epoch=self.epoch, memory_mode=self.memory_mode)
+        return header, [(message.role, message.compressed, message._data) for message in self.messages]
+
+    @classmethod
+    def restore(cls, data: Dict) -> "Session":
+        """从换出文件的内容重建会话，冷消息重新压缩"""
+        session = cls(data["agent_id"], data["session_id"], data.get("owner"))
+        session.epoch = data["epoch"]
+        session.created_at = data["created_at"]
+        session.memory_mode = data.get("memory_mode", SESSION_MEMORY_MODE)
+        messages = data["messages"]
+        for index, (role, content) in enumerate(messages):
+            message = Message(role, content)
+            session.messages.append(message)
+            session.message_bytes += message.nbytes
+            session.raw_bytes += message.raw_size
+            if SESSION_COMPRESS_COLD and index < len(messages) - SESSION_HOT_MESSAGES:
+                session._compress(message)
+        session.updated_at = data["updated_at"]
+        return session
+
+
+def session_key(agent_id: str, session_id: str) -> str:
+    """会话历史的唯一键"""
+    return f"{agent_id}:{session_id}"
+
+
+SUMMARY_FIELDS = ("agent_id", "session_id", "owner", "message_count", "created_at", "updated_at")
+
+
+def _meta_path(path: str) -> str:
+    return path[:-len(".json.gz")] + ".meta.json"
+
+
+def _write_meta_file(path: str, summary: Dict):
+    """在换出文件旁写入未压缩的会话摘要，启动时只读摘要即可建立索引；
+    记录换出文件的大小，两者不一致（写入中途退出）时以换出文件为准"""
+    meta = {field: summary[field] for field in SUMMARY_FIELDS}
+    meta["size"] = os.path.getsize(path)
+    meta_path = _meta_path(path)
+    with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(meta, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(meta_path + ".tmp", meta_path)
+
+
+def _write_spill_file(path: str, header: Dict, messages: List[Tuple[str, bool, object]]):
+    data = dict(header, messages=[
+        [role, zlib.decompress(payload).decode("utf-8") if compressed else payload]
+        for role, compressed, payload in messages
+    ])
+    # 先写临时文件再替换，进程中途退出也不会留下半个文件
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+    _write_meta_file(path, header)
+
+
+def _read_spill_file(path: str) -> Dict:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _read_spill_summary(path: str) -> Tuple[Dict, bool]:
+    """读取换出会话的摘要，返回(摘要, 是否从摘要文件读取)。摘要文件缺失（旧版本写入）或与换出文件不一致时
+    读取完整的换出文件并补写摘要文件"""
+    try:
+        with open(_meta_path(path), encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("size") == os.path.getsize(path):
+            return {field: meta[field] for field in SUMMARY_FIELDS}, True
+    except (OSError, ValueError, KeyError):
+        pass
+    data = _read_spill_file(path)
+    summary = {field: data[field] for field in SUMMARY_FIELDS if field not in ("owner", "message_count")}
+    # 旧版本写入的换出文件没有owner
+    summary["owner"] = data.get("owner")
+    summary["message_count"] = len(data["messages"])
+    try:
+        _write_meta_file(path, summary)
+    except OSError as e:
+        print(f"会话摘要文件写入失败 {path}: {str(e)}")
+    return summary, False
+
+
+class SessionNotLoadedError(RuntimeError):
+    """会话已换出到磁盘，访问前需要先await SessionStore.ensure_loaded"""
+
+
+class SessionStore:
+    """服务器端会话存储，为每个会话保存对话历史；超出内存预算或长时间空闲的会话换出到磁盘，再次访问时自动载入"""
+    def __init__(self, spill_dir: str = SESSION_SPILL_DIR, memory_budget: int = SESSION_MEMORY_BUDGET,
+                 idle_seconds: float = SESSION_IDLE_SECONDS):
+        # 按最近访问顺序排列，最久未访问的在最前
+        self.sessions: "OrderedDict[str, Session]" = OrderedDict()
+        # 已换出的会话摘要，会话列表无需读盘即可包含它们
+        self.spilled: Dict[str, Dict] = {}
+        self.spill_dir = spill_dir
+        self.memory_budget = memory_budget
+        self.idle_seconds = idle_seconds
+        self.total_bytes = 0
+        # 任一会话发生变化时递增，用于会话列表的ETag
+        self.version = 0
+        self._loading: Dict[str, asyncio.Future] = {}
+        # 正在写盘的会话键与写盘任务，同一会话同时只有一个线程写换出文件
+        self._spilling: Dict[str, asyncio.Future] = {}
+        self._evictor: Optional[asyncio.Task] = None
+        # 返回有进行中生成的会话键，这些会话不换出，回复完成后才能写入历史（由main设置为生成任务注册表的查询）
+        self.in_use: Callable[[], Set[str]] = set
+
+    def _spill_path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json.gz")
+
+    def _touch(self, key: str):
+        self.sessions.move_to_end(key)
+        self.sessions[key].accessed_at = time.time()
+
+    def _admit(self, key: str, session: Session):
+        session.accessed_at = time.time()
+        self.sessions[key] = session
+        self.total_bytes += session.nbytes
+        self.spilled.pop(key, None)
+        self._update_gauges()
+
+    def _update_gauges(self):
+        sessions_in_memory_gauge.set(len(self.sessions))
+        sessions_spilled_gauge.set(len(self.spilled))
+        session_bytes_gauge.set(self.total_bytes)
+
+    def get(self, agent_id: str, session_id: str) -> Optional[Session]:
+        """返回内存中的会话；会话已换出时抛出SessionNotLoadedError，不在事件循环中读盘"""
+        key = session_key(agent_id, session_id)
+        session = self.sessions.get(key)
+        if session is None and key in self.spilled:
+            raise SessionNotLoadedError(f"会话 {key} 已换出到磁盘，需要先调用ensure_loaded")
+        if session is not None:
+            self._touch(key)
+        return session
+
+    async def ensure_loaded(self, agent_id: str, session_id: str):
+        """会话已换出时在线程池中读盘载入，之后的同步访问都命中内存"""
+        key = session_key(agent_id, session_id)
+        if key in self.sessions or key not in self.spilled:
+            return
+        pending = self._loading.get(key)
+        if pending is not None:
+            await asyncio.shield(pending)
+            return
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._loading[key] = future
+        try:
+            data = await loop.run_in_executor(_io_executor, _read_spill_file, self._spill_path(key))
+            # 读盘期间可能已经被导入等操作重新创建
+            if key not in self.sessions:
+                self._admit(key, Session.restore(data))
+                session_reloads_counter.inc()
+                print(f"会话 {key} 已从磁盘载入")
+            future.set_result(None)
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            del self._loading[key]
+
+    def get_or_create(self, agent_id: str, session_id: str, owner: Optional[str] = None) -> Session:
+        """获取会话，不存在时创建并记录所属的客户端"""
+        session = self.get(agent_id, session_id)
+        if session is None:
+            key = session_key(agent_id, session_id)
+            print(f"为会话 {key} 创建新的历史记录")
+            session = Session(agent_id, session_id, owner)
+            self._admit(key, session)
+            self.version += 1
+        return session
+
+    def append(self, agent_id: str, session_id: str, role: str, content: str):
+        """追加一条消息到会话历史"""
+        session = self.get_or_create(agent_id, session_id)
+        before = session.nbytes
+        session.append(role, content)
+        self.total_bytes += session.nbytes - before
+        session_bytes_gauge.set(self.total_bytes)
+        self.version += 1
+
+    async def commit_reply(self, agent_id: str, session_id: str, text: str):
+        """把生成完成的回复写入历史；生成期间会话可能已换出（如停机排空），写入前先载入"""
+        await self.ensure_loaded(agent_id, session_id)
+        self.append(agent_id, session_id, "assistant", text)
+
+    def set_memory_mode(self, agent_id: str, session_id: str, mode: str):
+        """设置会话的历史记忆模式，之后的请求沿用该模式"""
+        if mode not in MEMORY_MODES:
+            raise ValueError(f"未知的记忆模式: {mode}")
+        self.get_or_create(agent_id, session_id).memory_mode = mode
+
+    def history(self, agent_id: str, session_id: str) -> List[Dict[str, str]]:
+        """返回发送给模型的历史消息列表（临时构建的字典，冷消息在此解压）"""
+        session = self.get(agent_id, session_id)
+        return [message.to_dict() for message in session.messages] if session else []
+
+    def list_sessions(self, agent_id: Optional[str] = None, owner: Optional[str] = None) -> List[Dict]:
+        """会话摘要列表（含已换出的会话），按最后活动时间倒序；指定owner时只列出该客户端创建的会话"""
+        summaries = [s.summary() for s in self.sessions.values()] + list(self.spilled.values())
+        return sorted(
+            (s for s in summaries
+             if (agent_id is None or s["agent_id"] == agent_id) and (owner is None or s["owner"] == owner)),
+            key=lambda s: s["updated_at"], reverse=True,
+        )
+
+    def page(self, session: Session, before: Optional[int], limit: int):
+        """倒序分页：返回序号小于before的最后limit条消息及其起止序号"""
+        end = len(session.messages) if before is None else max(0, min(before, len(session.messages)))
+        start = max(0, end - limit)
+        return start, end, session.messages[start:end]
+
+    async def spill(self, key: str) -> bool:
+        """把会话写入磁盘并移出内存；写盘期间会话有新消息时保留在内存中"""
+        # 后台换出与shed、flush可能同时换出同一会话：等待进行中的写盘结束后按最新状态重新判断。
+        # 调用方被取消时线程中的写盘仍会继续，因此等待的是写盘任务本身
+        pending = self._spilling.get(key)
+        while pending is not None and not pending.done():
+            await asyncio.wait([pending])
+            pending = self._spilling.get(key)
+        session = self.sessions.get(key)
+        if session is None:
+            return False
+        header, messages = session.snapshot()
+        updated_at = session.updated_at
+        loop = asyncio.get_running_loop()
+        write = loop.run_in_executor(_io_executor, _write_spill_file, self._spill_path(key), header, messages)
+        self._spilling[key] = write
+        write.add_done_callback(lambda done: self._spill_finished(key, done))
+        await asyncio.shield(write)
+        if self.sessions.get(key) is not session or session.updated_at != updated_at:
+            return False
+        del self.sessions[key]
+        self.total_bytes -= session.nbytes
+        self.spilled[key] = session.summary()
+        session_evictions_counter.inc()
+        self._update_gauges()
+        return True
+
+    def _spill_finished(self, key: str, write: asyncio.Future):
+        if self._spilling.get(key) is write:
+            del self._spilling[key]
+        # 调用方已被取消时写盘错误无人接收，在此记录
+        if not write.cancelled() and write.exception() is not None:
+            print(f"会话 {key} 写盘失败: {str(write.exception())}")
+
+    def _eviction_candidates(self) -> List[str]:
+        """按最近最少使用顺序挑选本轮要换出的会话：先满足内存预算，再处理空闲超时的会话。
+        空闲按最近读写时间accessed_at判断，与LRU顺序一致"""
+        now = time.time()
+        excess = self.total_bytes - self.memory_budget
+        busy = self.in_use()
+        candidates = []
+        for key, session in self.sessions.items():
+            if len(candidates) >= SESSION_EVICT_BATCH:
+                break
+            if key in busy:
+                # 回复仍在生成的会话完成后才换出
+                continue
+            if excess > 0:
+                excess -= session.nbytes
+            elif now - session.accessed_at <= self.idle_seconds:
+                # 之后的会话访问时间更近，不会空闲超时
+                break
+            candidates.append(key)
+        return candidates
+
+    async def evict_once(self) -> int:
+        evicted = 0
+        for key in self._eviction_candidates():
+            try:
+                if await self.spill(key):
+                    evicted += 1
+            except OSError as e:
+                print(f"会话 {key} 换出失败: {str(e)}")
+                break
+        return evicted
+
+    async def shed(self):
+        """内存占用超出预算时立即换出最久未用的会话，供批量导入使用，不等待后台换出任务"""
+        while self.total_bytes > self.memory_budget:
+            if not await self.evict_once():
+                break
+
+    async def iter_sessions(self) -> AsyncGenerator[Tuple[Dict, List[Tuple[str, str]]], None]:
+        """逐个产出会话的头信息与消息（角色、内容）列表，供导出使用。
+        内存中的会话按开始时的消息数截取；已换出的会话在线程中读盘，不载入内存、不影响换出顺序"""
+        loop = asyncio.get_running_loop()
+        for key in list(self.sessions) + list(self.spilled):
+            session = self.sessions.get(key)
+            if session is not None:
+                header, messages = session.snapshot()
+                yield header, [(role, zlib.decompress(payload).decode("utf-8") if compressed else payload)
+                               for role, compressed, payload in messages]
+            elif key in self.spilled:
+                # 开始导出后才换出的会话同样从磁盘读取
+                try:
+                    data = await loop.run_in_executor(_io_executor, _read_spill_file, self._spill_path(key))
+                except (OSError, ValueError) as e:
+                    print(f"导出时跳过无法读取的会话 {key}: {str(e)}")
+                    continue
+                messages = data.pop("messages")
+                yield data, [(role, content) for role, content in messages]
+
+    async def flush(self) -> int:
+        """把内存中的所有会话写入磁盘（停机前调用），返回写入的会话数；重启后由start载入索引"""
+        if self._evictor is not None:
+            self._evictor.cancel()
+        flushed = 0
+        for key in list(self.sessions):
+            try:
+                if await self.spill(key):
+                    flushed += 1
+            except OSError as e:
+                print(f"会话 {key} 写盘失败: {str(e)}")
+        return flushed
+
+    async def _eviction_loop(self):
+        while True:
+            await asyncio.sleep(SESSION_EVICT_INTERVAL)
+            evicted = await self.evict_once()
+            if evicted:
+                print(f"已将 {evicted} 个会话换出到磁盘，内存中剩余 {len(self.sessions)} 个，占用 {self.total_bytes} 字节")
+
+    async def start(self):
+        """载入磁盘上已换出会话的索引，并启动后台换出任务"""
+        os.makedirs(self.spill_dir, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        self.spilled.update(await loop.run_in_executor(_io_executor, self._scan_spill_dir))
+        self._update_gauges()
+        if self._evictor is None or self._evictor.done():
+            self._evictor = asyncio.create_task(self._eviction_loop())
+
+    def _scan_spill_dir(self) -> Dict[str, Dict]:
+        """从各换出文件旁的摘要文件建立索引，只有缺少摘要文件的会话需要读取并解压完整历史"""
+        index = {}
+        rebuilt = 0
+        for name in os.listdir(self.spill_dir):
+            if not name.endswith(".json.gz"):
+                continue
+            try:
+                summary, from_meta = _read_spill_summary(os.path.join(self.spill_dir, name))
+            except (OSError, ValueError, KeyError) as e:
+                print(f"跳过无法读取的会话文件 {name}: {str(e)}")
+                continue
+            rebuilt += not from_meta
+            index[session_key(summary["agent_id"], summary["session_id"])] = summary
+        if rebuilt:
+            print(f"为 {rebuilt} 个换出的会话补写了摘要文件")
+        return index
+
+    def memory_report(self, top: int = 20) -> Dict:
+        """按会话、智能体与总量统计会话历史的内存占用"""
+        agents: Dict[str, Dict] = {}
+        total = {"sessions": 0, "messages": 0, "bytes": 0, "raw_bytes": 0, "compressed_messages": 0}
+        for session in self.sessions.values():
+            compressed = sum(1 for message in session.messages if message.compressed)
+            for bucket in (agents.setdefault(session.agent_id, dict.fromkeys(total, 0)), total):
+                bucket["sessions"] += 1
+                bucket["messages"] += len(session.messages)
+                bucket["bytes"] += session.nbytes
+                bucket["raw_bytes"] += session.raw_bytes
+                bucket["compressed_messages"] += compressed
+        largest = sorted(self.sessions.values(), key=lambda s: s.nbytes, reverse=True)[:top]
+        return {
+            "total": total,
+            "agents": agents,
+            "sessions": [
+                dict(session.summary(), bytes=session.nbytes, raw_bytes=session.raw_bytes)
+                for session in largest
+            ],
+            "spilled_sessions": len(self.spilled),
+            "memory_budget_bytes": self.memory_budget,
+        }
+
+
+# 创建全局会话存储实例
+session_store = SessionStore()
@@ -0,0 +1,232 @@
+import asyncio
+import json
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncGenerator, AsyncIterator, Dict, List, Optional, Tuple
+
+from backend.app.metrics import metrics
+from backend.app.session_store import MEMORY_MODES, SessionStore
+
+# 导出时每积累多少字节的JSONL压缩并发送一次
+EXPORT_CHUNK_BYTES = int(os.getenv("SESSION_EXPORT_CHUNK_KB", "256")) * 1024
+# 导出文件的gzip压缩级别
+EXPORT_COMPRESS_LEVEL = 6
+# 导入时每批写入会话存储的消息条数，每批之后检查内存预算并让出事件循环
+IMPORT_BATCH_SIZE = int(os.getenv("SESSION_IMPORT_BATCH_SIZE", "1000"))
+# 导入时单行的最大字节数，超出时中止导入，避免缺少换行的输入占满内存
+IMPORT_MAX_LINE_BYTES = int(os.getenv("SESSION_IMPORT_MAX_LINE_MB", "8")) * 1024 * 1024
+# 每次解压的最大输出字节数，高压缩比的输入也只按该大小逐段展开
+IMPORT_INFLATE_BYTES = 1024 * 1024
+# 导入结果中最多列出的错误行数
+IMPORT_MAX_ERRORS = 20
+# zlib的wbits：31写出gzip格式，47自动识别gzip与zlib格式
+GZIP_WBITS = 31
+AUTO_WBITS = 47
+IMPORT_ROLES = ("user", "assistant", "system")
+
+export_turns_counter = metrics.counter("session_export_turns_total", "导出的会话消息数")
+import_turns_counter = metrics.counter("session_import_turns_total", "导入的会话消息数")
+
+# 压缩在线程中进行（zlib压缩时释放GIL），不阻塞事件循环
+_compress_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-export")
+
+
+class ImportFormatError(ValueError):
+    """导入的数据无法继续解析（不是有效的gzip流，或单行过长）"""
+
+
+def export_line(header: Dict, seq: int, role: str, content: str) -> str:
+    """一条消息对应的JSONL行；每个会话的第一行（seq为0）附带会话的创建时间、最后活动时间、记忆模式与所属客户端"""
+    record = {
+        "agent_id": header["agent_id"],
+        "session_id": header["session_id"],
+        "seq": seq,
+        "role": role,
+        "content": content,
+    }
+    if seq == 0:
+        record["session"] = {
+            "created_at": header["created_at"],
+            "updated_at": header["updated_at"],
+            "memory_mode": header.get("memory_mode"),
+            "owner": header.get("owner"),
+        }
+    return json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+
+
+async def export_sessions(store: SessionStore, agent_id: Optional[str] = None) -> AsyncGenerator[bytes, None]:
+    """逐段产出gzip压缩的JSONL，每行一条消息。一次只持有一个会话的消息与一段待压缩数据，
+    由StreamingResponse逐段发送，客户端读取慢时在发送处等待，内存占用与导出总量无关"""
+    loop = asyncio.get_running_loop()
+    compressor = zlib.compressobj(EXPORT_COMPRESS_LEVEL, zlib.DEFLATED, GZIP_WBITS)
+    lines: List[str] = []
+    size = 0
+    sessions = 0
+    turns = 0
+    async for header, messages in store.iter_sessions():
+        if agent_id is not None and header["agent_id"] != agent_id:
+            continue
+        sessions += 1
+        for seq, (role, content) in enumerate(messages):
+            line = export_line(header, seq, role, content)
+            lines.append(line)
+            size += len(line)
+            if size >= EXPORT_CHUNK_BYTES:
+                payload = "".join(lines).encode("utf-8")
+                lines.clear()
+                size = 0
+                data = await loop.run_in_executor(_compress_executor, compressor.compress, payload)
+                if data:
+                    yield data
+        turns += len(messages)
+        export_turns_counter.inc(len(messages))
+    payload = "".join(lines).encode("utf-8")
+    yield await loop.run_in_executor(_compress_executor, lambda: compressor.compress(payload) + compressor.flush())
+    print(f"会话导出完成: {sessions} 个会话，{turns} 条消息")
+
+
+class SessionImporter:
+    """分批导入JSONL流（gzip压缩或未压缩）：逐段解压、按行解析，每IMPORT_BATCH_SIZE行写入一次会话存储，
+    超出内存预算时立即换出最久未用的会话，内存占用与导入总量无关。
+    行的seq小于会话已有消息数时视为已导入而跳过，因此中断后可以重新导入同一文件"""
+    def __init__(self, store: SessionStore, batch_size: int = IMPORT_BATCH_SIZE):
+        self.store = store
+        self.batch_size = batch_size
+        # (行号, 记录)
+        self.batch: List[Tuple[int, Dict]] = []
+        self.lines = 0
+        self.turns = 0
+        self.sessions_created = 0
+        self.skipped = 0
+        self.error_count = 0
+        self.errors: List[str] = []
+
+    def _error(self, message: str, line_no: Optional[int] = None):
+        self.error_count += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append(f"第{line_no or self.lines}行: {message}")
+
+    def _parse(self, line: bytes) -> Optional[Dict]:
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            self._error(f"无效的JSON: {str(e)}")
+            return None
+        if not isinstance(record, dict):
+            self._error("每行应为一个JSON对象")
+            return None
+        for field in ("agent_id", "session_id", "content"):
+            if not isinstance(record.get(field), str) or (field != "content" and not record[field]):
+                self._error(f"缺少或无效的字段 {field}")
+                return None
+        if record.get("role") not in IMPORT_ROLES:
+            self._error(f"未知的角色: {record.get('role')!r}")
+            return None
+        seq = record.get("seq")
+        if seq is not None and (isinstance(seq, bool) or not isinstance(seq, int) or seq < 0):
+            self._error(f"无效的seq: {seq!r}")
+            return None
+        return record
+
+    async def _feed_lines(self, pending: bytes, data: bytes) -> bytes:
+        """解析data中的完整行，返回末尾不完整的部分"""
+        buffer = pending + data
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            line = buffer[start:end].strip()
+            start = end + 1
+            self.lines += 1
+            if not line:
+                continue
+            record = self._parse(line)
+            if record is not None:
+                self.batch.append((self.lines, record))
+                if len(self.batch) >= self.batch_size:
+                    await self.flush()
+        rest = buffer[start:]
+        if len(rest) > IMPORT_MAX_LINE_BYTES:
+            raise ImportFormatError(f"第{self.lines + 1}行超过 {IMPORT_MAX_LINE_BYTES} 字节")
+        return rest
+
+    async def feed(self, chunks: AsyncIterator[bytes]):
+        """读取整个字节流；按开头的魔数判断是否为gzip压缩"""
+        decompressor = None
+        compressed = None
+        pending = b""
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            if compressed is None:
+                compressed = chunk[:2] == b"\x1f\x8b"
+                decompressor = zlib.decompressobj(AUTO_WBITS) if compressed else None
+            if not compressed:
+                pending = await self._feed_lines(pending, chunk)
+                continue
+            data = chunk
+            try:
+                while data:
+                    pending = await self._feed_lines(pending, decompressor.decompress(data, IMPORT_INFLATE_BYTES))
+                    data = decompressor.unconsumed_tail
+                    if not data and decompressor.eof and decompressor.unused_data:
+                        # 多个gzip文件直接拼接（cat a.gz b.gz）时逐个解压
+                        data = decompressor.unused_data
+                        decompressor = zlib.decompressobj(AUTO_WBITS)
+            except zlib.error as e:
+                raise ImportFormatError(f"gzip数据无效: {str(e)}")
+        if compressed and not decompressor.eof:
+            raise ImportFormatError("gzip数据不完整")
+        if pending:
+            # 最后一行可以没有换行
+            await self._feed_lines(pending, b"\n")
+        await self.flush()
+
+    async def flush(self):
+        """把当前批次写入会话存储"""
+        batch, self.batch = self.batch, []
+        store = self.store
+        imported = 0
+        for line_no, record in batch:
+            agent_id, session_id = record["agent_id"], record["session_id"]
+            await store.ensure_loaded(agent_id, session_id)
+            session = store.get(agent_id, session_id)
+            count = len(session.messages) if session is not None else 0
+            seq = record.get("seq")
+            if seq is not None and seq < count:
+                self.skipped += 1
+                continue
+            if seq is not None and seq > count:
+                # 前面的消息缺失或导入失败，不在历史中留下空洞
+                self._error(f"会话 {agent_id}:{session_id} 的seq {seq} 与已有消息数 {count} 不连续", line_no)
+                continue
+            if session is None:
+                session = store.get_or_create(agent_id, session_id)
+                self.sessions_created += 1
+                meta = record.get("session")
+                if isinstance(meta, dict):
+                    if isinstance(meta.get("created_at"), (int, float)):
+                        session.created_at = meta["created_at"]
+                    if meta.get("memory_mode") in MEMORY_MODES:
+                        session.memory_mode = meta["memory_mode"]
+                    if isinstance(meta.get("owner"), str):
+                        session.owner = meta["owner"]
+            store.append(agent_id, session_id, record["role"], record["content"])
+            imported += 1
+        self.turns += imported
+        import_turns_counter.inc(imported)
+        await store.shed()
+        # 数据已在内存中时ensure_loaded不会等待，这里让出事件循环，导入期间不影响其他请求
+        await asyncio.sleep(0)
+
+    def report(self) -> Dict:
+        return {
+            "lines": self.lines,
+            "imported": self.turns,
+            "sessions_created": self.sessions_created,
+            "skipped": self.skipped,
+            "error_count": self.error_count,
+            "errors": self.errors,
+        }
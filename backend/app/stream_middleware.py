@@ -0,0 +1,464 @@
+import asyncio
+import json
+import os
+import re
+import time
+from typing import AsyncGenerator, Callable, Dict, List, Optional
+
+from backend.app.content_filter import StreamMatcher, term_list
+from backend.app.metrics import metrics
+
+# 某个处理阶段保留文本的最长时间（毫秒），超时后强制放行，限制首字节延迟的增加
+STREAM_HOLDBACK_MS = float(os.getenv("STREAM_HOLDBACK_MS", "300"))
+# 中间件配置文件（JSON）：{"agents": {"agent_id": ["stage", ...]}}，覆盖智能体自带配置
+STREAM_MIDDLEWARE_CONFIG_PATH = os.getenv("STREAM_MIDDLEWARE_CONFIG", "")
+
+holdback_release_counter = metrics.counter("stream_stage_forced_releases_total", "处理阶段因超时强制放行的次数")
+
+
+class StreamStage:
+    """流式处理阶段：feed接收新片段并返回可以立即输出的文本，无法确定的部分（例如可能被下一个片段补全的词）留在阶段内部。
+    release在等待超时时放弃判断、输出保留的文本；flush在流结束时调用"""
+    name = ""
+
+    def feed(self, text: str) -> str:
+        raise NotImplementedError
+
+    def held(self) -> int:
+        """当前保留的字符数"""
+        return 0
+
+    def release(self) -> str:
+        return self.flush()
+
+    def flush(self) -> str:
+        return ""
+
+
+class PreambleStripper(StreamStage):
+    """去掉部分提示词会产生的开场白（如“好的，以下是……：”）：只检查回复的第一行，
+    且只有以冒号结尾、后面还有正文时才去掉，整个回复只有这一行时原样保留"""
+    name = "strip_preamble"
+    PATTERN = re.compile(r"^\s*(好的|当然|没问题|明白了?|收到|以下是|下面是|OK|Sure)[^\n]{0,60}[：:]\s*$", re.IGNORECASE)
+    # 第一行超过该长度就不可能是开场白，直接放行
+    MAX_LINE = 80
+
+    def __init__(self):
+        self.buffer = ""
+        # 匹配开场白的第一行，等待正文出现后才去掉
+        self.candidate = ""
+        self.decided = False
+
+    def feed(self, text: str) -> str:
+        if self.decided:
+            return text
+        self.buffer += text
+        if self.candidate:
+            return self._after_candidate()
+        if "\n" in self.buffer:
+            first_line, rest = self.buffer.split("\n", 1)
+            if self.PATTERN.match(first_line):
+                self.candidate = first_line + "\n"
+                self.buffer = rest
+                return self._after_candidate()
+            return self.release()
+        if len(self.buffer) > self.MAX_LINE:
+            return self.release()
+        return ""
+
+    def _after_candidate(self) -> str:
+        # 开场白后的空行一并去掉；只有空白时继续等待
+        body = self.buffer.lstrip()
+        if not body:
+            return ""
+        self.decided = True
+        self.candidate = ""
+        self.buffer = ""
+        return body
+
+    def held(self) -> int:
+        return len(self.candidate) + len(self.buffer)
+
+    def release(self) -> str:
+        self.decided = True
+        text = self.candidate + self.buffer
+        self.candidate = ""
+        self.buffer = ""
+        return text
+
+    def flush(self) -> str:
+        # 没有正文时不做处理，避免把短回复整体删掉
+        return self.release()
+
+
+class MarkdownNormalizer(StreamStage):
+    """规范化Markdown：统一换行符，两个及以上井号的标题后补空格，行首•·●统一为“- ”列表，连续空行最多保留一个。
+    单个井号开头的行可能是话题标签（如“#好物分享”），保持不变；```或~~~围起的代码块内不做任何改动。
+    只在行首做判断，因此最多保留一个行首前缀和尚未确定的换行"""
+    name = "normalize_markdown"
+    BULLETS = "•·●▪"
+    # 行首前缀最多检查的字符数（“######”加一个字符，或缩进后的“```”）
+    MAX_PREFIX = 7
+    MAX_INDENT = 12
+
+    def __init__(self):
+        self.line_start = True
+        self.prefix = ""
+        self.newlines = 0
+        self.pending_cr = False
+        self.started = False
+        # 所在代码块的围栏（```或~~~），不在代码块中时为空
+        self.fence = ""
+
+    def feed(self, text: str) -> str:
+        if self.pending_cr:
+            text = "\r" + text
+            self.pending_cr = False
+        if text.endswith("\r"):
+            # \r\n可能被拆到两个片段中
+            text = text[:-1]
+            self.pending_cr = True
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+        out = []
+        for ch in text:
+            if ch == "\n":
+                if self.prefix:
+                    out.append(self._emit_newlines())
+                    out.append(self.prefix)
+                    self.prefix = ""
+                self.newlines += 1
+                self.line_start = True
+                continue
+            if self.line_start:
+                self.prefix += ch
+                # 前缀之前的空行属于判断前所在的区域（闭合围栏之前的空行仍在代码块内）
+                fenced = bool(self.fence)
+                decided = self._decide_prefix()
+                if decided is None:
+                    continue
+                out.append(self._emit_newlines(fenced))
+                out.append(decided)
+                self.prefix = ""
+                self.line_start = False
+                continue
+            out.append(ch)
+        return "".join(out)
+
+    def _emit_newlines(self, fenced: Optional[bool] = None) -> str:
+        # 回复开头的空行直接去掉，代码块之外的连续空行最多保留一个
+        if fenced is None:
+            fenced = bool(self.fence)
+        if fenced:
+            count = self.newlines
+        else:
+            count = min(self.newlines, 2) if self.started else 0
+        self.newlines = 0
+        self.started = True
+        return "\n" * count
+
+    def _decide_prefix(self) -> Optional[str]:
+        """返回规范化后的行首文本，仍无法确定时返回None"""
+        prefix = self.prefix
+        stripped = prefix.lstrip(" \t")
+        if not stripped:
+            return None if len(prefix) < self.MAX_INDENT else prefix
+        if stripped[0] in "`~":
+            marker = stripped[0] * 3
+            if len(stripped) < 3 and stripped == stripped[0] * len(stripped):
+                return None
+            if stripped.startswith(marker) and (not self.fence or self.fence == marker):
+                self.fence = "" if self.fence else marker
+            return prefix
+        if self.fence or stripped != prefix:
+            # 代码块内与缩进的行不做改动
+            return prefix
+        if prefix[0] in self.BULLETS:
+            # 再看一个字符，去掉符号后原有的空格
+            if len(prefix) == 1:
+                return None
+            return "- " + prefix[1:].lstrip(" ")
+        if prefix[0] == "#":
+            hashes = len(prefix) - len(prefix.lstrip("#"))
+            if hashes == len(prefix) and len(prefix) < self.MAX_PREFIX:
+                return None
+            rest = prefix[hashes:]
+            if 2 <= hashes <= 6 and rest and not rest.startswith(" "):
+                return prefix[:hashes] + " " + rest
+            return prefix
+        return prefix
+
+    def held(self) -> int:
+        # 行首保留的换行不可见，不计入放行判断
+        return len(self.prefix)
+
+    def release(self) -> str:
+        if not self.prefix:
+            return ""
+        text = self._emit_newlines() + self.prefix
+        self.prefix = ""
+        self.line_start = False
+        return text
+
+    def flush(self) -> str:
+        # 末尾的换行与未完成的前缀原样输出（末尾空行同样压缩）
+        text = self._emit_newlines() + self.prefix
+        self.prefix = ""
+        return text
+
+
+def _is_ascii_alnum(ch: str) -> bool:
+    return ch.isascii() and ch.isalnum()
+
+
+class FullwidthPunctuation(StreamStage):
+    """把半角标点转换为全角，用于文言风格的回复；数字中的小数点、千分位以及网址、代码块与行内代码保持不变，
+    英文双引号按出现顺序转换为「」。判断需要看下一个字符，因此行末的标点会保留到下一个片段"""
+    name = "fullwidth_punctuation"
+    MAPPING = {",": "，", ".": "。", "?": "？", "!": "！", ":": "：", ";": "；", "(": "（", ")": "）"}
+    # 网址协议名（“https”等），后面跟“:/”时进入网址
+    SCHEME = re.compile(r"[A-Za-z][A-Za-z0-9+.-]{1,15}")
+
+    def __init__(self):
+        self.previous = ""
+        self.pending = ""
+        self.quote_open = False
+        # 当前连续的ASCII非空白字符（最近的一段），用于识别网址开头
+        self.word = ""
+        self.line_start = True
+        # 连续反引号的个数及其是否从行首开始
+        self.ticks = 0
+        self.ticks_at_line_start = False
+        self.fence = False
+        self.code = False
+        self.url = False
+
+    def feed(self, text: str) -> str:
+        out = []
+        for ch in text:
+            if self.pending:
+                out.append(self._convert(self.pending, ch))
+                self._advance(self.pending)
+                self.pending = ""
+            if ch == "`":
+                if not self.ticks:
+                    self.ticks_at_line_start = self.line_start
+                self.ticks += 1
+            elif self.ticks:
+                self._end_ticks()
+            if ch == "\n":
+                # 行内代码与网址不跨行
+                self.code = False
+                self.url = False
+            elif self.url and (ch.isspace() or not ch.isascii()):
+                self.url = False
+            if ch == "`" or self.fence or self.code or self.url:
+                out.append(ch)
+                self._advance(ch)
+                continue
+            if ch in ",.:":
+                # 是否在数字、网址等之间要看下一个字符
+                self.pending = ch
+                continue
+            out.append(self._convert(ch, ""))
+            self._advance(ch)
+        return "".join(out)
+
+    def _advance(self, ch: str):
+        self.previous = ch
+        self.line_start = ch == "\n"
+        if ch.isascii() and not ch.isspace():
+            self.word = (self.word + ch)[-16:]
+        else:
+            self.word = ""
+
+    def _end_ticks(self):
+        """一段反引号结束：行首三个以上为代码块围栏，其余为行内代码的开始或结束"""
+        if self.ticks >= 3 and self.ticks_at_line_start:
+            self.fence = not self.fence
+            self.code = False
+        elif not self.fence:
+            self.code = not self.code
+        self.ticks = 0
+
+    def _convert(self, ch: str, following: str) -> str:
+        if ch == '"':
+            self.quote_open = not self.quote_open
+            return "「" if self.quote_open else "」"
+        if ch == ":" and following == "/" and self.SCHEME.fullmatch(self.word):
+            self.url = True
+            return ch
+        if ch == "." and self.word.lower() == "www" and _is_ascii_alnum(following):
+            self.url = True
+            return ch
+        if ch in ",.:" and _is_ascii_alnum(self.previous) and _is_ascii_alnum(following):
+            return ch
+        if ch == "." and (self.previous == "." or following == "."):
+            # 省略号等连续的点保持原样
+            return ch
+        return self.MAPPING.get(ch, ch)
+
+    def held(self) -> int:
+        return len(self.pending)
+
+    def flush(self) -> str:
+        if not self.pending:
+            return ""
+        text = self._convert(self.pending, "")
+        self._advance(self.pending)
+        self.pending = ""
+        return text
+
+
+class ContentFilter(StreamStage):
+    """违禁词过滤：基于Aho-Corasick自动机跨片段匹配，按CONTENT_FILTER_MODE遮盖或中止。
+    每个请求开始时取当前词表，词表热更新不影响进行中的回复"""
+    name = "content_filter"
+
+    def __init__(self):
+        self.matcher = StreamMatcher(term_list.current())
+
+    def feed(self, text: str) -> str:
+        return self.matcher.feed(text)
+
+    def held(self) -> int:
+        return self.matcher.held()
+
+    def release(self) -> str:
+        # 保留的尾部可能是违禁词的前半部分，超时也不能放行；其长度不超过最长违禁词
+        return ""
+
+    def flush(self) -> str:
+        return self.matcher.flush()
+
+
+# 可在配置中按名称引用的处理阶段
+STAGES: Dict[str, Callable[[], StreamStage]] = {
+    PreambleStripper.name: PreambleStripper,
+    MarkdownNormalizer.name: MarkdownNormalizer,
+    FullwidthPunctuation.name: FullwidthPunctuation,
+    ContentFilter.name: ContentFilter,
+}
+
+
+class StreamPipeline:
+    """按顺序串联的处理阶段，每个请求新建一份（阶段有跨片段的状态）"""
+    def __init__(self, stages: List[StreamStage], holdback: float = STREAM_HOLDBACK_MS / 1000):
+        self.stages = stages
+        self.holdback = holdback
+
+    def _feed(self, text: str) -> str:
+        for stage in self.stages:
+            if not text:
+                break
+            text = stage.feed(text)
+        return text
+
+    def _drain(self, method: str) -> str:
+        """依次对每个阶段调用release/flush，前一阶段输出的文本继续流经后续阶段"""
+        out = ""
+        for stage in self.stages:
+            out = stage.feed(out) if out else ""
+            out += getattr(stage, method)()
+        return out
+
+    def held(self) -> int:
+        return sum(stage.held() for stage in self.stages)
+
+    def transform_text(self, text: str) -> str:
+        """非流式回复一次性处理"""
+        return self._feed(text) + self._drain("flush")
+
+    async def process(self, chunks: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+        """在上游片段与连接之间运行处理链；有文本被保留超过holdback时强制放行"""
+        queue: asyncio.Queue = asyncio.Queue()
+        done = object()
+
+        async def pump():
+            try:
+                async for chunk in chunks:
+                    queue.put_nowait(chunk)
+            except Exception as e:
+                queue.put_nowait(e)
+            finally:
+                queue.put_nowait(done)
+
+        pump_task = asyncio.create_task(pump())
+        held_since: Optional[float] = None
+        try:
+            while True:
+                if held_since is None:
+                    item = await queue.get()
+                else:
+                    remaining = held_since + self.holdback - time.monotonic()
+                    try:
+                        item = await asyncio.wait_for(queue.get(), max(0.0, remaining))
+                    except asyncio.TimeoutError:
+                        holdback_release_counter.inc()
+                        released = self._drain("release")
+                        held_since = None
+                        if released:
+                            yield released
+                        continue
+                if item is done:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                out = self._feed(item)
+                if out:
+                    yield out
+                if self.held() == 0:
+                    held_since = None
+                elif held_since is None or out:
+                    held_since = time.monotonic()
+            tail = self._drain("flush")
+            if tail:
+                yield tail
+        finally:
+            pump_task.cancel()
+            try:
+                await pump_task
+            except asyncio.CancelledError:
+                pass
+            await chunks.aclose()
+
+
+class StreamMiddleware:
+    """为每个智能体构建处理链：配置文件优先，其次是智能体自带的stream_middleware"""
+    def __init__(self):
+        self.agent_stages: Dict[str, List[str]] = {}
+        if STREAM_MIDDLEWARE_CONFIG_PATH:
+            self.load_config(STREAM_MIDDLEWARE_CONFIG_PATH)
+
+    def load_config(self, path: str):
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        for agent_id, names in config.get("agents", {}).items():
+            unknown = [name for name in names if name not in STAGES]
+            if unknown:
+                raise ValueError(f"未知的流式处理阶段: {', '.join(unknown)}")
+            self.agent_stages[agent_id] = list(names)
+        print(f"已加载流式处理配置: {path}")
+
+    def stages_for(self, agent) -> List[str]:
+        if agent.id in self.agent_stages:
+            return self.agent_stages[agent.id]
+        return list(getattr(agent, "stream_middleware", None) or [])
+
+    def pipeline_for(self, agent) -> Optional[StreamPipeline]:
+        names = self.stages_for(agent)
+        if not names:
+            return None
+        return StreamPipeline([STAGES[name]() for name in names])
+
+    def wrap(self, agent, chunks: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+        """未配置处理阶段时原样返回上游片段，没有额外开销"""
+        pipeline = self.pipeline_for(agent)
+        return pipeline.process(chunks) if pipeline else chunks
+
+    def transform_text(self, agent, text: str) -> str:
+        pipeline = self.pipeline_for(agent)
+        return pipeline.transform_text(text) if pipeline else text
+
+
+# 创建全局流式处理中间件实例
+stream_middleware = StreamMiddleware()
@@ -0,0 +1,228 @@
+import json
+import os
+import random
+import secrets
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+from backend.app.metrics import metrics
+
+# 采样率：0表示关闭（默认），1表示全部采样；未采样的请求只有一次随机数比较的开销
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+# 导出文件路径（每行一个OTLP/JSON格式的ExportTraceServiceRequest），为空时只保存在进程内
+TRACE_EXPORT_FILE = os.getenv("TRACE_EXPORT_FILE", "")
+# 进程内保留的最近trace数量，可通过 /admin/traces 查看
+TRACE_BUFFER_SIZE = int(os.getenv("TRACE_BUFFER_SIZE", "200"))
+SERVICE_NAME = "agent-dialogue-backend"
+
+# OTLP中的span类型与状态码
+SPAN_KIND_INTERNAL = 1
+SPAN_KIND_SERVER = 2
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+# 文件写入放到单独线程中进行，不阻塞事件循环
+_export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace-export")
+
+traces_exported_counter = metrics.counter("traces_exported_total", "已导出的trace数")
+
+# 当前任务中活动的span，新建span时默认作为父span
+_active_span: ContextVar[Optional["Span"]] = ContextVar("active_span", default=None)
+
+
+def _otlp_value(value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: Dict[str, Any]) -> List[Dict]:
+    return [{"key": key, "value": _otlp_value(value)} for key, value in attributes.items() if value is not None]
+
+
+class Span:
+    """trace中的一个阶段，可作为上下文管理器使用，异常退出时记录错误状态"""
+    __slots__ = ("trace", "span_id", "parent_id", "name", "kind", "start_ns", "end_ns",
+                 "attributes", "events", "error", "_token")
+
+    def __init__(self, trace: "Trace", name: str, parent_id: Optional[str], kind: int, attributes: Dict[str, Any]):
+        self.trace = trace
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes
+        self.events: List[Dict] = []
+        self.error: Optional[str] = None
+        self._token = None
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def add_event(self, name: str, **attributes):
+        self.events.append({"name": name, "time_ns": time.time_ns(), "attributes": attributes})
+
+    def end(self, error: Optional[str] = None):
+        if self.end_ns is not None:
+            return
+        if error:
+            self.error = error
+        self.end_ns = time.time_ns()
+        self.trace._on_span_end()
+
+    def activate(self):
+        """设为当前任务的活动span，之后新建的span默认以它为父span；不要跨yield保持激活"""
+        self._token = _active_span.set(self)
+        return self
+
+    def __enter__(self):
+        return self.activate()
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._token is not None:
+            _active_span.reset(self._token)
+            self._token = None
+        self.end(f"{exc_type.__name__}: {exc}" if exc_type else None)
+
+    def to_otlp(self) -> Dict:
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(self.end_ns or time.time_ns()),
+            "attributes": _otlp_attributes(self.attributes),
+            "status": {"code": STATUS_ERROR, "message": self.error} if self.error else {"code": STATUS_OK},
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if self.events:
+            span["events"] = [
+                {"timeUnixNano": str(event["time_ns"]), "name": event["name"], "attributes": _otlp_attributes(event["attributes"])}
+                for event in self.events
+            ]
+        return span
+
+
+class Trace:
+    """一次请求的全部span；所有span结束后整体导出，后台生成晚于连接结束的情况也能完整记录"""
+    sampled = True
+
+    def __init__(self, tracer: "Tracer", name: str, **attributes):
+        self.tracer = tracer
+        self.trace_id = secrets.token_hex(16)
+        self.spans: List[Span] = []
+        self._open = 0
+        self.root = self.span(name, kind=SPAN_KIND_SERVER, **attributes)
+
+    def span(self, name: str, parent: Optional[Span] = None, kind: int = SPAN_KIND_INTERNAL, **attributes) -> Span:
+        """新建子span；未指定父span时使用当前活动span（须属于本trace），否则挂在根span下"""
+        if parent is None:
+            active = _active_span.get()
+            parent = active if active is not None and active.trace is self else getattr(self, "root", None)
+        span = Span(self, name, parent.span_id if parent else None, kind, attributes)
+        self.spans.append(span)
+        self._open += 1
+        return span
+
+    def _on_span_end(self):
+        self._open -= 1
+        if self._open == 0:
+            self.tracer.export(self)
+
+    def to_otlp(self) -> Dict:
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": _otlp_attributes({"service.name": SERVICE_NAME})},
+                "scopeSpans": [{
+                    "scope": {"name": "backend.app.tracing"},
+                    "spans": [span.to_otlp() for span in self.spans],
+                }],
+            }]
+        }
+
+
+class _NoopSpan:
+    """未采样时使用的空span，所有操作都不做任何事"""
+    trace_id = None
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def add_event(self, name: str, **attributes):
+        pass
+
+    def end(self, error: Optional[str] = None):
+        pass
+
+    def activate(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+class _NoopTrace:
+    sampled = False
+    trace_id = None
+    root = _NoopSpan()
+
+    def span(self, name: str, parent=None, kind: int = SPAN_KIND_INTERNAL, **attributes):
+        return self.root
+
+
+NOOP_TRACE = _NoopTrace()
+
+
+class Tracer:
+    """按采样率创建trace，结束的trace保存在进程内并可选写入OTLP/JSON文件"""
+    def __init__(self, sample_rate: float = TRACE_SAMPLE_RATE, export_file: str = TRACE_EXPORT_FILE,
+                 buffer_size: int = TRACE_BUFFER_SIZE):
+        self.sample_rate = sample_rate
+        self.export_file = export_file
+        self.recent: deque = deque(maxlen=buffer_size)
+
+    def start_trace(self, name: str, sampled: Optional[bool] = None, **attributes):
+        """开始一个trace；sampled为None时按采样率决定"""
+        if sampled is None:
+            sampled = self.sample_rate > 0 and (self.sample_rate >= 1 or random.random() < self.sample_rate)
+        if not sampled:
+            return NOOP_TRACE
+        return Trace(self, name, **attributes)
+
+    def export(self, trace: Trace):
+        self.recent.append(trace)
+        traces_exported_counter.inc()
+        if self.export_file:
+            line = json.dumps(trace.to_otlp(), ensure_ascii=False, separators=(",", ":"))
+            _export_executor.submit(self._write_line, line)
+
+    def _write_line(self, line: str):
+        try:
+            with open(self.export_file, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            print(f"写入trace文件失败: {str(e)}")
+
+    def find(self, trace_id: str) -> Optional[Trace]:
+        for trace in self.recent:
+            if trace.trace_id == trace_id:
+                return trace
+        return None
+
+
+# 创建全局tracer实例
+tracer = Tracer()
@@ -0,0 +1,160 @@
+import asyncio
+import os
+import random
+import re
+from typing import TYPE_CHECKING, Awaitable, Callable, Dict, List, Optional, Sequence
+
+from backend.app.content_filter import BLOCKED_REPLY
+from backend.app.generations import Generation, generation_registry, stream_generation
+from backend.app.request_context import RequestContext, reset_request_context, set_request_context
+from backend.app.stream_middleware import stream_middleware
+
+if TYPE_CHECKING:
+    from backend.app.agent_manager import BaseAgent
+    from backend.app.protocol import ProtocolV1
+
+# 一次请求最多生成的变体数
+VARIANTS_MAX = int(os.getenv("VARIANTS_MAX", "10"))
+
+# 评分中正文长度的理想区间（字符）
+TARGET_MIN_CHARS = 300
+TARGET_MAX_CHARS = 1000
+# 理想的emoji密度：每多少个字符一个emoji
+TARGET_CHARS_PER_EMOJI = 40
+
+_EMOJI_PATTERN = re.compile(
+    "[\U0001F300-\U0001FAFF\U00002600-\U000027BF\U0001F000-\U0001F2FF\U00002B00-\U00002BFF]"
+)
+
+
+def variant_request_id(request_id: str, index: int) -> str:
+    """每个变体作为独立的生成任务，拥有自己的请求ID，可单独续传"""
+    return f"{request_id}.v{index}"
+
+
+def score_variant(text: str, keywords: Sequence[str] = ()) -> Dict[str, float]:
+    """本地快速评分：长度是否在理想区间、emoji密度、关键词覆盖，各项0~1，total为加权和"""
+    length = len(text)
+    if length == 0:
+        return {"length": 0.0, "emoji": 0.0, "keywords": 0.0, "total": 0.0}
+
+    if length < TARGET_MIN_CHARS:
+        length_score = length / TARGET_MIN_CHARS
+    elif length > TARGET_MAX_CHARS:
+        length_score = max(0.0, 1 - (length - TARGET_MAX_CHARS) / TARGET_MAX_CHARS)
+    else:
+        length_score = 1.0
+
+    # emoji过少显得干，过多显得乱，偏离理想密度越远得分越低
+    emojis = len(_EMOJI_PATTERN.findall(text))
+    ideal = length / TARGET_CHARS_PER_EMOJI
+    emoji_score = max(0.0, 1 - abs(emojis - ideal) / max(ideal, 1.0))
+
+    keyword_score = 0.0
+    if keywords:
+        hits = sum(1 for keyword in keywords if keyword and keyword in text)
+        # 命中三个以上关键词即视为满分，避免鼓励堆砌
+        keyword_score = min(1.0, hits / 3)
+
+    total = 0.4 * length_score + 0.3 * emoji_score + 0.3 * keyword_score
+    return {
+        "length": round(length_score, 3),
+        "emoji": round(emoji_score, 3),
+        "keywords": round(keyword_score, 3),
+        "total": round(total, 3),
+    }
+
+
+def rank_variants(texts: Dict[int, str], keywords: Sequence[str] = ()) -> List[Dict]:
+    """按评分从高到低排列变体"""
+    ranking = [
+        {"variant": index, "chars": len(text), "scores": score_variant(text, keywords)}
+        for index, text in texts.items()
+    ]
+    ranking.sort(key=lambda item: item["scores"]["total"], reverse=True)
+    return ranking
+
+
+class VariantSet:
+    """同一请求的多个变体；全部结束后（无论连接是否仍在）评分，并把选中的变体写入对话历史"""
+    def __init__(self, directives: List[str], keywords: Sequence[str], rank: bool,
+                 on_complete: Callable[[str], Awaitable[None]]):
+        self.directives = directives
+        self.keywords = keywords
+        self.rank = rank
+        self.on_complete = on_complete
+        self.ranking: Optional[List[Dict]] = None
+        self.chosen: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+
+    def watch(self, generations: List[Generation]):
+        self.task = asyncio.create_task(self._collect(generations))
+
+    async def _collect(self, generations: List[Generation]):
+        # 生成任务被取消时也会正常结束，这里不会因单个变体失败而中断
+        await asyncio.wait([generation.task for generation in generations])
+        # 命中违禁词被中止的变体不参与评选
+        texts = {index: generation.text for index, generation in enumerate(generations)
+                 if generation.text and not generation.blocked}
+        if not texts:
+            if any(generation.blocked for generation in generations):
+                await self._commit(BLOCKED_REPLY)
+            return
+        if self.rank:
+            self.ranking = rank_variants(texts, self.keywords)
+            self.chosen = self.ranking[0]["variant"]
+        else:
+            self.chosen = min(texts)
+        # 历史中只保留一个回复：开启评分时为得分最高的变体，否则为第一个变体
+        await self._commit(texts[self.chosen])
+
+    async def _commit(self, text: str):
+        try:
+            await self.on_complete(text)
+        except Exception as e:
+            print(f"变体写入历史失败: {str(e)}")
+
+
+async def _skip_commit(_text: str):
+    pass
+
+
+async def stream_variants(protocol: "ProtocolV1", agent: "BaseAgent", request_id: str, context: RequestContext,
+                          messages: List[Dict[str, str]], directives: List[str], rank: bool,
+                          on_complete: Callable[[str], Awaitable[None]]):
+    """并发生成多个变体，每个变体是独立的生成任务并在各自的通道上交错推送，总耗时接近单个回复"""
+    variant_set = VariantSet(directives, agent.variant_keywords, rank, on_complete)
+    generations = []
+    for index, directive in enumerate(directives):
+        # 每个变体有自己的请求上下文（实际模型、路由结果互不覆盖），在创建任务前设置以便任务继承
+        variant_context = RequestContext(
+            agent_id=context.agent_id,
+            session_id=context.session_id,
+            model_override=context.model_override,
+            max_tokens=context.max_tokens,
+            client_id=context.client_id,
+            priority=context.priority,
+            deadline=context.deadline,
+        )
+        variant_context.trace = context.trace
+        token = set_request_context(variant_context)
+        try:
+            generations.append(generation_registry.start(
+                variant_request_id(request_id, index),
+                agent.id,
+                variant_context,
+                stream_middleware.wrap(agent, agent.process_variant_stream(messages, directive, seed=random.randint(1, 2 ** 31 - 1))),
+                # 单个变体不直接写入历史，由VariantSet在全部结束后选定
+                on_complete=_skip_commit,
+                channel=index,
+            ))
+        finally:
+            reset_request_context(token)
+    variant_set.watch(generations)
+
+    await asyncio.gather(*(
+        stream_generation(protocol, generation, trace=context.trace) for generation in generations
+    ))
+    await variant_set.task
+    if variant_set.ranking:
+        await protocol.send_variants(agent.id, request_id, variant_set.chosen, variant_set.ranking)
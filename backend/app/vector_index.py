@@ -0,0 +1,158 @@
+import math
+import os
+import re
+import zlib
+from typing import Dict, Hashable, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # 未安装numpy时使用稀疏向量的纯Python实现，结果相同但检索较慢
+    np = None
+
+# 哈希嵌入的维度，越大冲突越少、占用内存越多
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "512"))
+# 参与嵌入的字符n-gram长度及权重：单字区分度低，权重较小
+NGRAM_WEIGHTS = {1: 0.5, 2: 1.0, 3: 1.0}
+
+# 去掉空白与标点，只保留文字、数字与字母
+_NON_WORD = re.compile(r"[\W_]+")
+# 提问中常见、不影响语义的虚词，去掉后同一问题的不同问法更接近
+_FILLER = re.compile("请问|怎么样|怎么|怎样|如何|一下|一个|可以|能否|能不能|是否|吗|呢|吧|啊|的|了")
+
+
+def _add_feature(features: Dict[int, float], key: str, weight: float, dim: int):
+    # crc32在不同进程间稳定，便于向量随数据持久化
+    h = zlib.crc32(key.encode("utf-8"))
+    index = h % dim
+    features[index] = features.get(index, 0.0) + (weight if h & 0x80000000 else -weight)
+
+
+def _hashed_ngrams(text: str, dim: int) -> Dict[int, float]:
+    """字符n-gram特征哈希（带符号，减小冲突带来的偏差），返回未归一化的稀疏向量"""
+    normalized = _FILLER.sub("", _NON_WORD.sub("", text.lower()))
+    features: Dict[int, float] = {}
+    for n, weight in NGRAM_WEIGHTS.items():
+        for i in range(len(normalized) - n + 1):
+            _add_feature(features, normalized[i:i + n], weight, dim)
+    return features
+
+
+def _normalize(features: Dict[int, float], dim: int):
+    norm = math.sqrt(sum(value * value for value in features.values())) or 1.0
+    if np is None:
+        return {index: value / norm for index, value in features.items() if value}
+    vector = np.zeros(dim, dtype=np.float32)
+    if features:
+        vector[list(features)] = list(features.values())
+        vector /= norm
+    return vector
+
+
+def embed_text(text: str, dim: int = EMBEDDING_DIM):
+    """本地离线嵌入：L2归一化后的哈希n-gram向量，内积即余弦相似度。
+    安装numpy时返回float32数组，否则返回{维度: 值}的稀疏字典；文本为空时为零向量"""
+    return _normalize(_hashed_ngrams(text, dim), dim)
+
+
+def embed_features(weights: Dict[str, float], dim: int = EMBEDDING_DIM):
+    """把调用方提取的{特征: 权重}按与embed_text相同的方式哈希并归一化，用于需要自行分词的场景"""
+    features: Dict[int, float] = {}
+    for key, weight in weights.items():
+        _add_feature(features, key, weight, dim)
+    return _normalize(features, dim)
+
+
+class VectorIndex:
+    """归一化向量的内存索引，按内积做暴力检索。numpy可用时向量按行存放在预分配的矩阵中，
+    一次矩阵乘法完成检索；删除的行放入空闲列表复用，不移动其他行"""
+    def __init__(self, dim: int = EMBEDDING_DIM, capacity: int = 256):
+        self.dim = dim
+        self.keys: List[Optional[Hashable]] = []  # 行号 -> 键，空闲行为None
+        self.slots: Dict[Hashable, int] = {}
+        self.free: List[int] = []
+        if np is not None:
+            self.matrix = np.zeros((capacity, dim), dtype=np.float32)
+            self.valid = np.zeros(capacity, dtype=bool)
+        else:
+            self.rows: List[Optional[Dict[int, float]]] = []
+
+    def __len__(self) -> int:
+        return len(self.slots)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.slots
+
+    @property
+    def nbytes(self) -> int:
+        if np is not None:
+            return self.matrix.nbytes + self.valid.nbytes
+        return sum(len(row) for row in self.rows if row) * 16
+
+    def _allocate(self) -> int:
+        if self.free:
+            return self.free.pop()
+        slot = len(self.keys)
+        self.keys.append(None)
+        if np is not None:
+            if slot >= len(self.matrix):
+                # 容量翻倍，摊还后每次添加为常数时间
+                capacity = max(2 * len(self.matrix), 1)
+                matrix = np.zeros((capacity, self.dim), dtype=np.float32)
+                matrix[:slot] = self.matrix[:slot]
+                valid = np.zeros(capacity, dtype=bool)
+                valid[:slot] = self.valid[:slot]
+                self.matrix, self.valid = matrix, valid
+        else:
+            self.rows.append(None)
+        return slot
+
+    def add(self, key: Hashable, vector):
+        """添加或替换键对应的向量"""
+        if key in self.slots:
+            self.remove(key)
+        slot = self._allocate()
+        self.keys[slot] = key
+        self.slots[key] = slot
+        if np is not None:
+            self.matrix[slot] = vector
+            self.valid[slot] = True
+        else:
+            self.rows[slot] = vector
+
+    def remove(self, key: Hashable) -> bool:
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return False
+        self.keys[slot] = None
+        if np is not None:
+            self.valid[slot] = False
+        else:
+            self.rows[slot] = None
+        self.free.append(slot)
+        return True
+
+    def search(self, vector, k: int = 1, min_score: float = -1.0) -> List[Tuple[Hashable, float]]:
+        """返回相似度最高的k个(键, 相似度)，按相似度从高到低，低于min_score的不返回"""
+        if not self.slots or k <= 0:
+            return []
+        used = len(self.keys)
+        if np is not None:
+            scores = self.matrix[:used] @ vector
+            scores[~self.valid[:used]] = -np.inf
+            if k == 1:
+                candidates = [int(np.argmax(scores))]
+            else:
+                k = min(k, used)
+                top = np.argpartition(-scores, k - 1)[:k]
+                candidates = top[np.argsort(-scores[top])].tolist()
+            return [(self.keys[slot], float(scores[slot])) for slot in candidates
+                    if self.keys[slot] is not None and scores[slot] >= min_score]
+        results = []
+        for slot, row in enumerate(self.rows):
+            if row is None:
+                continue
+            score = sum(value * row.get(index, 0.0) for index, value in vector.items())
+            if score >= min_score:
+                results.append((self.keys[slot], score))
+        results.sort(key=lambda item: item[1], reverse=True)
+        return results[:k]
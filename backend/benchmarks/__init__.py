@@ -0,0 +1 @@
+# 空文件，使目录成为 Python 包 
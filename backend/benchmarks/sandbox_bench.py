@@ -0,0 +1,63 @@
+"""沙箱代码运行延迟测试：比较每次当场启动工作进程（冷启动）与从预热进程池取用的耗时。
+
+用法（项目根目录）：
+    python -m backend.benchmarks.sandbox_bench --runs 50 --pool-size 4
+"""
+import argparse
+import asyncio
+import time
+
+from backend.app.sandbox import SandboxPool, sandbox_supported
+
+CODE = "import math\nsum(math.sqrt(i) for i in range(10000))"
+
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def measure(pool: SandboxPool, runs: int, interval: float):
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = await pool.run(CODE)
+        latencies.append((time.perf_counter() - start) * 1000)
+        if result["status"] != "ok":
+            print(f"运行失败: {result}")
+        # 模拟请求之间的间隔，预热池在间隔中补充进程
+        await asyncio.sleep(interval)
+    return latencies
+
+
+async def run(args):
+    cold = SandboxPool(size=1)
+    # 不预热也不补充：每次运行都当场启动进程
+    cold.closed = True
+    cold_latencies = await measure(cold, args.runs, 0)
+
+    warm = SandboxPool(size=args.pool_size)
+    await warm.start()
+    await asyncio.sleep(1.0)
+    warm_latencies = await measure(warm, args.runs, args.interval)
+    warm.close()
+
+    for name, latencies in (("冷启动", cold_latencies), ("预热池", warm_latencies)):
+        print(f"{name}: p50 {percentile(latencies, 0.5):.1f} ms，p99 {percentile(latencies, 0.99):.1f} ms，"
+              f"最大 {max(latencies):.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument("--pool-size", type=int, default=4)
+    parser.add_argument("--interval", type=float, default=0.1, help="两次运行之间的间隔（秒）")
+    args = parser.parse_args()
+    if not sandbox_supported():
+        print("当前平台不支持沙箱（需要Linux）")
+        return
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""语义缓存查询延迟测试：在指定条目数下测量嵌入与检索的耗时分布。
+
+用法（项目根目录）：
+    python -m backend.benchmarks.semantic_cache_bench --entries 100000 --queries 1000
+"""
+import argparse
+import random
+import time
+
+from backend.app.semantic_cache import SemanticCache
+from backend.app.vector_index import EMBEDDING_DIM, np
+
+# 随机提问使用的词：编程问题中常见的片段
+_WORDS = ["python", "列表", "字典", "如何", "怎么", "反转", "排序", "去重", "合并", "读取", "文件", "字符串",
+          "异常", "线程", "异步", "装饰器", "生成器", "正则", "json", "时间", "格式化", "类", "继承", "性能"]
+
+
+def random_prompt(rng: random.Random) -> str:
+    return "".join(rng.choice(_WORDS) for _ in range(rng.randint(3, 10))) + str(rng.randint(0, 10 ** 6))
+
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--entries", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    cache = SemanticCache(max_entries=args.entries, ttl=3600)
+    print(f"维度 {EMBEDDING_DIM}，numpy: {'是' if np is not None else '否（纯Python实现）'}")
+
+    start = time.perf_counter()
+    for _ in range(args.entries):
+        cache.store("bench", random_prompt(rng), "回复")
+    elapsed = time.perf_counter() - start
+    index = cache.agents["bench"].index
+    print(f"写入 {args.entries} 条: {elapsed:.2f}s（{elapsed / args.entries * 1e6:.1f} µs/条），"
+          f"索引 {index.nbytes / 1024 / 1024:.1f} MB")
+
+    latencies = []
+    hits = 0
+    for _ in range(args.queries):
+        prompt = random_prompt(rng)
+        start = time.perf_counter()
+        hits += cache.lookup("bench", prompt) is not None
+        latencies.append((time.perf_counter() - start) * 1000)
+    print(f"查询 {args.queries} 次: p50 {percentile(latencies, 0.5):.2f} ms，p99 {percentile(latencies, 0.99):.2f} ms，"
+          f"最大 {max(latencies):.2f} ms，命中 {hits} 次")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""语义缓存阈值评估：在人工标注的提问对上计算不同阈值下的命中准确率（precision）与召回率，
+same为True的是同一问题的不同问法，False的是字面相近、含义不同的提问（命中即返回错误答案）。
+
+用法（项目根目录）：
+    python -m backend.benchmarks.semantic_cache_eval
+    python -m backend.benchmarks.semantic_cache_eval --set holdout --show-errors
+
+dev用于调整query_terms的词典与SEMANTIC_CACHE_THRESHOLD；holdout在词典定稿后另行编写，没有参与调整，
+用来检查在没见过的提问上是否仍然成立。
+"""
+import argparse
+
+from backend.app.query_terms import analyze
+from backend.app.semantic_cache import SEMANTIC_CACHE_THRESHOLD
+from backend.app.vector_index import np
+
+DEV_PAIRS = [
+    # 同一问题的不同问法
+    ("怎么反转列表", "python列表如何倒序", True),
+    ("如何反转一个列表", "列表怎么倒过来", True),
+    ("python怎么对列表排序", "列表如何排序", True),
+    ("列表去重怎么做", "如何删除列表中的重复元素", True),
+    ("怎么读取json文件", "python如何读json文件", True),
+    ("如何把字符串转换成整数", "字符串怎么转为int", True),
+    ("字典怎么按值排序", "如何根据value对字典排序", True),
+    ("怎么合并两个字典", "两个字典如何合并", True),
+    ("如何获取当前时间", "python怎么得到现在的时间", True),
+    ("怎么判断文件是否存在", "如何检查文件存不存在", True),
+    ("如何删除字典中的键", "怎么从字典里移除一个key", True),
+    ("字符串怎么分割", "如何拆分字符串", True),
+    ("列表怎么添加元素", "如何往列表里追加元素", True),
+    ("如何把列表转换成字符串", "列表怎么转为字符串", True),
+    ("怎么写入csv文件", "如何保存数据到csv文件", True),
+    ("字符串如何替换", "怎么替换字符串里的内容", True),
+    ("怎么获取列表长度", "列表的元素个数怎么求", True),
+    ("如何遍历字典", "字典怎么迭代", True),
+    ("怎么把字符串转成小写", "字符串如何变成小写", True),
+    ("python怎么格式化字符串", "字符串格式化怎么写", True),
+    ("如何读取excel文件", "怎么用python读excel", True),
+    ("怎么创建虚拟环境", "如何新建虚拟环境", True),
+    ("怎么查找字符串中的子串", "如何在字符串里搜索子串", True),
+    ("列表怎么取最大值", "如何获取列表中的最大值", True),
+    ("怎么获取字典所有的键", "如何得到字典的全部key", True),
+    ("怎么捕获异常", "python如何捕捉异常", True),
+    ("如何让程序暂停几秒", "怎么让程序休眠几秒", True),
+    ("怎么计算列表的和", "如何对列表求和", True),
+    ("如何将字典写入json文件", "怎么把字典保存为json文件", True),
+    ("怎么判断字符串是否为空", "如何检查字符串是不是空的", True),
+    ("如何把两个列表合并", "两个列表怎么拼接", True),
+    ("怎么复制一个列表", "如何拷贝列表", True),
+    ("如何获取文件的扩展名", "怎么得到文件后缀名", True),
+    ("怎么删除列表中的元素", "如何从列表里移除元素", True),
+    ("如何生成随机数", "怎么产生随机数", True),
+    ("如何去掉字符串两端的空格", "怎么删除字符串首尾空格", True),
+    ("如何反转字符串", "字符串怎么倒序", True),
+    ("列表如何按降序排序", "怎么把列表从大到小排序", True),
+    ("怎么打开文件", "如何打开一个文件", True),
+    ("如何定义函数", "函数怎么定义", True),
+    ("怎么读取文件的每一行", "如何逐行读取文件", True),
+    ("如何把字符串转成列表", "字符串怎么转换为列表", True),
+    ("怎么判断列表是否为空", "如何检查列表是不是空", True),
+    ("如何获取字符串长度", "字符串长度怎么求", True),
+    ("怎么把时间戳转换成日期", "时间戳如何转为日期", True),
+    # 字面相近、含义不同
+    ("excel怎么删除第一行", "excel怎么删除最后一行", False),
+    ("列表升序排序", "列表降序排序", False),
+    ("如何读取json文件", "如何写入json文件", False),
+    ("怎么反转列表", "怎么反转字符串", False),
+    ("字典按键排序", "字典按值排序", False),
+    ("怎么把字符串转成大写", "怎么把字符串转成小写", False),
+    ("如何合并两个字典", "如何合并两个列表", False),
+    ("怎么删除列表的第一个元素", "怎么删除列表的最后一个元素", False),
+    ("如何获取列表最大值", "如何获取列表最小值", False),
+    ("怎么给列表添加元素", "怎么删除列表元素", False),
+    ("如何读取csv文件", "如何读取json文件", False),
+    ("怎么加密字符串", "怎么解密字符串", False),
+    ("怎么压缩文件", "怎么解压文件", False),
+    ("字符串怎么编码", "字符串怎么解码", False),
+    ("对象怎么序列化", "对象怎么反序列化", False),
+    ("python2怎么打印", "python3怎么打印", False),
+    ("怎么读取文件第3行", "怎么读取文件第5行", False),
+    ("怎么上传文件", "怎么下载文件", False),
+    ("字符串怎么拆分", "字符串怎么合并", False),
+    ("怎么获取绝对路径", "怎么获取相对路径", False),
+    ("怎么实现深拷贝", "怎么实现浅拷贝", False),
+    ("线程怎么创建", "进程怎么创建", False),
+    ("两个集合求交集", "两个集合求并集", False),
+    ("怎么删除excel的一行", "怎么删除excel的一列", False),
+    ("怎么等待1秒", "怎么等待1毫秒", False),
+    ("如何判断文件是否存在", "如何判断目录是否存在", False),
+    ("字典怎么获取所有键", "字典怎么获取所有值", False),
+    ("怎么同步执行函数", "怎么异步执行函数", False),
+    ("列表怎么排序", "字典怎么排序", False),
+    ("怎么把列表转换成字符串", "怎么把字符串转换成列表", False),
+    ("如何读取文件", "如何删除文件", False),
+    ("怎么获取当前时间", "怎么获取当前日期", False),
+    ("如何安装python", "如何卸载python", False),
+    ("怎么打开文件", "怎么关闭文件", False),
+    ("怎么启动线程", "怎么停止线程", False),
+    ("字符串转整数", "字符串转浮点数", False),
+    ("怎么连接mysql", "怎么连接redis", False),
+    ("列表切片怎么用", "字符串切片怎么用", False),
+    ("如何统计单词个数", "如何统计字符个数", False),
+    ("如何获取列表第一个元素", "如何获取列表第二个元素", False),
+    ("怎么在列表开头插入元素", "怎么在列表末尾插入元素", False),
+    ("怎么升级pip", "怎么降级pip", False),
+    ("字典按值升序排序", "字典按值降序排序", False),
+    ("如何把json转成字典", "如何把字典转成json", False),
+    ("如何判断是否为奇数", "如何判断是否为偶数", False),
+    ("怎么获取文件大小", "怎么获取文件名", False),
+    ("怎么求列表平均值", "怎么求列表中位数", False),
+    ("如何计算两个日期相差天数", "如何计算两个日期相差小时", False),
+    ("读取excel第一行", "读取excel最后一行", False),
+    ("python列表升序", "python列表降序", False),
+    ("怎么反转列表", "如何连接数据库", False),
+    ("如何读取json", "如何写入json", False),
+]
+
+HOLDOUT_PAIRS = [
+    # 同一问题的不同问法
+    ("怎么给字典排序", "字典如何排序", True),
+    ("如何删除字符串中的空格", "怎么去掉字符串里的空格", True),
+    ("列表怎么求最小值", "如何获取列表的最小值", True),
+    ("怎么把整数转换成字符串", "int怎么转为字符串", True),
+    ("如何读取文本文件", "怎么读文本文件", True),
+    ("怎么合并两个列表", "列表如何拼接", True),
+    ("如何统计列表中元素出现的次数", "怎么计数列表里元素出现的次数", True),
+    ("字典如何添加键值对", "怎么往字典里增加键值对", True),
+    ("如何把列表倒过来", "列表怎么逆序", True),
+    ("怎么判断字典是否为空", "如何检查字典是不是空的", True),
+    ("如何获取当前日期", "怎么得到今天的日期", True),
+    ("怎么将字符串转为大写", "字符串如何变成大写", True),
+    ("如何遍历列表", "列表怎么迭代", True),
+    ("怎么把json文件读进来", "如何加载json文件", True),
+    ("如何删除文件", "怎么移除文件", True),
+    ("怎么查找列表中元素的位置", "如何在列表里搜索元素的位置", True),
+    ("如何复制字典", "字典怎么拷贝", True),
+    ("怎么把字典写入文件", "如何保存字典到文件", True),
+    ("列表怎么按升序排列", "怎么把列表从小到大排序", True),
+    ("如何替换列表中的元素", "怎么替代列表里的元素", True),
+    ("怎么拆分字符串", "如何切割字符串", True),
+    ("如何生成随机整数", "怎么产生随机整数", True),
+    ("怎么判断目录是否存在", "如何检查文件夹存不存在", True),
+    ("如何获取字典的所有值", "怎么得到字典全部的value", True),
+    ("怎么让程序等待一秒", "如何让程序暂停1秒", True),
+    ("如何获取文件大小", "怎么得到文件的大小", True),
+    ("怎么创建一个空字典", "如何新建空字典", True),
+    ("如何去掉列表里的重复值", "列表怎么去重", True),
+    ("怎么把列表写入csv", "如何保存列表到csv", True),
+    ("如何捕获所有异常", "怎么捕捉全部异常", True),
+    # 字面相近、含义不同
+    ("怎么给字典排序", "怎么给元组排序", False),
+    ("如何删除字符串开头的空格", "如何删除字符串末尾的空格", False),
+    ("列表怎么求最小值", "列表怎么求最大值", False),
+    ("怎么把整数转换成字符串", "怎么把字符串转换成整数", False),
+    ("如何读取文本文件", "如何写入文本文件", False),
+    ("怎么合并两个列表", "怎么拆分列表", False),
+    ("如何统计列表中元素出现的次数", "如何统计字符串中字符出现的次数", False),
+    ("字典如何添加键值对", "字典如何删除键值对", False),
+    ("如何把列表倒过来", "如何把列表排序", False),
+    ("怎么判断字典是否为空", "怎么判断集合是否为空", False),
+    ("如何获取当前日期", "如何获取当前时间戳", False),
+    ("怎么将字符串转为大写", "怎么将字符串转为小写", False),
+    ("如何遍历列表", "如何遍历字典", False),
+    ("怎么读取json文件", "怎么读取yaml文件", False),
+    ("如何删除文件", "如何删除目录", False),
+    ("怎么在列表开头添加元素", "怎么在列表末尾添加元素", False),
+    ("如何复制字典", "如何合并字典", False),
+    ("怎么把字典写入json", "怎么把字典写入csv", False),
+    ("列表怎么按升序排列", "列表怎么按降序排列", False),
+    ("如何替换字符串中的第一个字符", "如何替换字符串中的最后一个字符", False),
+    ("怎么用pandas读取excel", "怎么用openpyxl读取excel", False),
+    ("如何生成随机整数", "如何生成随机浮点数", False),
+    ("怎么获取文件的创建时间", "怎么获取文件的修改时间", False),
+    ("如何获取字典的所有键", "如何获取字典的所有值", False),
+    ("怎么让程序等待一秒", "怎么让程序等待十秒", False),
+    ("如何获取文件大小", "如何获取文件扩展名", False),
+    ("怎么创建线程池", "怎么创建进程池", False),
+    ("如何压缩字符串", "如何解压字符串", False),
+    ("怎么把字符串编码成字节", "怎么把字节解码成字符串", False),
+    ("如何安装requests", "如何安装numpy", False),
+    ("怎么连接数据库", "怎么关闭数据库连接", False),
+    ("如何计算列表平均值", "如何计算列表求和", False),
+    ("怎么捕获异常", "怎么抛出异常", False),
+    ("如何获取列表第三个元素", "如何获取列表第四个元素", False),
+    ("怎么反转字典", "怎么合并字典", False),
+]
+
+
+def score_pair(a: str, b: str) -> float:
+    """与SemanticCache.lookup相同的判断：guard不同时不可能命中，记为-1"""
+    qa, qb = analyze(a), analyze(b)
+    if qa.guard != qb.guard:
+        return -1.0
+    if np is not None:
+        return float(qa.vector @ qb.vector)
+    return sum(value * qb.vector.get(index, 0.0) for index, value in qa.vector.items())
+
+
+def evaluate(pairs, threshold: float):
+    tp = sum(1 for _, _, same, score in pairs if same and score >= threshold)
+    fp = sum(1 for _, _, same, score in pairs if not same and score >= threshold)
+    positives = sum(1 for _, _, same, _ in pairs if same)
+    precision = tp / (tp + fp) if tp + fp else 1.0
+    recall = tp / positives if positives else 0.0
+    return precision, recall, tp, fp
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--set", choices=("dev", "holdout", "all"), default="dev")
+    parser.add_argument("--show-errors", action="store_true", help="列出当前阈值下判断错误的提问对")
+    args = parser.parse_args()
+    raw = {"dev": DEV_PAIRS, "holdout": HOLDOUT_PAIRS, "all": DEV_PAIRS + HOLDOUT_PAIRS}[args.set]
+    pairs = [(a, b, same, score_pair(a, b)) for a, b, same in raw]
+    positives = sum(1 for pair in pairs if pair[2])
+    print(f"{args.set}: {positives} 对同义提问，{len(pairs) - positives} 对含义不同的提问，"
+          f"其中 {sum(1 for pair in pairs if not pair[2] and pair[3] < 0)} 对被guard直接排除")
+
+    print(f"\n{'阈值':>6}{'准确率':>9}{'召回率':>9}{'误命中':>8}")
+    for threshold in (0.5, 0.55, 0.6, 0.65, 0.7, 0.75, 0.8, 0.85, 0.9):
+        precision, recall, _, fp = evaluate(pairs, threshold)
+        marker = " <- 当前" if abs(threshold - SEMANTIC_CACHE_THRESHOLD) < 1e-9 else ""
+        print(f"{threshold:>8.2f}{precision:>10.3f}{recall:>10.3f}{fp:>9}{marker}")
+
+    if args.show_errors:
+        print(f"\n阈值 {SEMANTIC_CACHE_THRESHOLD} 下的错误：")
+        for a, b, same, score in pairs:
+            hit = score >= SEMANTIC_CACHE_THRESHOLD
+            if hit != same:
+                print(f"  {'漏命中' if same else '误命中'} {score:.3f}  {a} | {b}")
+
+
+if __name__ == "__main__":
+    main()
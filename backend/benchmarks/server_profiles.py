@@ -0,0 +1,193 @@
+"""开发与生产启动方式对比：依次用run_backend.py（单进程、自动重载）与run_production.py启动服务器，施加相同的HTTP与WebSocket负载。
+
+用法（项目根目录，先停止占用8000端口的服务器；仅支持Linux）：
+    python -m backend.benchmarks.server_profiles --workers 4 --duration 10 --connections 200
+
+负载不调用上游模型：HTTP为keep-alive连接上反复请求/ready，WebSocket为每个连接反复发送ping并等待pong，
+测量的是事件循环、HTTP解析与WebSocket帧处理的开销。压测客户端与服务器在同一台机器上，
+客户端进程数（--load-processes）应留出足够的CPU给服务器。
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import re
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+import websockets
+
+HOST = "127.0.0.1"
+# run_backend.py固定监听该端口，两种方式使用同一端口
+PORT = 8000
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_CONTENT_LENGTH = re.compile(rb"content-length:\s*(\d+)", re.IGNORECASE)
+
+
+def profile_command(name: str, workers: int):
+    if name == "dev":
+        return [sys.executable, "run_backend.py"]
+    return [sys.executable, "run_production.py", "--host", HOST, "--port", str(PORT), "--workers", str(workers)]
+
+
+def wait_ready(timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f"http://{HOST}:{PORT}/ready", timeout=1.0) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"服务器 {timeout:g}s 内未就绪")
+
+
+def tree_rss_mb(pid: int) -> float:
+    """进程及其所有子进程（worker、重载子进程、沙箱进程）的常驻内存之和"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # 第4个字段为父进程ID，进程名可能包含空格，从右括号之后解析
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    total = 0
+    stack = [pid]
+    while stack:
+        current = stack.pop()
+        stack.extend(children.get(current, ()))
+        try:
+            with open(f"/proc/{current}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total / 1024
+
+
+async def http_client(deadline: float, latencies: list):
+    reader, writer = await asyncio.open_connection(HOST, PORT)
+    request = f"GET /ready HTTP/1.1\r\nHost: {HOST}\r\n\r\n".encode()
+    try:
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            writer.write(request)
+            headers = await reader.readuntil(b"\r\n\r\n")
+            await reader.readexactly(int(_CONTENT_LENGTH.search(headers).group(1)))
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def ws_client(client_id: str, deadline: float, latencies: list):
+    async with websockets.connect(f"ws://{HOST}:{PORT}/ws/{client_id}", open_timeout=30, ping_interval=None) as websocket:
+        # 连接建立后服务器先发送连接ID与心跳间隔
+        await websocket.recv()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            await websocket.send('{"type":"ping"}')
+            while True:
+                frame = json.loads(await websocket.recv())
+                if frame.get("type") == "pong":
+                    break
+                if frame.get("type") == "ping":
+                    await websocket.send('{"type":"pong"}')
+            latencies.append(time.perf_counter() - start)
+
+
+async def generate_load(kind: str, index: int, connections: int, duration: float) -> list:
+    latencies = []
+    deadline = time.perf_counter() + duration
+    if kind == "http":
+        clients = [http_client(deadline, latencies) for _ in range(connections)]
+    else:
+        clients = [ws_client(f"bench-{index}-{i}", deadline, latencies) for i in range(connections)]
+    results = await asyncio.gather(*clients, return_exceptions=True)
+    errors = [r for r in results if isinstance(r, Exception)]
+    if errors:
+        print(f"  {len(errors)} 个{kind}连接失败: {errors[0]!r}")
+    return latencies
+
+
+def load_process(job) -> list:
+    return asyncio.run(generate_load(*job))
+
+
+def percentile(values, q: float) -> float:
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run_load(kind: str, processes: int, connections: int, duration: float):
+    per_process = max(1, connections // processes)
+    with multiprocessing.Pool(processes) as pool:
+        parts = pool.map(load_process, [(kind, i, per_process, duration) for i in range(processes)])
+    latencies = sorted(latency for part in parts for latency in part)
+    if not latencies:
+        return None
+    return {
+        "rps": len(latencies) / duration,
+        "p50": percentile(latencies, 0.5) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+    }
+
+
+def run_profile(name: str, args) -> dict:
+    print(f"启动 {name} 配置: {' '.join(profile_command(name, args.workers)[1:])}")
+    server = subprocess.Popen(profile_command(name, args.workers), cwd=ROOT,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = {}
+    try:
+        wait_ready()
+        # 预热，首批请求的导入与初始化开销不计入结果
+        run_load("http", 1, 4, 1.0)
+        for kind in args.scenarios:
+            results[kind] = run_load(kind, args.load_processes, args.connections, args.duration)
+            print(f"  {kind}: {results[kind]}")
+        results["rss_mb"] = tree_rss_mb(server.pid)
+    finally:
+        # 与生产环境相同通过SIGTERM停止，排空后退出
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(60)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="生产配置的worker数")
+    parser.add_argument("--duration", type=float, default=10.0, help="每个场景的持续时间（秒）")
+    parser.add_argument("--connections", type=int, default=200, help="每个场景的并发连接总数")
+    parser.add_argument("--load-processes", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                        help="压测客户端进程数")
+    parser.add_argument("--profiles", default="dev,prod")
+    parser.add_argument("--scenarios", default="http,ws")
+    args = parser.parse_args()
+    args.scenarios = args.scenarios.split(",")
+
+    results = {name: run_profile(name, args) for name in args.profiles.split(",")}
+
+    print(f"\n{'配置':<6}{'场景':<6}{'请求/秒':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, result in results.items():
+        for kind in args.scenarios:
+            stats = result.get(kind)
+            if stats:
+                print(f"{name:<6}{kind:<6}{stats['rps']:>10.0f}{stats['p50']:>10.2f}{stats['p99']:>10.2f}")
+        print(f"{name:<6}常驻内存（含子进程） {result.get('rss_mb', 0):.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
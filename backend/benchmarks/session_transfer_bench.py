@@ -0,0 +1,81 @@
+"""会话批量导入导出测试：生成大量消息流式导入会话存储，再全部导出为gzip压缩的JSONL，
+报告吞吐量以及两个阶段各自的Python内存峰值（应与消息总数无关，只取决于批次大小与内存预算）。
+
+用法（项目根目录）：
+    python -m backend.benchmarks.session_transfer_bench --sessions 10000 --turns 100 --budget-mb 16
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import zlib
+from contextlib import redirect_stdout
+
+from backend.app.session_store import SessionStore
+from backend.app.session_transfer import SessionImporter, export_sessions
+
+
+async def generate_dump(sessions: int, turns: int, size: int):
+    """边生成边压缩的导出格式数据，生成端本身不占用与总量相关的内存"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    filler = "x" * size
+    for s in range(sessions):
+        lines = "".join(
+            json.dumps({"agent_id": f"agent{s % 4}", "session_id": f"bench-{s}", "seq": i,
+                        "role": "user" if i % 2 == 0 else "assistant", "content": f"{i} {filler}"}) + "\n"
+            for i in range(turns)
+        )
+        data = compressor.compress(lines.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+async def run(args):
+    store = SessionStore(spill_dir=tempfile.mkdtemp(prefix="session-bench-"),
+                         memory_budget=args.budget_mb * 1024 * 1024)
+    total = args.sessions * args.turns
+    # 创建、换出会话时的逐条日志不输出
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        tracemalloc.start()
+        start = time.perf_counter()
+        importer = SessionImporter(store, batch_size=args.batch_size)
+        await importer.feed(generate_dump(args.sessions, args.turns, args.content_bytes))
+        import_seconds = time.perf_counter() - start
+        import_peak = tracemalloc.get_traced_memory()[1]
+
+        tracemalloc.reset_peak()
+        exported = 0
+        start = time.perf_counter()
+        with tempfile.TemporaryFile() as f:
+            async for chunk in export_sessions(store):
+                f.write(chunk)
+                exported += len(chunk)
+        export_seconds = time.perf_counter() - start
+        export_peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    report = importer.report()
+    print(f"导入: {report['imported']}/{total} 条消息，{import_seconds:.1f}s，"
+          f"{report['imported'] / import_seconds:.0f} 条/秒，内存峰值 {import_peak / 1e6:.1f} MB，错误 {report['error_count']}")
+    print(f"导出: {exported / 1e6:.1f} MB gzip，{export_seconds:.1f}s，{total / export_seconds:.0f} 条/秒，"
+          f"内存峰值 {export_peak / 1e6:.1f} MB")
+    print(f"会话存储: 内存中 {len(store.sessions)} 个会话，已换出 {len(store.spilled)} 个")
+    print("（吞吐量包含tracemalloc的开销，只适合在相同参数下相互比较）")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=10000)
+    parser.add_argument("--turns", type=int, default=100, help="每个会话的消息数")
+    parser.add_argument("--content-bytes", type=int, default=200, help="每条消息的内容长度")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--budget-mb", type=int, default=16, help="会话存储的内存预算")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""WebSocket空闲连接压测：向运行中的服务器建立大量空闲连接并回应心跳，按服务器常驻内存的增量估算每个连接的内存开销。
+
+用法（项目根目录，先在另一个终端启动单个worker的服务器）：
+    python -m backend.benchmarks.ws_idle_load --url ws://localhost:8000 --connections 20000 --clients 1000 --hold 60
+"""
+import argparse
+import asyncio
+import json
+import resource
+import time
+import urllib.request
+
+import websockets
+
+
+def fetch_report(http_url: str, admin_token: str) -> dict:
+    request = urllib.request.Request(f"{http_url}/admin/connections?top=0", headers={"X-Admin-Token": admin_token})
+    with urllib.request.urlopen(request, timeout=30) as response:
+        return json.loads(response.read())
+
+
+def raise_fd_limit(needed: int) -> int:
+    """客户端每个连接占用一个文件描述符，尽量把软限制提高到所需数量"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+    if soft < target:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    return resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+
+
+async def hold_connection(url: str, opened: asyncio.Event, stop: asyncio.Event, stats: dict):
+    try:
+        async with websockets.connect(url, open_timeout=60, ping_interval=None, max_queue=4) as websocket:
+            stats["open"] += 1
+            opened.set()
+            while not stop.is_set():
+                try:
+                    frame = json.loads(await asyncio.wait_for(websocket.recv(), timeout=1.0))
+                except asyncio.TimeoutError:
+                    continue
+                if frame.get("type") == "ping":
+                    stats["pings"] += 1
+                    await websocket.send('{"type":"pong"}')
+    except Exception as e:
+        stats["failed"] += 1
+        stats["last_error"] = repr(e)
+        opened.set()
+    finally:
+        stats["closed"] += 1
+
+
+async def run(args):
+    http_url = args.url.replace("ws://", "http://", 1).replace("wss://", "https://", 1)
+    limit = raise_fd_limit(args.connections + 256)
+    if limit < args.connections + 16:
+        print(f"警告: 文件描述符上限为 {limit}，不足以建立 {args.connections} 个连接")
+
+    before = fetch_report(http_url, args.admin_token)
+    print(f"压测前: 连接 {before['connections']}，常驻内存 {before['process_rss_bytes'] / 1024 / 1024:.1f} MB")
+
+    stats = {"open": 0, "failed": 0, "closed": 0, "pings": 0, "last_error": None}
+    stop = asyncio.Event()
+    tasks = []
+    start = time.perf_counter()
+    for i in range(args.connections):
+        opened = asyncio.Event()
+        url = f"{args.url}/ws/load-{i % args.clients}"
+        tasks.append(asyncio.create_task(hold_connection(url, opened, stop, stats)))
+        # 限制建立速率，避免服务器accept队列溢出
+        if (i + 1) % args.batch == 0:
+            await opened.wait()
+            print(f"已建立 {stats['open']} 个连接，失败 {stats['failed']}")
+    while stats["open"] + stats["failed"] < args.connections:
+        await asyncio.sleep(0.1)
+    print(f"建立 {stats['open']} 个连接用时 {time.perf_counter() - start:.1f}s，失败 {stats['failed']}"
+          + (f"（{stats['last_error']}）" if stats["last_error"] else ""))
+
+    await asyncio.sleep(args.hold)
+    after = fetch_report(http_url, args.admin_token)
+    opened_count = after["connections"] - before["connections"]
+    delta = after["process_rss_bytes"] - before["process_rss_bytes"]
+    print(f"保持 {args.hold:g}s 后: 连接 {after['connections']}，常驻内存 {after['process_rss_bytes'] / 1024 / 1024:.1f} MB，"
+          f"收到心跳 {stats['pings']} 次，期间断开 {stats['closed']} 个")
+    if opened_count > 0:
+        print(f"每个连接约 {delta / opened_count / 1024:.1f} KB（常驻内存增量 {delta / 1024 / 1024:.1f} MB / {opened_count} 个连接），"
+              f"其中连接记录 {after['record_bytes'] / max(after['connections'], 1):.0f} B")
+
+    stop.set()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="ws://localhost:8000")
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--clients", type=int, default=1000, help="连接分摊到的client_id数量")
+    parser.add_argument("--batch", type=int, default=500, help="每建立多少个连接等待一次")
+    parser.add_argument("--hold", type=float, default=60.0, help="连接建立后保持的秒数，超过心跳间隔才能观察到心跳")
+    parser.add_argument("--admin-token", default="")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
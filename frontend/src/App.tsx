@@ -1,9 +1,17 @@
-import React, { useState, useEffect } from 'react';
+import React, { useState, useEffect, useRef } from 'react';
 import ChatWindow from './components/ChatWindow';
 import { motion } from 'framer-motion';
 import SessionManager, { Session } from './components/SessionManager';
 import ApiKeyManager from './components/ApiKeyManager';
 import { v4 as uuidv4 } from 'uuid';
+import { loadAllMessages, messagePersister, migrateFromLocalStorage } from './messageStore';
+
+// 逐帧日志只在调试时输出：在浏览器控制台执行 localStorage.setItem('debugStream', '1') 后刷新页面
+const DEBUG_STREAM = localStorage.getItem('debugStream') === '1';
+// 每次从服务器获取的历史消息条数
+const HISTORY_PAGE_SIZE = 30;
+// 本地清除过历史的会话，不再从服务器加载清除前的消息
+const CLEARED_SESSIONS_KEY = 'clearedHistorySessions';
 
 interface Agent {
     id: string;
@@ -24,11 +32,91 @@ interface SessionMessages {
     [sessionId: string]: Message[];
 }
 
+// 进行中的流式回复，断线重连后用于续传
+interface PendingGeneration {
+    requestId: string;
+    sessionId: string;
+    lastSeq: number;
+}
+
 // 按分类组织智能体
 interface AgentGroup {
     [category: string]: Agent[];
 }
 
+// 会话在服务器上的分页状态：cursor用于获取更早的消息（null表示已到最早），start为已加载的第一条消息的序号
+interface HistoryState {
+    cursor: string | null;
+    start: number;
+}
+
+// 每个浏览器使用固定的客户端ID，WebSocket连接与历史接口都用它标识会话所属的客户端
+const getClientId = (): string => {
+    let clientId = localStorage.getItem('clientId');
+    if (!clientId) {
+        clientId = `web-${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}`;
+        localStorage.setItem('clientId', clientId);
+    }
+    return clientId;
+};
+
+const loadClearedSessions = (): Set<string> => {
+    try {
+        return new Set(JSON.parse(localStorage.getItem(CLEARED_SESSIONS_KEY) || '[]'));
+    } catch {
+        return new Set();
+    }
+};
+
+const markSessionsCleared = (sessionIds: string[]) => {
+    const cleared = loadClearedSessions();
+    sessionIds.forEach(sessionId => cleared.add(sessionId));
+    localStorage.setItem(CLEARED_SESSIONS_KEY, JSON.stringify(Array.from(cleared)));
+};
+
+// 从服务器倒序分页获取会话历史；会话不在服务器上（如旧版本创建、属于其他客户端）时返回null
+const fetchHistoryPage = async (agentId: string, sessionId: string, cursor?: string) => {
+    const params = new URLSearchParams({ limit: String(HISTORY_PAGE_SIZE) });
+    if (cursor) {
+        params.set('cursor', cursor);
+    }
+    const response = await fetch(
+        `http://localhost:8000/sessions/${encodeURIComponent(agentId)}/${encodeURIComponent(sessionId)}/messages?${params}`,
+        { headers: { 'X-Client-Id': getClientId() } }
+    );
+    if (response.status === 404) {
+        return null;
+    }
+    if (!response.ok) {
+        throw new Error(`获取历史消息失败: ${response.status}`);
+    }
+    const data = await response.json();
+    return {
+        messages: data.messages as { index: number; role: string; content: string }[],
+        nextCursor: data.next_cursor as string | null,
+        total: data.total as number
+    };
+};
+
+// 服务器的消息没有时间，本地缓存中有相同消息时沿用本地的记录（从末尾对齐，跳过本地的系统提示）
+const toLocalMessages = (
+    fetched: { role: string; content: string }[],
+    agentId: string,
+    cached: Message[],
+    fallbackTime: Date
+): Message[] => {
+    const conversation = cached.filter(message => message.from !== 'system');
+    const offset = conversation.length - fetched.length;
+    return fetched.map((message, index) => {
+        const from = message.role === 'user' ? 'user' : agentId;
+        const local = conversation[offset + index];
+        if (local && local.from === from && local.content === message.content) {
+            return local;
+        }
+        return { content: message.content, from, timestamp: fallbackTime, isFinal: true };
+    });
+};
+
 // 保存会话到 localStorage
 const saveSessionsToLocalStorage = (sessions: Session[]) => {
     try {
@@ -64,47 +152,12 @@ const loadSessionsFromLocalStorage = (): Session[] => {
     return [];
 };
 
-// 保存消息历史到 localStorage
-const saveMessagesToLocalStorage = (messages: SessionMessages) => {
-    try {
-        // 将Date对象转换为ISO字符串以便存储
-        const serializedMessages = JSON.stringify(messages, (key, value) => {
-            if (key === 'timestamp' && value instanceof Date) {
-                return value.toISOString();
-            }
-            return value;
-        });
-        localStorage.setItem('sessionMessages', serializedMessages);
-    } catch (error) {
-        console.error('保存消息历史记录失败:', error);
-    }
-};
-
-// 从 localStorage 读取消息历史
-const loadMessagesFromLocalStorage = (): SessionMessages => {
-    try {
-        const serializedMessages = localStorage.getItem('sessionMessages');
-        if (serializedMessages) {
-            // 将ISO字符串转换回Date对象
-            return JSON.parse(serializedMessages, (key, value) => {
-                if (key === 'timestamp' && typeof value === 'string') {
-                    return new Date(value);
-                }
-                return value;
-            });
-        }
-    } catch (error) {
-        console.error('读取消息历史记录失败:', error);
-    }
-    return {};
-};
-
 const App: React.FC = () => {
     const [agents, setAgents] = useState<Agent[]>([]);
     const [selectedAgent, setSelectedAgent] = useState<Agent | null>(null);
     const [sessions, setSessions] = useState<Session[]>(loadSessionsFromLocalStorage());
     const [currentSessionId, setCurrentSessionId] = useState<string | null>(null);
-    const [sessionMessages, setSessionMessages] = useState<SessionMessages>(loadMessagesFromLocalStorage());
+    const [sessionMessages, setSessionMessages] = useState<SessionMessages>({});
     const [ws, setWs] = useState<WebSocket | null>(null);
     const [darkMode, setDarkMode] = useState(localStorage.getItem('darkMode') === 'true');
     const [sidebarOpen, setSidebarOpen] = useState(true);
@@ -115,6 +168,14 @@ const App: React.FC = () => {
     const [tempSessionName, setTempSessionName] = useState<string>('');
     const [apiKeyModalOpen, setApiKeyModalOpen] = useState(false);
     const [currentApiKey, setCurrentApiKey] = useState<string>('');
+    const pendingGenerationRef = useRef<PendingGeneration | null>(null);
+    const [historyStates, setHistoryStates] = useState<{ [sessionId: string]: HistoryState }>({});
+    const historyStatesRef = useRef(historyStates);
+    historyStatesRef.current = historyStates;
+    const loadingOlderRef = useRef(false);
+    // 上一次已持久化的消息状态，用于找出发生变化的消息
+    const persistedMessagesRef = useRef<SessionMessages>({});
+    const messagesLoadedRef = useRef(false);
 
     // 将智能体按分类分组
     const groupedAgents = agents.reduce((acc: AgentGroup, agent) => {
@@ -131,9 +192,61 @@ const App: React.FC = () => {
         saveSessionsToLocalStorage(sessions);
     }, [sessions]);
 
-    // 保存消息历史到localStorage
+    // 从IndexedDB加载消息历史（首次加载时迁移旧版localStorage数据）
     useEffect(() => {
-        saveMessagesToLocalStorage(sessionMessages);
+        let cancelled = false;
+        migrateFromLocalStorage()
+            .then(() => loadAllMessages())
+            .then(loadedMessages => {
+                if (cancelled) return;
+                persistedMessagesRef.current = loadedMessages;
+                messagesLoadedRef.current = true;
+                // 保留加载期间新产生的消息
+                setSessionMessages(prev => ({ ...loadedMessages, ...prev }));
+            })
+            .catch(error => {
+                console.error('读取消息历史记录失败:', error);
+                messagesLoadedRef.current = true;
+            });
+        
+        // 页面隐藏或关闭前写入尚未提交的消息
+        const flushMessages = () => messagePersister.flush();
+        const handleVisibilityChange = () => {
+            if (document.visibilityState === 'hidden') flushMessages();
+        };
+        window.addEventListener('beforeunload', flushMessages);
+        document.addEventListener('visibilitychange', handleVisibilityChange);
+        return () => {
+            cancelled = true;
+            window.removeEventListener('beforeunload', flushMessages);
+            document.removeEventListener('visibilitychange', handleVisibilityChange);
+        };
+    }, []);
+
+    // 增量保存消息历史：状态不可变更新，只需比较引用即可找出新增或修改的消息
+    useEffect(() => {
+        if (!messagesLoadedRef.current) return;
+        const previous = persistedMessagesRef.current;
+        persistedMessagesRef.current = sessionMessages;
+        
+        Object.keys(previous).forEach(sessionId => {
+            if (!(sessionId in sessionMessages)) {
+                messagePersister.deleteSession(sessionId);
+            }
+        });
+        
+        Object.entries(sessionMessages).forEach(([sessionId, messages]) => {
+            const previousMessages = previous[sessionId];
+            if (previousMessages === messages) return;
+            if (previousMessages && previousMessages.length > messages.length) {
+                messagePersister.deleteSession(sessionId, messages.length);
+            }
+            messages.forEach((message, index) => {
+                if (!previousMessages || previousMessages[index] !== message) {
+                    messagePersister.schedule(sessionId, index, message);
+                }
+            });
+        });
     }, [sessionMessages]);
 
     // 保存深色模式设置
@@ -209,21 +322,58 @@ const App: React.FC = () => {
 
     useEffect(() => {
         let websocket: WebSocket | null = null;
+        // 服务器重连提示中给出的延迟（毫秒），仅用于下一次重连
+        let reconnectDelay: number | null = null;
         
         // 建立WebSocket连接函数
         const connectWebSocket = () => {
             console.log('尝试建立WebSocket连接...');
-            websocket = new WebSocket('ws://localhost:8000/ws/client1');
+            // 同一浏览器的多个标签页使用相同的客户端ID，各自建立独立连接
+            websocket = new WebSocket(`ws://localhost:8000/ws/${getClientId()}`);
             
             websocket.onopen = () => {
                 console.log('WebSocket连接已建立, 当前会话ID:', currentSessionId);
                 setWs(websocket);
+                
+                // 断线前有未完成的回复，从最后收到的序号继续接收
+                const pending = pendingGenerationRef.current;
+                if (pending && pending.sessionId === currentSessionId && websocket) {
+                    console.log(`续传回复: ${pending.requestId}, 偏移: ${pending.lastSeq + 1}`);
+                    websocket.send(JSON.stringify({
+                        type: 'resume',
+                        request_id: pending.requestId,
+                        offset: pending.lastSeq + 1
+                    }));
+                }
             };
 
             websocket.onmessage = (event) => {
                 try {
                     const data = JSON.parse(event.data);
-                    console.log('收到WebSocket消息:', data);
+                    
+                    // 服务器心跳：立即回应，服务器据此判断连接是否存活
+                    if (data.type === 'ping') {
+                        websocket?.send(JSON.stringify({ type: 'pong' }));
+                        return;
+                    }
+                    if (data.type === 'reconnect') {
+                        // 服务器即将重启，按提示的延迟重连，未完成的回复在重连后续传
+                        console.log(`服务器即将重启，${data.after_ms}毫秒后重连`);
+                        reconnectDelay = data.after_ms;
+                        return;
+                    }
+                    if (data.type === 'resume_required') {
+                        // 接收过慢被服务器断开，重连后按已收到的序号续传
+                        console.log('接收过慢，服务器即将断开连接，续传信息:', data.resume);
+                        return;
+                    }
+                    if (data.type === 'connected') {
+                        console.log(`连接ID: ${data.connection_id}, 心跳间隔: ${data.heartbeat}秒`);
+                        return;
+                    }
+                    if (DEBUG_STREAM) {
+                        console.log('收到WebSocket消息:', data);
+                    }
                     
                     // 确保有currentSessionId才处理消息
                     if (!currentSessionId) {
@@ -237,14 +387,45 @@ const App: React.FC = () => {
                         return;
                     }
 
-                    console.log(`处理来自 ${agentId} 的消息, 类型: ${data.type}, 会话ID: ${currentSessionId}`);
+                    if (DEBUG_STREAM) {
+                        console.log(`处理来自 ${agentId} 的消息, 类型: ${data.type}, 会话ID: ${currentSessionId}`);
+                    }
+                    
+                    // 记录收到的片段序号，断线重连时据此续传
+                    const pending = pendingGenerationRef.current;
+                    if (pending && data.request_id === pending.requestId) {
+                        if (data.type === 'message_chunk' || data.type === 'message_snapshot') {
+                            pending.lastSeq = data.seq;
+                        } else if (data.type === 'message') {
+                            pendingGenerationRef.current = null;
+                        }
+                    }
                     
                     // 使用函数式更新，确保状态一定是最新的
-                    if (data.type === 'message_chunk') {
+                    if (data.type === 'message_snapshot') {
+                        // 续传偏移早于服务器缓冲区时，用截至当前的完整内容替换已收到的部分
+                        setSessionMessages((prevMessages) => {
+                            const prevSessionMessages = prevMessages[currentSessionId] || [];
+                            const lastMessage = prevSessionMessages.length > 0 
+                                ? prevSessionMessages[prevSessionMessages.length - 1] 
+                                : null;
+                            const snapshotMessage = {
+                                content: data.content || "",
+                                from: agentId,
+                                timestamp: new Date(),
+                                isFinal: false
+                            };
+                            const updatedMessages = lastMessage && lastMessage.from === agentId && !lastMessage.isFinal
+                                ? [...prevSessionMessages.slice(0, -1), snapshotMessage]
+                                : [...prevSessionMessages, snapshotMessage];
+                            return {
+                                ...prevMessages,
+                                [currentSessionId]: updatedMessages
+                            };
+                        });
+                    } else if (data.type === 'message_chunk') {
                         // 强制使用函数式更新，确保总是获取到最新的sessionMessages状态
                         setSessionMessages((prevMessages) => {
-                            console.log('更新前的消息状态:', JSON.stringify(prevMessages[currentSessionId] || []));
-                            
                             const prevSessionMessages = prevMessages[currentSessionId] || [];
                             const lastMessage = prevSessionMessages.length > 0 
                                 ? prevSessionMessages[prevSessionMessages.length - 1] 
@@ -270,11 +451,11 @@ const App: React.FC = () => {
                                         isFinal: false
                                     }
                                 ];
-                                console.log('添加新消息:', data.content);
+                                if (DEBUG_STREAM) {
+                                    console.log('添加新消息:', data.content);
+                                }
                             }
                             
-                            console.log('更新后的消息状态:', JSON.stringify(updatedMessages));
-                            
                             // 确保返回完整的新状态对象
                             return {
                                 ...prevMessages,
@@ -325,6 +506,7 @@ const App: React.FC = () => {
                         updateSessionLastMessageTime(currentSessionId);
                     } else if (data.type === 'error') {
                         console.error('收到错误消息:', data.content);
+                        pendingGenerationRef.current = null;
                         // 显示错误消息
                         setSessionMessages(prev => {
                             const prevMessages = prev[currentSessionId] || [];
@@ -351,10 +533,22 @@ const App: React.FC = () => {
                 console.log(`WebSocket连接已关闭: 代码=${event.code}, 原因=${event.reason}`);
                 setWs(null);
                 
+                // 同一浏览器打开的标签页过多时服务器关闭最早的连接，不再重连以免互相挤占
+                if (event.code === 4002) {
+                    console.log('连接已被同一浏览器的新连接替换');
+                    return;
+                }
+                // 因长时间空闲被关闭时，等页面重新可见再重连
+                if (event.code === 4000 && document.visibilityState !== 'visible' && !unmounting) {
+                    document.addEventListener('visibilitychange', connectWebSocket, { once: true });
+                    return;
+                }
                 // 非正常关闭且不是组件卸载导致的关闭，尝试重连
                 if (event.code !== 1000 && !unmounting) {
-                    console.log('尝试在3秒后重新连接...');
-                    setTimeout(connectWebSocket, 3000);
+                    const delay = reconnectDelay ?? 3000;
+                    reconnectDelay = null;
+                    console.log(`尝试在${delay}毫秒后重新连接...`);
+                    setTimeout(connectWebSocket, delay);
                 }
             };
 
@@ -390,6 +584,69 @@ const App: React.FC = () => {
         };
     }, [currentSessionId]); // 添加依赖于currentSessionId，确保会话变更时重新建立正确连接
 
+    // 打开会话时从服务器加载最新的一页历史，更早的消息在滚动到顶部时再获取
+    useEffect(() => {
+        if (!selectedAgent || !currentSessionId || currentSessionId in historyStatesRef.current) return;
+        const agentId = selectedAgent.id;
+        const sessionId = currentSessionId;
+        if (loadClearedSessions().has(sessionId)) {
+            setHistoryStates(prev => ({ ...prev, [sessionId]: { cursor: null, start: 0 } }));
+            return;
+        }
+        const session = sessions.find(item => item.id === sessionId);
+        fetchHistoryPage(agentId, sessionId)
+            .then(page => {
+                // 会话不在服务器上时继续使用本地缓存
+                if (!page) {
+                    setHistoryStates(prev => ({ ...prev, [sessionId]: { cursor: null, start: 0 } }));
+                    return;
+                }
+                // 回复仍在生成时服务器的历史中还没有这条回复，保留本地正在接收的内容
+                if (pendingGenerationRef.current?.sessionId === sessionId) return;
+                const start = page.messages.length > 0 ? page.messages[0].index : page.total;
+                setHistoryStates(prev => ({ ...prev, [sessionId]: { cursor: page.nextCursor, start } }));
+                setSessionMessages(prev => ({
+                    ...prev,
+                    [sessionId]: toLocalMessages(page.messages, agentId, prev[sessionId] || [], session?.createdAt || new Date())
+                }));
+            })
+            .catch(error => {
+                // 服务器不可用时继续使用本地缓存，下次打开会话时重试
+                console.error('获取历史消息失败:', error);
+            });
+    }, [currentSessionId, selectedAgent]);
+
+    // 滚动到顶部时获取更早的一页历史
+    const loadOlderMessages = async () => {
+        if (!selectedAgent || !currentSessionId || loadingOlderRef.current) return;
+        const agentId = selectedAgent.id;
+        const sessionId = currentSessionId;
+        const history = historyStatesRef.current[sessionId];
+        if (!history || !history.cursor) return;
+        loadingOlderRef.current = true;
+        try {
+            const page = await fetchHistoryPage(agentId, sessionId, history.cursor);
+            if (!page) {
+                setHistoryStates(prev => ({ ...prev, [sessionId]: { ...history, cursor: null } }));
+                return;
+            }
+            const session = sessions.find(item => item.id === sessionId);
+            const older = toLocalMessages(page.messages, agentId, [], session?.createdAt || new Date());
+            setHistoryStates(prev => ({
+                ...prev,
+                [sessionId]: { cursor: page.nextCursor, start: history.start - older.length }
+            }));
+            setSessionMessages(prev => ({
+                ...prev,
+                [sessionId]: [...older, ...(prev[sessionId] || [])]
+            }));
+        } catch (error) {
+            console.error('获取更早的历史消息失败:', error);
+        } finally {
+            loadingOlderRef.current = false;
+        }
+    };
+
     // 更新会话的最后消息时间
     const updateSessionLastMessageTime = (sessionId: string, timestamp = new Date()) => {
         setSessions(prev => 
@@ -541,14 +798,17 @@ const App: React.FC = () => {
         if (ws && ws.readyState === WebSocket.OPEN) {
             console.log(`发送消息到会话: ${currentSessionId}, 智能体: ${selectedAgent.id}`);
             try {
+                const requestId = uuidv4();
                 const messageData = JSON.stringify({
                     type: 'message',
                     to: selectedAgent.id,
                     content: text,
                     stream: true,
-                    session_id: currentSessionId
+                    session_id: currentSessionId,
+                    request_id: requestId
                 });
                 ws.send(messageData);
+                pendingGenerationRef.current = { requestId, sessionId: currentSessionId, lastSeq: -1 };
             } catch (error) {
                 console.error('发送消息失败:', error);
                 // 添加一条本地错误消息
@@ -589,6 +849,8 @@ const App: React.FC = () => {
     // 清除当前会话的消息历史
     const clearCurrentSessionMessages = () => {
         if (currentSessionId) {
+            markSessionsCleared([currentSessionId]);
+            setHistoryStates(prev => ({ ...prev, [currentSessionId]: { cursor: null, start: 0 } }));
             setSessionMessages(prev => ({
                 ...prev,
                 [currentSessionId]: []
@@ -599,6 +861,8 @@ const App: React.FC = () => {
 
     // 清除所有消息历史
     const clearAllMessages = () => {
+        markSessionsCleared(sessions.map(session => session.id));
+        setHistoryStates(Object.fromEntries(sessions.map(session => [session.id, { cursor: null, start: 0 }])));
         setSessionMessages({});
         setClearModalOpen(false);
     };
@@ -958,6 +1222,9 @@ const App: React.FC = () => {
                                 agentId={selectedAgent.id}
                                 agentName={selectedAgent.name}
                                 messages={currentSessionId ? (sessionMessages[currentSessionId] || []) : []}
+                                firstMessageKey={currentSessionId ? (historyStates[currentSessionId]?.start || 0) : 0}
+                                hasOlderMessages={!!(currentSessionId && historyStates[currentSessionId]?.cursor)}
+                                onLoadOlder={loadOlderMessages}
                                 onSendMessage={handleSendMessage}
                                 darkMode={darkMode}
                                 onClearHistory={clearCurrentSessionMessages}
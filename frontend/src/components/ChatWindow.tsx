@@ -1,4 +1,4 @@
-import React, { useState, useEffect, useRef } from 'react';
+import React, { useState, useEffect, useLayoutEffect, useRef } from 'react';
 import { motion, AnimatePresence } from 'framer-motion';
 import ReactMarkdown from 'react-markdown';
 import { Prism as SyntaxHighlighter } from 'react-syntax-highlighter';
@@ -22,6 +22,9 @@ interface ChatWindowProps {
     onSendMessage: (message: string) => void;
     darkMode?: boolean;
     onClearHistory?: () => void;
+    firstMessageKey?: number; // 第一条消息在会话中的序号，向前加载更早的消息时消息的key保持不变
+    hasOlderMessages?: boolean; // 服务器上是否还有更早的消息
+    onLoadOlder?: () => Promise<void>;
 }
 
 const ChatWindow: React.FC<ChatWindowProps> = ({
@@ -30,7 +33,10 @@ const ChatWindow: React.FC<ChatWindowProps> = ({
     messages,
     onSendMessage,
     darkMode = false,
-    onClearHistory
+    onClearHistory,
+    firstMessageKey = 0,
+    hasOlderMessages = false,
+    onLoadOlder
 }) => {
     const [inputMessage, setInputMessage] = useState('');
     const [isTyping, setIsTyping] = useState(false);
@@ -40,6 +46,10 @@ const ChatWindow: React.FC<ChatWindowProps> = ({
     const textareaRef = useRef<HTMLTextAreaElement>(null);
     const [autoScroll, setAutoScroll] = useState(true);
     const messageContainerRef = useRef<HTMLDivElement>(null);
+    const [loadingOlder, setLoadingOlder] = useState(false);
+    // 向前加载前距离底部的高度，加载后据此恢复阅读位置
+    const restoreOffsetRef = useRef<number | null>(null);
+    const lastMessageRef = useRef<Message | undefined>(undefined);
 
     // 自动调整文本框高度
     useEffect(() => {
@@ -64,6 +74,10 @@ const ChatWindow: React.FC<ChatWindowProps> = ({
 
     // 修改useEffect钩子以确保滚动到最新消息
     useEffect(() => {
+        // 向前加载更早的消息时最后一条消息不变，不滚动
+        const lastMessage = messages[messages.length - 1];
+        if (lastMessage === lastMessageRef.current) return;
+        lastMessageRef.current = lastMessage;
         // 当新消息添加时滚动到底部
         if (messagesEndRef.current && messages.length > 0) {
             console.log('滚动到最新消息');
@@ -71,11 +85,44 @@ const ChatWindow: React.FC<ChatWindowProps> = ({
         }
     }, [messages]);
 
+    // 更早的消息插入到顶部后保持原来的阅读位置
+    useLayoutEffect(() => {
+        const container = messageContainerRef.current;
+        if (container && restoreOffsetRef.current !== null) {
+            container.scrollTop = container.scrollHeight - restoreOffsetRef.current;
+            restoreOffsetRef.current = null;
+        }
+    }, [messages]);
+
+    const loadOlder = async () => {
+        const container = messageContainerRef.current;
+        if (!container || !onLoadOlder || loadingOlder) return;
+        setLoadingOlder(true);
+        restoreOffsetRef.current = container.scrollHeight - container.scrollTop;
+        try {
+            await onLoadOlder();
+        } finally {
+            setLoadingOlder(false);
+        }
+    };
+
+    // 已加载的消息不足一屏、无法滚动时继续向前加载
+    useEffect(() => {
+        const container = messageContainerRef.current;
+        if (container && hasOlderMessages && !loadingOlder && container.scrollHeight <= container.clientHeight) {
+            loadOlder();
+        }
+    }, [messages, hasOlderMessages, loadingOlder]);
+
     // 检测用户是否手动滚动，用于决定是否取消自动滚动
     const handleScroll = () => {
         if (!messageContainerRef.current) return;
         
         const { scrollTop, scrollHeight, clientHeight } = messageContainerRef.current;
+        // 滚动到顶部附近时获取更早的消息
+        if (scrollTop < 50 && hasOlderMessages) {
+            loadOlder();
+        }
         const isScrolledNearBottom = scrollHeight - scrollTop - clientHeight < 100;
         
         // 如果用户已滚动至接近底部，重新启用自动滚动
@@ -239,12 +286,17 @@ const ChatWindow: React.FC<ChatWindowProps> = ({
                 className={`flex-1 overflow-y-auto p-4 space-y-4 ${darkMode ? 'bg-gray-900' : 'bg-gray-50'}`}
                 onScroll={handleScroll}
             >
+                {loadingOlder && (
+                    <div className={`text-center text-xs py-2 ${darkMode ? 'text-gray-500' : 'text-gray-400'}`}>
+                        正在加载更早的消息...
+                    </div>
+                )}
                 <AnimatePresence>
                     {messages.map((message, index) => {
                         console.log(`渲染消息 ${index}:`, message.from, message.content?.substring(0, 50));
                         return (
                             <motion.div
-                                key={index}
+                                key={firstMessageKey + index}
                                 initial={{ opacity: 0, y: 20 }}
                                 animate={{ opacity: 1, y: 0 }}
                                 exit={{ opacity: 0 }}
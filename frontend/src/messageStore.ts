@@ -0,0 +1,171 @@
+// 基于IndexedDB的消息持久化：每条消息单独存储，只写入发生变化的消息
+
+export interface StoredMessage {
+    content: string;
+    from: string;
+    timestamp: Date;
+    isFinal?: boolean;
+}
+
+export interface StoredSessionMessages {
+    [sessionId: string]: StoredMessage[];
+}
+
+interface MessageRecord {
+    sessionId: string;
+    index: number;
+    content: string;
+    from: string;
+    timestamp: string;
+    isFinal?: boolean;
+}
+
+const DB_NAME = 'agent-dialogue';
+const DB_VERSION = 1;
+const MESSAGE_STORE = 'messages';
+// 旧版本整体存放在localStorage中的消息历史
+const LEGACY_STORAGE_KEY = 'sessionMessages';
+// 流式输出期间的写入合并间隔
+const STREAMING_WRITE_DELAY_MS = 500;
+
+let dbPromise: Promise<IDBDatabase> | null = null;
+
+const openDatabase = (): Promise<IDBDatabase> => {
+    if (!dbPromise) {
+        dbPromise = new Promise((resolve, reject) => {
+            const request = indexedDB.open(DB_NAME, DB_VERSION);
+            request.onupgradeneeded = () => {
+                const db = request.result;
+                if (!db.objectStoreNames.contains(MESSAGE_STORE)) {
+                    // 以[会话ID, 消息序号]为主键，同一会话的消息在键空间中连续
+                    db.createObjectStore(MESSAGE_STORE, { keyPath: ['sessionId', 'index'] });
+                }
+            };
+            request.onsuccess = () => resolve(request.result);
+            request.onerror = () => reject(request.error);
+        });
+    }
+    return dbPromise;
+};
+
+const waitForTransaction = (transaction: IDBTransaction): Promise<void> =>
+    new Promise((resolve, reject) => {
+        transaction.oncomplete = () => resolve();
+        transaction.onerror = () => reject(transaction.error);
+        transaction.onabort = () => reject(transaction.error);
+    });
+
+const toRecord = (sessionId: string, index: number, message: StoredMessage): MessageRecord => ({
+    sessionId,
+    index,
+    content: message.content,
+    from: message.from,
+    timestamp: message.timestamp instanceof Date ? message.timestamp.toISOString() : String(message.timestamp),
+    isFinal: message.isFinal
+});
+
+const sessionRange = (sessionId: string, fromIndex = 0) =>
+    IDBKeyRange.bound([sessionId, fromIndex], [sessionId, Infinity]);
+
+// 读取全部会话消息
+export const loadAllMessages = async (): Promise<StoredSessionMessages> => {
+    const db = await openDatabase();
+    const transaction = db.transaction(MESSAGE_STORE, 'readonly');
+    const request = transaction.objectStore(MESSAGE_STORE).getAll();
+    await waitForTransaction(transaction);
+
+    // getAll按主键顺序返回，同一会话的消息已按序号排列
+    const result: StoredSessionMessages = {};
+    (request.result as MessageRecord[]).forEach(record => {
+        if (!result[record.sessionId]) {
+            result[record.sessionId] = [];
+        }
+        result[record.sessionId].push({
+            content: record.content,
+            from: record.from,
+            timestamp: new Date(record.timestamp),
+            isFinal: record.isFinal
+        });
+    });
+    return result;
+};
+
+// 批量写入消息
+const putRecords = async (records: MessageRecord[]) => {
+    if (records.length === 0) return;
+    const db = await openDatabase();
+    const transaction = db.transaction(MESSAGE_STORE, 'readwrite');
+    const store = transaction.objectStore(MESSAGE_STORE);
+    records.forEach(record => store.put(record));
+    await waitForTransaction(transaction);
+};
+
+// 删除会话中序号不小于fromIndex的消息，fromIndex为0时删除整个会话
+const deleteRecords = async (sessionId: string, fromIndex = 0) => {
+    const db = await openDatabase();
+    const transaction = db.transaction(MESSAGE_STORE, 'readwrite');
+    transaction.objectStore(MESSAGE_STORE).delete(sessionRange(sessionId, fromIndex));
+    await waitForTransaction(transaction);
+};
+
+// 把旧版localStorage中的消息历史一次性迁移到IndexedDB
+export const migrateFromLocalStorage = async () => {
+    const serializedMessages = localStorage.getItem(LEGACY_STORAGE_KEY);
+    if (!serializedMessages) return;
+
+    try {
+        const legacyMessages: StoredSessionMessages = JSON.parse(serializedMessages, (key, value) => {
+            if (key === 'timestamp' && typeof value === 'string') {
+                return new Date(value);
+            }
+            return value;
+        });
+        const records: MessageRecord[] = [];
+        Object.entries(legacyMessages).forEach(([sessionId, messages]) => {
+            messages.forEach((message, index) => records.push(toRecord(sessionId, index, message)));
+        });
+        await putRecords(records);
+        localStorage.removeItem(LEGACY_STORAGE_KEY);
+        console.log(`已将 ${records.length} 条消息从localStorage迁移到IndexedDB`);
+    } catch (error) {
+        console.error('迁移消息历史记录失败:', error);
+    }
+};
+
+// 增量持久化：流式输出中的消息合并写入，最终消息立即提交
+class MessagePersister {
+    private pending = new Map<string, MessageRecord>();
+    private timer: ReturnType<typeof setTimeout> | null = null;
+
+    schedule(sessionId: string, index: number, message: StoredMessage) {
+        this.pending.set(`${sessionId}\u0000${index}`, toRecord(sessionId, index, message));
+        if (message.isFinal) {
+            this.flush();
+        } else if (!this.timer) {
+            this.timer = setTimeout(() => this.flush(), STREAMING_WRITE_DELAY_MS);
+        }
+    }
+
+    deleteSession(sessionId: string, fromIndex = 0) {
+        // 丢弃尚未写入的、将被删除的消息
+        this.pending.forEach((record, key) => {
+            if (record.sessionId === sessionId && record.index >= fromIndex) {
+                this.pending.delete(key);
+            }
+        });
+        deleteRecords(sessionId, fromIndex).catch(error => console.error('删除消息历史记录失败:', error));
+    }
+
+    flush() {
+        if (this.timer) {
+            clearTimeout(this.timer);
+            this.timer = null;
+        }
+        if (this.pending.size === 0) return;
+        const records = Array.from(this.pending.values());
+        this.pending.clear();
+        putRecords(records).catch(error => console.error('保存消息历史记录失败:', error));
+    }
+}
+
+export const messagePersister = new MessagePersister();
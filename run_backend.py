@@ -1,4 +1,4 @@
 import uvicorn
 
 if __name__ == "__main__":
-    uvicorn.run("backend.app.main:app", host="127.0.0.1", port=8000, reload=True) 
\ No newline at end of file
+    uvicorn.run("backend.app.main:app", host="127.0.0.1", port=8000, reload=True, ws_per_message_deflate=True) 
\ No newline at end of file
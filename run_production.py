@@ -0,0 +1,165 @@
+"""生产环境启动入口：多worker、无自动重载，已安装时使用uvloop与httptools。
+
+用法（项目根目录）：
+    python run_production.py --host 0.0.0.0 --port 8000 --workers 4
+
+各参数也可通过环境变量设置，见README“生产部署”。开发时仍使用run_backend.py（单进程、自动重载）。
+"""
+import argparse
+import os
+import signal
+import sys
+import time
+from typing import Dict
+
+import uvicorn
+from uvicorn._subprocess import get_subprocess
+from uvicorn.supervisors import Multiprocess
+
+try:
+    import uvloop
+except ImportError:  # Windows不支持uvloop，或未安装时退回标准asyncio事件循环
+    uvloop = None
+
+try:
+    import httptools
+except ImportError:  # 未安装时退回纯Python的h11解析器
+    httptools = None
+
+APP = "backend.app.main:app"
+
+# 监听地址与端口
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "8000"))
+# worker进程数。会话、进行中的生成与语义缓存都在各worker的内存中，多worker时负载均衡需按client_id保持粘滞
+SERVER_WORKERS = int(os.getenv("SERVER_WORKERS", "1"))
+# 已安装uvloop与httptools时是否使用
+SERVER_FAST_LOOP = os.getenv("SERVER_FAST_LOOP", "true").lower() == "true"
+# HTTP keep-alive空闲超时（秒），应大于前端负载均衡到后端的空闲超时，避免负载均衡复用已被关闭的连接
+SERVER_KEEP_ALIVE = int(os.getenv("SERVER_KEEP_ALIVE", "75"))
+# 每个worker同时处理的连接数上限（含WebSocket），超出时新的HTTP请求返回503，0为不限制
+SERVER_LIMIT_CONCURRENCY = int(os.getenv("SERVER_LIMIT_CONCURRENCY", "0"))
+# 监听队列长度
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", "2048"))
+# 是否输出访问日志
+SERVER_ACCESS_LOG = os.getenv("SERVER_ACCESS_LOG", "false").lower() == "true"
+# 单条WebSocket消息的最大字节数，客户端发送的是一条提问，不需要uvicorn默认的16MB
+WS_MAX_MESSAGE_BYTES = int(os.getenv("WS_MAX_MESSAGE_BYTES", str(1024 * 1024)))
+# 每个连接尚未被处理的入站消息数上限，超出后暂停读取该连接
+WS_MAX_INBOUND_QUEUE = int(os.getenv("WS_MAX_INBOUND_QUEUE", "16"))
+# 是否启用permessage-deflate压缩；每个连接的压缩状态约占数十KB内存，大量空闲连接时可关闭
+WS_PER_MESSAGE_DEFLATE = os.getenv("WS_PER_MESSAGE_DEFLATE", "true").lower() == "true"
+# 排空结束交给uvicorn退出后，等待剩余HTTP请求完成的时间（秒）
+SERVER_GRACEFUL_SHUTDOWN = 10
+# 检查worker是否意外退出的间隔（秒）
+WORKER_CHECK_INTERVAL = 1.0
+# worker启动后在该时间（秒）内退出视为启动失败（配置错误、端口或依赖问题），不再重启而是停止服务
+WORKER_MIN_UPTIME = 10.0
+
+
+class WorkerSupervisor(Multiprocess):
+    """在uvicorn的多进程管理上补充两点：退出时同时向所有worker发送SIGTERM，让它们并行排空
+    （uvicorn逐个终止并等待，总耗时会按worker数累加）；worker运行一段时间后意外退出时重新启动"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.started_at: Dict[int, float] = {}
+
+    def signal_handler(self, sig, frame):
+        if self.should_exit.is_set() and sig == signal.SIGTERM:
+            # 再次收到SIGTERM：转发给worker，各worker不再等待进行中的生成
+            for process in self.processes:
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGTERM)
+            return
+        self.should_exit.set()
+
+    def run(self):
+        self.startup()
+        now = time.monotonic()
+        self.started_at = {process.pid: now for process in self.processes}
+        while not self.should_exit.wait(WORKER_CHECK_INTERVAL):
+            if not self.restart_exited():
+                break
+        self.shutdown()
+
+    def restart_exited(self) -> bool:
+        """重启意外退出的worker；有worker启动后很快退出时返回False"""
+        for index, process in enumerate(self.processes):
+            if process.is_alive():
+                continue
+            uptime = time.monotonic() - self.started_at.pop(process.pid, 0.0)
+            if uptime < WORKER_MIN_UPTIME:
+                print(f"worker进程 {process.pid} 启动后 {uptime:.1f}s 即退出（返回码 {process.exitcode}），停止服务")
+                return False
+            print(f"worker进程 {process.pid} 意外退出（返回码 {process.exitcode}），重新启动")
+            replacement = get_subprocess(config=self.config, target=self.target, sockets=self.sockets)
+            replacement.start()
+            self.processes[index] = replacement
+            self.started_at[replacement.pid] = time.monotonic()
+        return True
+
+    def shutdown(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.join()
+        print(f"所有worker已退出，父进程 {self.pid} 结束")
+
+
+def build_config(args: argparse.Namespace, app: str = APP) -> uvicorn.Config:
+    fast = args.fast_loop
+    return uvicorn.Config(
+        app,
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        loop="uvloop" if fast and uvloop is not None else "asyncio",
+        http="httptools" if fast and httptools is not None else "h11",
+        ws="websockets",
+        ws_max_size=WS_MAX_MESSAGE_BYTES,
+        ws_max_queue=WS_MAX_INBOUND_QUEUE,
+        # 心跳由应用的连接管理器统一批量发送（见connections），关闭websockets库为每个连接创建的保活任务
+        ws_ping_interval=None,
+        ws_ping_timeout=None,
+        ws_per_message_deflate=WS_PER_MESSAGE_DEFLATE,
+        reload=False,
+        timeout_keep_alive=SERVER_KEEP_ALIVE,
+        timeout_graceful_shutdown=SERVER_GRACEFUL_SHUTDOWN,
+        limit_concurrency=SERVER_LIMIT_CONCURRENCY or None,
+        backlog=SERVER_BACKLOG,
+        access_log=SERVER_ACCESS_LOG,
+    )
+
+
+def serve(config: uvicorn.Config):
+    """单worker时在当前进程中运行；多worker时由父进程绑定端口并管理worker进程。
+    两种方式下SIGTERM都会先触发各worker的停机排空（见drain），期间/ready返回503"""
+    server = uvicorn.Server(config)
+    print(f"启动服务: {config.host}:{config.port}，worker数 {config.workers}，事件循环 {config.loop}，HTTP解析 {config.http}")
+    if config.workers > 1:
+        sock = config.bind_socket()
+        supervisor = WorkerSupervisor(config, target=server.run, sockets=[sock])
+        supervisor.run()
+        if any(process.exitcode for process in supervisor.processes):
+            sys.exit(1)
+    else:
+        server.run()
+        if not server.started:
+            sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS)
+    parser.add_argument("--no-fast-loop", dest="fast_loop", action="store_false", default=SERVER_FAST_LOOP,
+                        help="不使用uvloop与httptools")
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers至少为1")
+    serve(build_config(args))
+
+
+if __name__ == "__main__":
+    main()